@@ -5,6 +5,7 @@ Module for handling, parsing, and checking configuration files
 from sklearn.metrics import make_scorer
 from configobj import ConfigObj
 import logging
+import os
 
 from . import metrics, utils
 from .legos.model_finder import check_models_mixed
@@ -80,7 +81,9 @@ def parse_conf_file(filepath):
 
     def check_general_setup_settings_are_valid():
         all_settings =  ['input_features', 'target_feature', 'metrics',
-                         'randomizer', 'validation_columns', 'not_input_features', 'grouping_feature']
+                         'randomizer', 'validation_columns', 'not_input_features', 'grouping_feature',
+                         'n_jobs', 'feature_cache', 'feature_cache_size', 'split_cache', 'split_csvs',
+                         'fit_dtype', 'fold_preprocessing', 'low_memory', 'data_cache']
         for name in GS:
             if name not in all_settings:
                 raise utils.InvalidConfParameters(
@@ -129,6 +132,70 @@ def parse_conf_file(filepath):
             GS['randomizer'] = False
     set_randomizer_setting()
 
+    def set_fit_dtype_setting():
+        GS['fit_dtype'] = GS.get('fit_dtype', 'float64')
+        if GS['fit_dtype'] not in ['float64', 'float32']:
+            raise utils.InvalidConfParameters(
+                f"[GeneralSetup] fit_dtype must be float64 or float32, got '{GS['fit_dtype']}'")
+    set_fit_dtype_setting()
+
+    def set_data_cache_setting():
+        if 'data_cache' in GS:
+            GS['data_cache'] = mybool(GS['data_cache'])
+        else:
+            GS['data_cache'] = False
+    set_data_cache_setting()
+
+    def set_low_memory_setting():
+        if 'low_memory' in GS:
+            GS['low_memory'] = mybool(GS['low_memory'])
+        else:
+            GS['low_memory'] = False
+    set_low_memory_setting()
+
+    def set_fold_preprocessing_setting():
+        if 'fold_preprocessing' in GS:
+            GS['fold_preprocessing'] = mybool(GS['fold_preprocessing'])
+        else:
+            GS['fold_preprocessing'] = False
+    set_fold_preprocessing_setting()
+
+    def set_split_csvs_setting():
+        if 'split_csvs' in GS:
+            GS['split_csvs'] = mybool(GS['split_csvs'])
+        else:
+            GS['split_csvs'] = False
+    set_split_csvs_setting()
+
+    def set_n_jobs_setting():
+        if 'n_jobs' in GS:
+            try:
+                GS['n_jobs'] = int(GS['n_jobs'])
+            except ValueError:
+                raise utils.InvalidConfParameters(
+                    f"[GeneralSetup] n_jobs must be an integer, got '{GS['n_jobs']}'")
+        else:
+            GS['n_jobs'] = 1
+    set_n_jobs_setting()
+
+    def set_feature_cache_settings():
+        if 'feature_cache' not in GS or GS['feature_cache'] in ['None', 'False', 'false']:
+            GS['feature_cache'] = None
+        else:
+            GS['feature_cache'] = os.path.expanduser(GS['feature_cache'])
+        try:
+            GS['feature_cache_size'] = float(GS.get('feature_cache_size', 1000))
+        except ValueError:
+            raise utils.InvalidConfParameters(
+                f"[GeneralSetup] feature_cache_size must be a number of megabytes, got '{GS['feature_cache_size']}'")
+    set_feature_cache_settings()
+
+    def set_split_cache_setting():
+        if 'split_cache' not in GS or GS['split_cache'] in ['None', 'False', 'false']:
+            GS['split_cache'] = None
+        else:
+            GS['split_cache'] = os.path.expanduser(GS['split_cache'])
+    set_split_cache_setting()
 
     def set_default_features():
         for name in ['input_features', 'target_feature']:
@@ -184,17 +251,24 @@ def parse_conf_file(filepath):
     make_long_name_short_name_pairs()
 
     def check_and_boolify_plot_settings():
-        default_false = ['feature_vs_target']
+        default_false = ['feature_vs_target', 'defer_plots']
         default_true = ['target_histogram', 'train_test_plots', 'predicted_vs_true',
                          'predicted_vs_true_bars', 'best_worst_per_point', 'average_normalized_errors',
                          'average_cumulative_normalized_errors']
-        all_settings = default_false + default_true
+        all_settings = default_false + default_true + ['dpi']
         if 'PlotSettings' not in conf:
             conf['PlotSettings'] = dict()
         PS = conf['PlotSettings']
+        try:
+            PS['dpi'] = int(PS.get('dpi', 250))
+        except ValueError:
+            raise utils.InvalidConfParameters(
+                f"[PlotSettings] dpi must be an integer, got '{PS['dpi']}'")
         for name, value in PS.items():
             if name not in all_settings:
                 raise utils.InvalidConfParameters(f"[PlotSettings] parameter '{name}' is unknown")
+            if name == 'dpi':
+                continue
             try:
                 PS[name] = mybool(value)
             except ValueError:
@@ -0,0 +1,128 @@
+"""
+Module for caching the parsed contents of an input data file beside it, so later runs on the same
+file skip parsing the csv or xlsx.
+
+The cache is a directory next to the data file (<file>.mastml_cache) holding one .npy file per
+column and a meta.json describing the columns and the file they came from. Text columns are
+stored as categorical codes, with their categories kept in meta.json. A cache is used while the
+file's size and modification time match, or, if only the time changed, its sha256 does. Columns
+are memory mapped when loaded, and only the ones asked for are read.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+# Bump whenever the saved format changes
+CACHE_VERSION = 1
+
+def cache_path(file_path):
+    return file_path + '.mastml_cache'
+
+def cached_columns(file_path):
+    " Column names of file_path's cache, or None if it has no usable cache "
+    meta = _valid_meta(file_path)
+    return None if meta is None else [column['name'] for column in meta['columns']]
+
+def load(file_path, usecols=None, categorical=False):
+    """
+    Returns the cached dataframe of file_path, with only the columns in usecols if given, or None
+    if there's no usable cache. Text columns come back as objects, or categoricals if categorical.
+    """
+    meta = _valid_meta(file_path)
+    if meta is None:
+        return None
+    directory = cache_path(file_path)
+    columns = dict()
+    for number, column in enumerate(meta['columns']):
+        if usecols is not None and column['name'] not in usecols:
+            continue
+        values = np.load(os.path.join(directory, f'{number}.npy'), mmap_mode='r')
+        if column['categories'] is None:
+            columns[column['name']] = values
+        else:
+            values = pd.Categorical.from_codes(values, column['categories'])
+            columns[column['name']] = values if categorical else np.asarray(values, dtype=object)
+    names = [column['name'] for column in meta['columns'] if column['name'] in columns]
+    log.info(f'Loaded {len(names)} columns of {file_path} from its cache {directory}')
+    return pd.DataFrame(columns, columns=names)
+
+def save(file_path, df):
+    """
+    Caches df as the contents of file_path, replacing any older cache. Raises OSError if it can't
+    be written, and TypeError or ValueError if df holds values that can't be stored (like a text
+    column with dates mixed in); either way no partial cache is left behind.
+    """
+    directory = cache_path(file_path)
+    temp_directory = f'{directory}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    try:
+        os.makedirs(temp_directory)
+        columns = list()
+        for number, name in enumerate(df.columns):
+            series = df[name]
+            if series.dtype.kind in 'biufcmM' and isinstance(series.values, np.ndarray):
+                values, categories = series.values, None
+            else: # text, or anything else numpy can't store on its own
+                categorical = pd.Categorical(series)
+                values, categories = categorical.codes, [_jsonable(c) for c in categorical.categories]
+            np.save(os.path.join(temp_directory, f'{number}.npy'), values, allow_pickle=False)
+            columns.append(dict(name=_jsonable(name), categories=categories))
+        meta = dict(version=CACHE_VERSION, source=_fingerprint(file_path, with_hash=True), columns=columns)
+        with open(os.path.join(temp_directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temp_directory, directory)
+    finally:
+        shutil.rmtree(temp_directory, ignore_errors=True)
+    log.info(f'Cached the contents of {file_path} in {directory}')
+
+def _valid_meta(file_path):
+    " The cache's meta.json contents if it's from this CACHE_VERSION and matches file_path, else None "
+    meta_path = os.path.join(cache_path(file_path), 'meta.json')
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != CACHE_VERSION:
+        return None
+    source, current = meta['source'], _fingerprint(file_path)
+    if source['size'] != current['size']:
+        return None
+    if source['mtime_ns'] != current['mtime_ns']:
+        # touched but maybe not changed, like after a copy or checkout
+        if source['sha256'] != _fingerprint(file_path, with_hash=True)['sha256']:
+            return None
+        source['mtime_ns'] = current['mtime_ns']
+        temp_path = f'{meta_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(temp_path, meta_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return meta
+
+def _fingerprint(file_path, with_hash=False):
+    stat = os.stat(file_path)
+    fingerprint = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    if with_hash:
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(block)
+        fingerprint['sha256'] = hasher.hexdigest()
+    return fingerprint
+
+def _jsonable(value):
+    " numpy scalars to plain python ones so json can write them "
+    return value.item() if isinstance(value, np.generic) else value
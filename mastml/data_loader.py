@@ -2,30 +2,48 @@
 Module for loading checking the input data file
 """
 
+import os
+from collections import OrderedDict
+
 import pandas as pd
+from pandas.api.types import union_categoricals
 import logging
 log = logging.getLogger('mastml')
 
-def load_data(file_path, input_features=None, target_feature=None, grouping_feature = None, feature_blacklist=list()):
-    " Loads in csv from filename and ensures required columns are present. Returns dataframe. "
+from . import data_cache
 
-    # Load data
-    try:
-        df = pd.read_csv(file_path)
-    except:
-        df = pd.read_excel(file_path)
+# Rows parsed at a time by the low_memory csv reader
+CHUNK_ROWS = 100000
 
-    # Assign default values to input_features and target_feature;
-    if input_features is None and target_feature is None: # input is first n-1 and target is just n
-        input_features = list(df.columns[:-1])
-        target_feature = df.columns[-1]
-    elif input_features is None: # input is all the features except the target feature
-        input_features = [col for col in df.columns if col != target_feature]
-    elif target_feature is None: # target is the last non-input feature
-        for col in df.columns[::-1]:
-            if col not in input_features:
-                target_feature = col
-                break
+def load_data(file_path, input_features=None, target_feature=None, grouping_feature = None, feature_blacklist=list(),
+              low_memory=False, keep_columns=(), cache=False):
+    """
+    Loads in csv, xlsx, parquet or feather from filename and ensures required columns are present.
+    Returns dataframe.
+
+    With cache, the parsed file is kept in a data_cache beside it and read from there next time.
+
+    With low_memory, a csv is parsed CHUNK_ROWS rows at a time and every column but the target is
+    shrunk by _compact as it comes in. If input_features is given, only the
+    columns the run needs are read: the inputs, the target, grouping_feature, feature_blacklist
+    and keep_columns (validation columns, columns named by feature generators, ...).
+    """
+
+    # Load data
+    if low_memory:
+        header = _read_header(file_path, cache)
+        input_features, target_feature = _default_features(header, input_features, target_feature)
+        needed = set(input_features) | set(feature_blacklist) | set(keep_columns)
+        needed |= {column for column in [target_feature, grouping_feature] if column is not None}
+        usecols = [column for column in header if column in needed]
+        log.info(f'Loading {len(usecols)} of the {len(header)} columns in {file_path}')
+        if cache:
+            df = _compact(_read_cached(file_path, usecols, categorical=True), target_feature)
+        else:
+            df = _read_compact(file_path, usecols, target_feature)
+    else:
+        df = _read_cached(file_path) if cache else _read_file(file_path)
+        input_features, target_feature = _default_features(df.columns, input_features, target_feature)
 
     # Collect required features:
     required_features = input_features + [target_feature]
@@ -35,23 +53,106 @@ def load_data(file_path, input_features=None, target_feature=None, grouping_feat
         if feature not in df.columns:
             raise Exception(f"Data file does not have column '{feature}'")
 
-    X, y = df[input_features], df[target_feature]
-
     log.info('blacklisted features, either from "not_input_features" or a "grouping_column":' +
                  str(feature_blacklist))
-    # take blacklisted features out of X:
-    X_noinput_dict = dict()
-    for feature in set(feature_blacklist):
-        X_noinput_dict[feature] = X[feature]
-        X = X.drop(feature, axis=1)
-
-    X_noinput = pd.DataFrame(X_noinput_dict)
+    # take blacklisted features out of X, selecting the remaining columns once rather than
+    # dropping them one by one (each drop copies the whole frame)
+    noinput_features = list(OrderedDict.fromkeys(feature_blacklist))
+    X = df[[feature for feature in input_features if feature not in noinput_features]]
+    X_noinput = df[noinput_features]
 
     if grouping_feature:
         X_grouped = pd.DataFrame(df[grouping_feature])
     else:
         X_grouped = None
 
-    df = df.drop(target_feature, axis=1)
+    y = df.pop(target_feature)
 
     return df, X, X_noinput, X_grouped, y
+
+def _default_features(columns, input_features, target_feature):
+    " Assign default values to input_features and target_feature "
+    if input_features is None and target_feature is None: # input is first n-1 and target is just n
+        input_features = list(columns[:-1])
+        target_feature = columns[-1]
+    elif input_features is None: # input is all the features except the target feature
+        input_features = [col for col in columns if col != target_feature]
+    elif target_feature is None: # target is the last non-input feature
+        for col in columns[::-1]:
+            if col not in input_features:
+                target_feature = col
+                break
+    return input_features, target_feature
+
+def _extension(file_path):
+    return os.path.splitext(file_path)[1]
+
+def _read_file(file_path, usecols=None):
+    " Reads usecols (default all) of file_path, picking the reader by its extension "
+    if _extension(file_path) == '.parquet':
+        return pd.read_parquet(file_path, columns=usecols)
+    if _extension(file_path) == '.feather':
+        return pd.read_feather(file_path, columns=usecols)
+    if _extension(file_path) in ['.xlsx', '.xls']:
+        df = pd.read_excel(file_path)
+        return df[usecols] if usecols is not None else df
+    return pd.read_csv(file_path, usecols=usecols)
+
+def _read_cached(file_path, usecols=None, categorical=False):
+    """
+    Reads usecols (default all) of file_path from its data_cache, first caching all of it if
+    the cache is missing or stale. Parquet and feather are quick to read already, so they aren't cached.
+    """
+    if _extension(file_path) in ['.parquet', '.feather']:
+        return _read_file(file_path, usecols)
+    df = data_cache.load(file_path, usecols, categorical)
+    if df is not None:
+        return df
+    df = _read_file(file_path)
+    try:
+        data_cache.save(file_path, df)
+    except (OSError, TypeError, ValueError) as e:
+        log.warning(f'Could not cache {file_path}, reading it without the cache: {e}')
+    return df[usecols] if usecols is not None else df
+
+def _read_header(file_path, cache=False):
+    if cache and data_cache.cached_columns(file_path) is not None:
+        return data_cache.cached_columns(file_path)
+    if _extension(file_path) == '.parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(file_path).names
+    if _extension(file_path) == '.feather':
+        import pyarrow.ipc
+        return pyarrow.ipc.open_file(file_path).schema.names
+    if _extension(file_path) in ['.xlsx', '.xls']:
+        return list(pd.read_excel(file_path, nrows=0).columns)
+    return list(pd.read_csv(file_path, nrows=0).columns)
+
+def _read_compact(file_path, usecols, target_feature):
+    " Reads file_path chunk by chunk, compacting each chunk before the next is parsed "
+    if _extension(file_path) != '.csv':
+        return _compact(_read_file(file_path, usecols), target_feature)
+    chunks = [_compact(chunk, target_feature)
+              for chunk in pd.read_csv(file_path, usecols=usecols, chunksize=CHUNK_ROWS)]
+    df = pd.concat(chunks, ignore_index=True)
+    # chunks end up with different categories, which concat turns back into plain objects
+    for column in df.columns:
+        if all(chunk[column].dtype.name == 'category' for chunk in chunks):
+            df[column] = union_categoricals([chunk[column] for chunk in chunks])
+    return df
+
+def _compact(df, target_feature):
+    """
+    Shrinks the columns of df (except the target): floats to float32, ints to the smallest int
+    type that holds them and text to categoricals
+    """
+    for column in df.columns:
+        if column == target_feature:
+            continue
+        if df[column].dtype == 'float64':
+            df[column] = df[column].astype('float32')
+        elif df[column].dtype == 'int64':
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+        elif df[column].dtype == 'object':
+            df[column] = df[column].astype('category')
+    return df
@@ -0,0 +1,95 @@
+"""
+Module for caching the output of feature generators on disk between runs.
+
+Each cached dataframe lives in its own file, named by a hash of everything that determines it:
+the input columns the generator reads, the generator class and its conf parameters, and
+CACHE_VERSION. Files are stored column by column in a .npz, and the least recently used ones
+are deleted once the directory grows past its size cap.
+"""
+
+import hashlib
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+# Bump whenever a generator's output changes for the same input, so stale entries are never hit
+CACHE_VERSION = 1
+
+def generate_cached(generator, kwargs, df, y, cache_dir, max_size_mb):
+    """
+    Returns generator.fit_transform(df, y), loading it from cache_dir if the same generator with the
+    same kwargs has already been run on the same input columns.
+    """
+    key = cache_key(generator, kwargs, df)
+    path = os.path.join(cache_dir, key + '.npz')
+
+    if os.path.isfile(path):
+        try:
+            dataframe = _load_dataframe(path)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'Ignoring unreadable feature cache entry {path}: {e}')
+        else:
+            log.info(f'Loaded {generator.__class__.__name__} features from cache {path}')
+            os.utime(path) # mark as recently used
+            return dataframe
+
+    dataframe = generator.fit_transform(df, y)
+    os.makedirs(cache_dir, exist_ok=True)
+    _save_dataframe(dataframe, path)
+    _evict(cache_dir, max_size_mb)
+    return dataframe
+
+def cache_key(generator, kwargs, df):
+    " Hex digest identifying the output of generator, built with kwargs, on df "
+    hasher = hashlib.sha256()
+    hasher.update(f'{CACHE_VERSION} {generator.__module__}.{generator.__class__.__name__}'.encode())
+    hasher.update(repr(sorted((str(k), repr(v)) for k, v in kwargs.items())).encode())
+    columns = _relevant_columns(generator, df)
+    hasher.update(repr([(str(c), str(df[c].dtype)) for c in columns]).encode())
+    hasher.update(pd.util.hash_pandas_object(df[columns], index=True).values.tobytes())
+    hasher.update(str(len(df)).encode())
+    return hasher.hexdigest()
+
+def _relevant_columns(generator, df):
+    " The columns of df that generator actually reads, so unrelated edits don't invalidate it "
+    composition_feature = getattr(generator, 'composition_feature', None)
+    if composition_feature is not None:
+        # Magpie joins together every column containing the composition feature name
+        return [column for column in df.columns if composition_feature in column]
+    features = getattr(generator, 'features', None)
+    if features is not None:
+        return list(features)
+    return list(df.columns)
+
+def _save_dataframe(dataframe, path):
+    " Writes each column as its own array, through a temporary file so readers never see half of it "
+    arrays = {f'column_{i}': dataframe.iloc[:, i].values for i in range(dataframe.shape[1])}
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, columns=np.array(list(dataframe.columns), dtype=object),
+                 index=dataframe.index.values, **arrays)
+    os.replace(temp_path, path)
+
+def _load_dataframe(path):
+    with np.load(path, allow_pickle=True) as saved:
+        columns = list(saved['columns'])
+        # generators may drop rows, so the index is saved rather than taken from the input
+        dataframe = pd.DataFrame({i: saved[f'column_{i}'] for i in range(len(columns))},
+                                 columns=range(len(columns)), index=saved['index'])
+    dataframe.columns = columns
+    return dataframe
+
+def _evict(cache_dir, max_size_mb):
+    " Deletes the least recently used entries until the cache fits in max_size_mb "
+    entries = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.npz')]
+    entries = sorted(entries, key=os.path.getmtime)
+    total_size = sum(os.path.getsize(f) for f in entries)
+    while entries and total_size > max_size_mb * 1024**2:
+        oldest = entries.pop(0)
+        total_size -= os.path.getsize(oldest)
+        log.debug(f'Evicting {oldest} from feature cache')
+        os.remove(oldest)
@@ -0,0 +1,66 @@
+"""
+Module for fitting the normalizers and feature selectors inside cross validation, on the training
+rows of each fold only, so no information from a fold's test rows leaks into the features its
+models are scored on.
+
+Each distinct training set is fit once: folds are keyed by a hash of their training row labels, so
+the splitters that produce the same fold and every model fit on it share one transformed
+dataframe, and each normalizer fit on a fold is shared by all the selectors that follow it.
+"""
+
+import copy
+import hashlib
+import logging
+
+import numpy as np
+from sklearn.externals.joblib import Parallel, delayed
+
+log = logging.getLogger('mastml')
+
+def fold_key(train_indices):
+    " Hex digest identifying a fold by its training row labels "
+    train_indices = np.ascontiguousarray(train_indices)
+    return hashlib.sha1(str(train_indices.dtype).encode() + train_indices.tobytes()).hexdigest()
+
+def transform_folds(normalizers, selectors, X, y, folds, X_grouped=None, n_jobs=1):
+    """
+    Fits every (normalizer, selector) pair on the training rows of each distinct fold in folds, an
+    iterable of training index labels, and transforms all the rows of X with it.
+    Returns a dict of {(fold_key, normalizer_name, selector_name): transformed dataframe}.
+    """
+    distinct = dict()
+    for train_indices in folds:
+        distinct.setdefault(fold_key(train_indices), train_indices)
+    log.info(f"Fitting {len(normalizers)*len(selectors)} normalizer/selector pairs "
+             f"on {len(distinct)} distinct folds with n_jobs={n_jobs}")
+    fits = Parallel(n_jobs=n_jobs)(delayed(fit_fold)(normalizers, selectors, X, y, train_indices, X_grouped)
+                                   for train_indices in distinct.values())
+    transformed = dict()
+    for key, fit in zip(distinct, fits):
+        for (normalizer_name, selector_name), X_selected in fit.items():
+            transformed[(key, normalizer_name, selector_name)] = X_selected
+    return transformed
+
+def fit_fold(normalizers, selectors, X, y, train_indices, X_grouped=None):
+    """
+    Fits copies of the normalizers and selectors, lists of (name, instance), on the rows of X at
+    train_indices and returns {(normalizer_name, selector_name): all rows of X transformed}
+    """
+    train_X, train_y = X.loc[train_indices], y.loc[train_indices]
+    train_groups = X_grouped.loc[train_indices] if X_grouped is not None else None
+    transformed = dict()
+    for normalizer_name, normalizer_instance in normalizers:
+        normalizer = copy.deepcopy(normalizer_instance).fit(train_X, train_y)
+        X_normalized = normalizer.transform(X)
+        train_normalized = X_normalized.loc[train_indices]
+        for selector_name, selector_instance in selectors:
+            selector = copy.deepcopy(selector_instance)
+            if selector.__class__.__name__ == 'MASTMLFeatureSelector':
+                selector.fit(train_normalized, train_y, train_groups)
+            else:
+                selector.fit(train_normalized, train_y)
+            X_selected = selector.transform(X_normalized)
+            if not X_selected.index.equals(X.index): # some selectors make new dataframes without it
+                X_selected.index = X.index
+            transformed[(normalizer_name, selector_name)] = X_selected
+    return transformed
@@ -4,13 +4,12 @@ This whole thing is a hack. But it's the only way, short of repeating every line
 twice.
 """
 
+import functools
 import inspect
 import os
 import textwrap
 from pandas import DataFrame, Series
 
-import nbformat
-
 from . import plot_helper # TODO: fix cyclic import
 
 def ipynb_maker(plot_func):
@@ -18,6 +17,7 @@ def ipynb_maker(plot_func):
     wraps a plotting func so it also outputs it's own usable source
     """
 
+    @functools.wraps(plot_func)
     def wrapper(*args, **kwargs):
 
         # convert everything to kwargs for easier display
@@ -59,8 +59,11 @@ def ipynb_maker(plot_func):
         func_strings = '\n\n'.join(inspect.getsource(func) for func in core_funcs)
 
         plot_func_string = inspect.getsource(plot_func)
-        # remove first line that has this decorator on it (!!!)
-        plot_func_string = '\n'.join(plot_func_string.split('\n')[1:])
+        # remove the decorator lines on top of it (!!!)
+        plot_func_lines = plot_func_string.split('\n')
+        while plot_func_lines[0].startswith('@'):
+            plot_func_lines.pop(0)
+        plot_func_string = '\n'.join(plot_func_lines)
 
         # put the arguments and their values in the code
         arg_assignments = []
@@ -98,6 +101,7 @@ def ipynb_maker(plot_func):
                     display(Image(filename=plot_path))
             """)
 
+        import nbformat # slow to import, and only needed once there's a notebook to write
         nb = nbformat.v4.new_notebook()
         readme_cell = nbformat.v4.new_markdown_cell(readme)
         text_cells = [header, func_strings, plot_func_string, args_block, main]
@@ -3,8 +3,10 @@ import pandas as pd
 import warnings
 import logging
 
+from sklearn.base import clone
 from sklearn.model_selection import learning_curve
 from sklearn.feature_selection import f_regression
+from sklearn.externals.joblib import Parallel, delayed
 
 from mastml.legos import feature_selectors as fs
 
@@ -27,61 +29,89 @@ def sample_learning_curve(X, y, estimator, cv, scoring, Xgroups=None):
 
     return train_sizes, train_mean, test_mean, train_stdev, test_stdev
 
-def feature_learning_curve(X, y, estimator, cv, scoring, selector_name, n_features_to_select=None, Xgroups=None):
+def feature_learning_curve(X, y, estimator, cv, scoring, selector_name, n_features_to_select=None, Xgroups=None, n_jobs=1):
+    """
+    Cv train and test scores of estimator using the top 1, 2, ... n_features_to_select features.
+    The selector is only fit once: forward selection, RFE, SelectKBest and SequentialFeatureSelector
+    all produce nested feature sets, so every size is read off the same ranking path. The cv for
+    the different sizes then runs in n_jobs processes.
+    """
     if Xgroups is not None:
         Xgroups = np.array(Xgroups).reshape(-1, )
+    if not n_features_to_select:
+        n_features_to_select = X.shape[1]
+    n_features_to_select = min(n_features_to_select, X.shape[1])
+    train_sizes = [1+f for f in range(n_features_to_select)]
+
+    feature_subsets = _feature_ranking_path(X, y, estimator, cv, selector_name, n_features_to_select, Xgroups)
+
+    # Need to use arrays to avoid indexing issues when leaving out validation data
+    X_values = np.array(X)
+    y = np.array(y)
+    splits = list(cv.split(X_values, y, Xgroups))
+    predictions = Parallel(n_jobs=n_jobs)(
+        delayed(_cv_predictions)(estimator, X_values[:, subset], y, splits) for subset in feature_subsets)
+
+    # Score here rather than in the workers, some of the metrics are lambdas and can't be pickled
     train_mean = list()
     train_stdev = list()
     test_mean = list()
     test_stdev = list()
-    if not n_features_to_select:
-        n_features_to_select = X.shape[1].tolist()
-    train_sizes = range(n_features_to_select)
-    train_sizes = [1+f for f in train_sizes]
-    for feature in train_sizes:
-        if selector_name == 'RFE':
-            log.warning("Using RFE as feature selector does not support a custom CV or grouping scheme. Your learning"
-                        "curve will be generated properly, but will not use the custom CV or grouping scheme")
-            try:
-                Xnew = fs.name_to_constructor[selector_name](estimator, feature+1).fit(X, y).transform(X)
-            except RuntimeError:
-                log.error("You have specified an estimator for RFE that does not have a coef_ or feature_importances_ attribute. "
-                          "Acceptable models to use with RFE include: LinearRegression, Lasso, SVR, DecisionTreeRegressor, "
-                          "RandomForestRegressor, ExtraTreesRegressor, AdaBoostRegressor, etc.")
-        elif selector_name == 'SelectKBest':
-            log.warning("Using SelectKBest as feature selector does not support a custom estimator model, CV or grouping scheme. "
-                        "Your learning curve will be generated properly, but will not use the custom model, CV or grouping scheme")
-            Xnew = fs.name_to_constructor[selector_name](f_regression, feature+1).fit(X, y).transform(X)
-        elif selector_name == 'MASTMLFeatureSelector':
-            Xnew = fs.name_to_constructor[selector_name](estimator, feature+1, cv).fit(X, y, pd.DataFrame(Xgroups)).transform(X)
-        elif selector_name == 'SequentialFeatureSelector':
-            log.warning("Using SequentialFeatureSelector as feature selector does not support a custom CV or grouping scheme. "
-                        "Your learning curve will be generated properly, but will not use the custom CV or grouping scheme")
-            Xnew = fs.name_to_constructor[selector_name](estimator, feature+1).fit(pd.DataFrame(X), pd.DataFrame(y)).transform(X)
-        elif selector_name == None:
+    for fold_predictions in predictions:
+        train_scores = [scoring._score_func(train_vals, y[trains])
+                        for (trains, tests), (train_vals, test_vals) in zip(splits, fold_predictions)]
+        test_scores = [scoring._score_func(test_vals, y[tests])
+                       for (trains, tests), (train_vals, test_vals) in zip(splits, fold_predictions)]
+        train_mean.append(np.mean(train_scores))
+        train_stdev.append(np.std(train_scores))
+        test_mean.append(np.mean(test_scores))
+        test_stdev.append(np.std(test_scores))
+    return np.array(train_sizes), np.array(train_mean), np.array(test_mean), np.array(train_stdev), np.array(test_stdev)
+
+def _feature_ranking_path(X, y, estimator, cv, selector_name, n_features_to_select, Xgroups):
+    " Column indices of the selected features for 1, 2, ... n_features_to_select features "
+    n_features = range(1, n_features_to_select+1)
+    if selector_name == 'RFE':
+        log.warning("Using RFE as feature selector does not support a custom CV or grouping scheme. Your learning"
+                    "curve will be generated properly, but will not use the custom CV or grouping scheme")
+        try:
+            # Eliminating one feature at a time down to 1 passes through every smaller RFE's selection
+            ranking = fs.name_to_constructor[selector_name](clone(estimator), n_features_to_select=1).fit(X, y).ranking_
+        except RuntimeError:
+            log.error("You have specified an estimator for RFE that does not have a coef_ or feature_importances_ attribute. "
+                      "Acceptable models to use with RFE include: LinearRegression, Lasso, SVR, DecisionTreeRegressor, "
+                      "RandomForestRegressor, ExtraTreesRegressor, AdaBoostRegressor, etc.")
+            raise
+        return [np.flatnonzero(ranking <= k) for k in n_features]
+    elif selector_name == 'SelectKBest':
+        log.warning("Using SelectKBest as feature selector does not support a custom estimator model, CV or grouping scheme. "
+                    "Your learning curve will be generated properly, but will not use the custom model, CV or grouping scheme")
+        scores = fs.name_to_constructor[selector_name](f_regression, k='all').fit(X, y).scores_
+        order = np.argsort(-np.nan_to_num(scores), kind='mergesort')
+        return [np.sort(order[:k]) for k in n_features]
+    elif selector_name == 'SequentialFeatureSelector':
+        log.warning("Using SequentialFeatureSelector as feature selector does not support a custom CV or grouping scheme. "
+                    "Your learning curve will be generated properly, but will not use the custom CV or grouping scheme")
+        sfs = fs.name_to_constructor[selector_name](clone(estimator), k_features=n_features_to_select).fit(pd.DataFrame(X), pd.DataFrame(y))
+        return [list(sfs.subsets_[k]['feature_idx']) for k in n_features]
+    elif selector_name in ['MASTMLFeatureSelector', None]:
+        if selector_name is None:
             log.warning("A selector name for learning curve calculation was not found. Defaulting to using the "
                         "MASTMLFeatureSelector for learning curve")
-            Xnew = fs.name_to_constructor["MASTMLFeatureSelector"](estimator, feature+1, cv).fit(X, y, pd.DataFrame(Xgroups)).transform(X)
-        else:
-            log.error("You have specified an invalid selector_name for learning curve. Either leave blank to use the default"
-                      " MASTMLFeatureSelector or use one of SelectKBest, RFE, SequentialFeatureSelector, MASTMLFeatureSelector")
-            exit()
-        # Need to use arrays to avoid indexing issues when leaving out validation data
-        Xnew = np.array(Xnew)
-        y = np.array(y)
-        Xgroups = np.array(Xgroups)
-        cv_number=1
-        train_scores = dict()
-        test_scores = dict()
-        for trains, tests in cv.split(Xnew, y, Xgroups):
-            model = estimator.fit(Xnew[trains], y[trains])
-            train_vals = model.predict(Xnew[trains])
-            test_vals = model.predict(Xnew[tests])
-            train_scores[cv_number] = scoring._score_func(train_vals, y[trains])
-            test_scores[cv_number] = scoring._score_func(test_vals, y[tests])
-            cv_number += 1
-        train_mean.append(np.mean(list(train_scores.values())))
-        train_stdev.append(np.std(list(train_scores.values())))
-        test_mean.append(np.mean(list(test_scores.values())))
-        test_stdev.append(np.std(list(test_scores.values())))
-    return np.array(train_sizes), np.array(train_mean), np.array(test_mean), np.array(train_stdev), np.array(test_stdev)
\ No newline at end of file
+        selector = fs.name_to_constructor["MASTMLFeatureSelector"](estimator, n_features_to_select, cv)
+        selector.fit(X, y, pd.DataFrame(Xgroups))
+        columns = [list(X.columns).index(name) for name in selector.selected_feature_names]
+        return [columns[:k] for k in n_features]
+    else:
+        log.error("You have specified an invalid selector_name for learning curve. Either leave blank to use the default"
+                  " MASTMLFeatureSelector or use one of SelectKBest, RFE, SequentialFeatureSelector, MASTMLFeatureSelector")
+        exit()
+
+def _cv_predictions(estimator, X, y, splits):
+    " [(train predictions, test predictions) for each split] "
+    model = clone(estimator)
+    fold_predictions = list()
+    for trains, tests in splits:
+        model.fit(X[trains], y[trains])
+        fold_predictions.append((model.predict(X[trains]), model.predict(X[tests])))
+    return fold_predictions
@@ -4,9 +4,15 @@ All classes here assume dataframe input and guarantee dataframe output
 (So no numpy arrays)
 """
 
-import multiprocessing
+import hashlib
+import json
 import os
+import time
 import logging
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -14,19 +20,20 @@ import pandas as pd
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.preprocessing import PolynomialFeatures as SklearnPolynomialFeatures
 
-import pymatgen
-from pymatgen import Element, Composition
-from pymatgen.ext.matproj import MPRester
-from citrination_client import CitrinationClient, PifQuery, SystemQuery, ChemicalFieldQuery, ChemicalFilter
-# trouble? try: `pip install citrination_client=="2.1.0"`
+# pymatgen and citrination_client are slow to import, so they're only imported by the generators
+# that use them. trouble with citrination_client? try: `pip install citrination_client=="2.1.0"`
 
 # locate path to directory containing AtomicNumber.table, AtomicRadii.table AtomicVolume.table, etc
 # (needs to do it the hard way becuase python -m sets cwd to wherever python is ran from)
 import mastml
 from mastml import utils
 log = logging.getLogger('mastml')
-print('mastml dir: ', mastml.__path__)
 MAGPIE_DATA_PATH = os.path.join(mastml.__path__[0], '../magpie/')
+MAGPIE_CACHE_NAME = 'magpie_table.npz'
+_magpie_tables = dict() # data_path -> (property_names, table), see load_magpie_table
+_parsed_compositions = dict() # composition string -> [(Z-1, atomic fraction), ...], see parse_compositions
+_citrine_cache = OrderedDict() # (api key or client, composition) -> (property names, values), least recently used first
+_citrine_cache_lock = threading.Lock()
 
 class PolynomialFeatures(BaseEstimator, TransformerMixin):
     def __init__(self, features=None, degree=2, interaction_only=False, include_bias=True):
@@ -61,37 +68,33 @@ class ContainsElement(BaseEstimator, TransformerMixin):
     def transform(self, df, y=None):
         compositions = df[self.composition_feature]
         if self.all_elements == False:
-            has_element = compositions.apply(self._contains_element)
-            df_trans = has_element.to_frame(name=self.new_column_name)
+            df_trans = self._contains_element(compositions).to_frame(name=self.new_column_name)
         elif self.all_elements == True:
             df_trans = self._contains_all_elements(compositions=compositions)
         return df_trans
 
-    def _contains_element(self, comp):
+    def _contains_element(self, compositions):
         """
-        Returns 1 if comp contains that element, and 0 if not.
+        Returns 1 for each composition containing that element, and 0 if not.
         Uses ints because sklearn and numpy like number classes better than bools. Could even be
         something crazy like "contains {element}" and "does not contain {element}" if you really
         wanted.
         """
-        comp = pymatgen.Composition(comp)
-        count = comp[self.element]
-        return int(count != 0)
+        from pymatgen import Element
+        _, inverse, element_indices, _ = parse_compositions(compositions)
+        has_element = (element_indices == Element(str(self.element)).Z - 1).any(axis=1)
+        return pd.Series(has_element.astype(int)[inverse], index=compositions.index)
 
     def _contains_all_elements(self, compositions):
-        elements = list()
-        df_trans = pd.DataFrame()
-        for comp in compositions.values:
-            comp = pymatgen.Composition(comp)
-            for element in comp.elements:
-                if element not in elements:
-                    elements.append(element)
-        for element in elements:
-            self.element = element
-            self.new_column_name = "has_"+str(self.element)
-            has_element = compositions.apply(self._contains_element)
-            df_trans[self.new_column_name] = has_element
-        return df_trans
+        from pymatgen import Element
+        _, inverse, element_indices, _ = parse_compositions(compositions)
+        # columns in the order the elements first show up in the data
+        elements = pd.unique(element_indices[element_indices >= 0])
+        has_element = np.zeros((element_indices.shape[0], len(elements)), dtype=int)
+        for j, element_index in enumerate(elements):
+            has_element[:, j] = (element_indices == element_index).any(axis=1)
+        column_names = ["has_"+Element.from_Z(element_index+1).symbol for element_index in elements]
+        return pd.DataFrame(has_element[inverse], columns=column_names, index=compositions.index)
 
 class Magpie(BaseEstimator, TransformerMixin):
     " Wraps MagpieFeatureGeneration "
@@ -115,9 +118,12 @@ class Magpie(BaseEstimator, TransformerMixin):
 
 class MaterialsProject(BaseEstimator, TransformerMixin):
     " Wraps MaterialsProjectFeatureGeneration "
-    def __init__(self, composition_feature, api_key):
+    def __init__(self, composition_feature, api_key, max_concurrent_requests=8, max_retries=3, endpoint=None):
         self.composition_feature = composition_feature
         self.api_key = api_key
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        self.endpoint = endpoint
 
     def fit(self, df, y=None):
         self.original_features = df.columns
@@ -125,7 +131,9 @@ class MaterialsProject(BaseEstimator, TransformerMixin):
 
     def transform(self, df):
         # make materials project api call (uses internet)
-        mpg = MaterialsProjectFeatureGeneration(df.copy(), self.api_key, self.composition_feature)
+        mpg = MaterialsProjectFeatureGeneration(df.copy(), self.api_key, self.composition_feature,
+                                                max_concurrent_requests=self.max_concurrent_requests,
+                                                max_retries=self.max_retries, endpoint=self.endpoint)
         df = mpg.generate_materialsproject_features()
 
         df = df.drop(self.original_features, axis=1)
@@ -136,9 +144,12 @@ class MaterialsProject(BaseEstimator, TransformerMixin):
 
 class Citrine(BaseEstimator, TransformerMixin):
     " Wraps CitrineFeatureGeneration "
-    def __init__(self, composition_feature, api_key):
+    def __init__(self, composition_feature, api_key, max_concurrent_requests=8, cache_size=1024, cache_dir=None):
         self.composition_feature = composition_feature
         self.api_key = api_key
+        self.max_concurrent_requests = max_concurrent_requests
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
 
     def fit(self, df, y=None):
         self.original_features = df.columns
@@ -146,7 +157,9 @@ class Citrine(BaseEstimator, TransformerMixin):
 
     def transform(self, df):
         # make citrine api call (uses internet)
-        cfg = CitrineFeatureGeneration(df.copy(), self.api_key, self.composition_feature)
+        cfg = CitrineFeatureGeneration(df.copy(), self.api_key, self.composition_feature,
+                                       max_concurrent_requests=self.max_concurrent_requests,
+                                       cache_size=self.cache_size, cache_dir=self.cache_dir)
         df = cfg.generate_citrine_features()
 
         df = df.drop(self.original_features, axis=1)
@@ -193,6 +206,94 @@ def clean_dataframe(df):
         log.warning(f'Dropping {lost_count}/{before_count} generated columns due to missing values')
     return df
 
+def parse_compositions(compositions):
+    """
+    Parses each distinct composition string once, returning
+    (unique_compositions, inverse, element_indices, fractions), where unique_compositions[inverse]
+    gives back the input and row i of element_indices/fractions holds Z-1 and the atomic fraction of
+    each element of unique_compositions[i] (in pymatgen's order), padded with -1 and 0.
+    Parsed strings are remembered for the rest of the run, so every generator shares the work.
+    """
+    from pymatgen import Element, Composition
+    inverse, unique_compositions = pd.factorize(pd.Series(compositions).astype(str))
+    parsed = list()
+    for composition in unique_compositions:
+        if composition not in _parsed_compositions:
+            amounts = Composition(composition).get_el_amt_dict()
+            atoms_per_formula_unit = sum(amounts.values())
+            _parsed_compositions[composition] = [(Element(element).Z - 1, amount / atoms_per_formula_unit)
+                                                 for element, amount in amounts.items()]
+        parsed.append(_parsed_compositions[composition])
+
+    max_n_elements = max([len(elements) for elements in parsed] + [1])
+    element_indices = np.full((len(parsed), max_n_elements), -1, dtype=int)
+    fractions = np.zeros((len(parsed), max_n_elements))
+    for i, elements in enumerate(parsed):
+        for site, (index, fraction) in enumerate(elements):
+            element_indices[i, site] = index
+            fractions[i, site] = fraction
+    return list(unique_compositions), inverse, element_indices, fractions
+
+def load_magpie_table(data_path=MAGPIE_DATA_PATH):
+    """
+    Returns (property_names, table), where table[Z-1, j] is the value of property_names[j] for the
+    element with atomic number Z, and NaN wherever magpie has no (or non-numeric) data.
+    The .table files are only parsed the first time; the resulting matrix is saved next to them as
+    a .npz, which is reused until one of the .table files is changed.
+    """
+    if data_path in _magpie_tables:
+        return _magpie_tables[data_path]
+
+    table_files = sorted(f for f in os.listdir(data_path) if f.endswith('.table'))
+    cache_path = os.path.join(data_path, MAGPIE_CACHE_NAME)
+    newest_table = max(os.path.getmtime(os.path.join(data_path, f)) for f in table_files)
+
+    table = None
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= newest_table:
+        try:
+            with np.load(cache_path) as cached:
+                property_names, table = list(cached['property_names']), cached['table']
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            log.debug(f'Ignoring unreadable magpie cache {cache_path} ({e}), reparsing the tables')
+    if table is None:
+        property_names = list()
+        columns = list()
+        for f in table_files:
+            property_name = f[:-len('.table')]
+            # OxidationStates holds a list of states per element, not a single number
+            if property_name == 'OxidationStates':
+                continue
+            with open(os.path.join(data_path, f)) as table_file:
+                columns.append([_parse_magpie_value(line) for line in table_file])
+            property_names.append(property_name)
+        # the tables don't all cover the same number of elements, pad the short ones with NaN
+        table = np.full((max(len(column) for column in columns), len(columns)), np.nan)
+        for j, column in enumerate(columns):
+            table[:len(column), j] = column
+        # written through a temporary file (one per process, since runs can start together) so
+        # readers never see half of it
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, property_names=np.array(property_names), table=table)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            log.debug(f'Could not write magpie cache to {cache_path}, it will be rebuilt next run')
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    _magpie_tables[data_path] = (property_names, table)
+    return property_names, table
+
+def _parse_magpie_value(line):
+    " Turns one line of a magpie .table file into a float, NaN for 'Missing', 'NA' and the like "
+    if "Missing" in line or "NA" in line:
+        return np.nan
+    try:
+        return float(line.strip())
+    except ValueError:
+        return np.nan
+
 class MagpieFeatureGeneration(object):
 
     def __init__(self, dataframe, composition_feature):
@@ -223,157 +324,75 @@ class MagpieFeatureGeneration(object):
         # Add the column of combined material compositions into the dataframe
         self.dataframe[self.composition_feature] = compositions
 
-        # Assign each magpiedata feature set to appropriate composition name
-        magpiedata_dict_composition_average = {}
-        magpiedata_dict_arithmetic_average = {}
-        magpiedata_dict_max = {}
-        magpiedata_dict_min = {}
-        magpiedata_dict_difference = {}
-        magpiedata_dict_atomic_bysite = {}
-        for composition in compositions:
-            magpiedata_composition_average, magpiedata_arithmetic_average, magpiedata_max, magpiedata_min, magpiedata_difference = self._get_computed_magpie_features(composition=composition, data_path=MAGPIE_DATA_PATH)
-            magpiedata_atomic_notparsed = self._get_atomic_magpie_features(composition=composition, data_path=MAGPIE_DATA_PATH)
-
-            magpiedata_dict_composition_average[composition] = magpiedata_composition_average
-            magpiedata_dict_arithmetic_average[composition] = magpiedata_arithmetic_average
-            magpiedata_dict_max[composition] = magpiedata_max
-            magpiedata_dict_min[composition] = magpiedata_min
-            magpiedata_dict_difference[composition] = magpiedata_difference
-
-            # Add site-specific elemental features
-            count = 1
-            magpiedata_atomic_bysite = {}
-            for entry in magpiedata_atomic_notparsed:
-                for magpiefeature, featurevalue in magpiedata_atomic_notparsed[entry].items():
-                    magpiedata_atomic_bysite["Site"+str(count)+"_"+str(magpiefeature)] = featurevalue
-                count += 1
-
-            magpiedata_dict_atomic_bysite[composition] = magpiedata_atomic_bysite
-
-        magpiedata_dict_list = [magpiedata_dict_composition_average, magpiedata_dict_arithmetic_average,
-                                magpiedata_dict_max, magpiedata_dict_min, magpiedata_dict_difference, magpiedata_dict_atomic_bysite]
+        # Featurize each distinct composition once, as a batch, then line them back up with the rows
+        _, inverse, element_indices, fractions = parse_compositions(compositions)
+        property_names, table = load_magpie_table(MAGPIE_DATA_PATH)
 
-        dataframe = self.dataframe
-        for magpiedata_dict in magpiedata_dict_list:
-            dataframe_magpie = pd.DataFrame.from_dict(data=magpiedata_dict, orient='index')
-            # Need to reorder compositions in new dataframe to match input dataframe
-            dataframe_magpie = dataframe_magpie.reindex(self.dataframe[self.composition_feature].tolist())
-            # Need to make compositions the first column, instead of the row names
-            dataframe_magpie.index.name = self.composition_feature
-            dataframe_magpie.reset_index(inplace=True)
-            # Need to delete duplicate column before merging dataframes
-            del dataframe_magpie[self.composition_feature]
-            # Merge magpie feature dataframe with originally supplied dataframe
-            dataframe = DataframeUtilities().merge_dataframe_columns(dataframe1=dataframe, dataframe2=dataframe_magpie)
+        feature_blocks = list(self._get_computed_magpie_features(element_indices, fractions, table))
+        feature_blocks.append(self._get_atomic_magpie_features(element_indices, table))
+        feature_names = [name+suffix for suffix in ['_composition_average', '_arithmetic_average',
+                                                    '_max_value', '_min_value', '_difference']
+                         for name in property_names]
+        feature_names += ["Site"+str(site+1)+"_"+name for site in range(element_indices.shape[1])
+                          for name in property_names]
+
+        # Need to reorder compositions in new dataframe to match input dataframe
+        dataframe_magpie = pd.DataFrame(np.hstack(feature_blocks)[inverse], columns=feature_names)
+        # Merge magpie feature dataframe with originally supplied dataframe
+        dataframe = DataframeUtilities().merge_dataframe_columns(dataframe1=self.dataframe, dataframe2=dataframe_magpie)
 
         return dataframe
 
-    def _get_computed_magpie_features(self, composition, data_path):
-        magpiedata_composition_average = {}
-        magpiedata_arithmetic_average = {}
-        magpiedata_max = {}
-        magpiedata_min = {}
-        magpiedata_difference = {}
-        magpiedata_atomic = self._get_atomic_magpie_features(composition=composition, data_path=data_path)
-        composition = Composition(composition)
-        element_list, atoms_per_formula_unit = self._get_element_list(composition=composition)
-
-        # Initialize feature values to all be 0, because need to dynamically update them with weighted values in next loop.
-        for magpie_feature in magpiedata_atomic[element_list[0]]:
-            magpiedata_composition_average[magpie_feature] = 0
-            magpiedata_arithmetic_average[magpie_feature] = 0
-            magpiedata_max[magpie_feature] = 0
-            magpiedata_min[magpie_feature] = 0
-            magpiedata_difference[magpie_feature] = 0
-
-        for element in magpiedata_atomic:
-            for magpie_feature, feature_value in magpiedata_atomic[element].items():
-                if feature_value is not 'NaN':
-                    # Composition average features
-                    magpiedata_composition_average[magpie_feature] += feature_value*float(composition[element])/atoms_per_formula_unit
-                    # Arithmetic average features
-                    magpiedata_arithmetic_average[magpie_feature] += feature_value/len(element_list)
-                    # Max features
-                    if magpiedata_max[magpie_feature] > 0:
-                        if feature_value > magpiedata_max[magpie_feature]:
-                            magpiedata_max[magpie_feature] = feature_value
-                    elif magpiedata_max[magpie_feature] == 0:
-                        magpiedata_max[magpie_feature] = feature_value
-                    # Min features
-                    if magpiedata_min[magpie_feature] > 0:
-                        if feature_value < magpiedata_min[magpie_feature]:
-                            magpiedata_min[magpie_feature] = feature_value
-                    elif magpiedata_min[magpie_feature] == 0:
-                        magpiedata_min[magpie_feature] = feature_value
-                    # Difference features (max - min)
-                    magpiedata_difference[magpie_feature] = magpiedata_max[magpie_feature] - magpiedata_min[magpie_feature]
-
-        # Change names of features to reflect each computed type of magpie feature (max, min, etc.)
-        magpiedata_composition_average_renamed = {}
-        magpiedata_arithmetic_average_renamed = {}
-        magpiedata_max_renamed = {}
-        magpiedata_min_renamed = {}
-        magpiedata_difference_renamed = {}
-        for key in magpiedata_composition_average:
-            magpiedata_composition_average_renamed[key+"_composition_average"] = magpiedata_composition_average[key]
-        for key in magpiedata_arithmetic_average:
-            magpiedata_arithmetic_average_renamed[key+"_arithmetic_average"] = magpiedata_arithmetic_average[key]
-        for key in magpiedata_max:
-            magpiedata_max_renamed[key+"_max_value"] = magpiedata_max[key]
-        for key in magpiedata_min:
-            magpiedata_min_renamed[key+"_min_value"] = magpiedata_min[key]
-        for key in magpiedata_difference:
-            magpiedata_difference_renamed[key+"_difference"] = magpiedata_difference[key]
-
-        return magpiedata_composition_average_renamed, magpiedata_arithmetic_average_renamed, magpiedata_max_renamed, magpiedata_min_renamed, magpiedata_difference_renamed
-
-    def _get_atomic_magpie_features(self, composition, data_path):
-        # Get .table files containing feature values for each element, assign file names as feature names
-        magpie_feature_names = []
-        for f in os.listdir(data_path):
-            if '.table' in f:
-                magpie_feature_names.append(f[:-6])
-
-        composition = Composition(composition)
-        element_list, atoms_per_formula_unit = self._get_element_list(composition=composition)
-
-        element_dict = {}
-        for element in element_list:
-            element_dict[element] = Element(element).Z
-
-        magpiedata_atomic = {}
-        for k, v in element_dict.items():
-            atomic_values = {}
-            for feature_name in magpie_feature_names:
-                f = open(data_path + '/' + feature_name + '.table', 'r')
-                # Get Magpie data of relevant atomic numbers for this composition
-                for line, feature_value in enumerate(f.readlines()):
-                    if line + 1 == v:
-                        if "Missing" not in feature_value and "NA" not in feature_value:
-                            if feature_name != "OxidationStates":
-                                atomic_values[feature_name] = float(feature_value.strip())
-                        if "Missing" in feature_value:
-                            atomic_values[feature_name] = 'NaN'
-                        if "NA" in feature_value:
-                            atomic_values[feature_name] = 'NaN'
-                f.close()
-            magpiedata_atomic[k] = atomic_values
-
-        return magpiedata_atomic
-
-    def _get_element_list(self, composition):
-        element_amounts = composition.get_el_amt_dict()
-        atoms_per_formula_unit = 0
-        for v in element_amounts.values():
-            atoms_per_formula_unit += v
-
-        # Get list of unique elements present
-        element_list = []
-        for k in element_amounts:
-            if k not in element_list:
-                element_list.append(k)
-
-        return element_list, atoms_per_formula_unit
+    def _get_computed_magpie_features(self, element_indices, fractions, table):
+        """
+        Returns the composition average, arithmetic average, max, min and difference (max - min)
+        of every magpie property, each as an (n_compositions, n_properties) array.
+        Elements with no data for a property are left out of that property's statistics.
+        """
+        n_compositions = element_indices.shape[0]
+        present = element_indices >= 0
+        rows = np.repeat(np.arange(n_compositions), present.sum(axis=1))
+
+        # composition x element matrices, so both averages are a single matrix product
+        fraction_matrix = np.zeros((n_compositions, table.shape[0]))
+        fraction_matrix[rows, element_indices[present]] = fractions[present]
+        count_matrix = np.zeros((n_compositions, table.shape[0]))
+        count_matrix[rows, element_indices[present]] = 1
+        table_no_nan = np.nan_to_num(table)
+        n_elements = present.sum(axis=1).reshape(-1, 1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            composition_average = fraction_matrix @ table_no_nan
+            arithmetic_average = (count_matrix @ table_no_nan) / n_elements
+
+        site_values = self._get_site_values(element_indices, table)
+        # fmax/fmin skip NaN and only give NaN back when every element is missing the property
+        max_value = np.fmax.reduce(site_values, axis=1)
+        min_value = np.fmin.reduce(site_values, axis=1)
+        max_value[np.isnan(max_value)] = 0
+        min_value[np.isnan(min_value)] = 0
+        difference = max_value - min_value
+
+        # an empty composition has no features at all
+        empty = n_elements.reshape(-1) == 0
+        for block in [composition_average, arithmetic_average, max_value, min_value, difference]:
+            block[empty] = np.nan
+
+        return composition_average, arithmetic_average, max_value, min_value, difference
+
+    def _get_atomic_magpie_features(self, element_indices, table):
+        """
+        Returns the raw magpie properties of each element in each composition, flattened so the
+        columns are all properties of site 1, then all properties of site 2, etc.
+        """
+        site_values = self._get_site_values(element_indices, table)
+        return site_values.reshape(site_values.shape[0], -1)
+
+    def _get_site_values(self, element_indices, table):
+        " (n_compositions, n_sites, n_properties) array of properties, NaN for unused sites "
+        table_with_blank = np.vstack([table, np.full((1, table.shape[1]), np.nan)])
+        # -1 (no element on this site) picks out the trailing row of NaNs
+        return table_with_blank[element_indices]
 
 class MaterialsProjectFeatureGeneration(object):
     """
@@ -384,6 +403,11 @@ class MaterialsProjectFeatureGeneration(object):
         configdict (dict) : MASTML configfile object as dict
         dataframe (pandas dataframe) : dataframe containing x and y data and feature names
         mapi_key (str) : your Materials Project API key
+        composition_feature (str) : name of the column holding the material compositions
+        max_concurrent_requests (int) : how many queries may be in flight at once
+        max_retries (int) : how many times a failed query is retried, waiting twice as long each time
+        endpoint (str) : url of the Materials Project REST api, or of a local stand-in for testing
+        mprester (MPRester) : client to use instead of making one from mapi_key and endpoint
 
     Methods:
         generate_materialsproject_features : generates materials project feature set based on compositions in dataframe
@@ -394,10 +418,18 @@ class MaterialsProjectFeatureGeneration(object):
             Returns:
                 pandas dataframe : dataframe containing magpie feature set
     """
-    def __init__(self, dataframe, mapi_key, composition_feature):
+    def __init__(self, dataframe, mapi_key, composition_feature, max_concurrent_requests=8, max_retries=3,
+                 endpoint=None, mprester=None):
         self.dataframe = dataframe
         self.mapi_key = mapi_key
         self.composition_feature = composition_feature
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        # one client (and so one http session) shared by every request
+        if mprester is None:
+            from pymatgen.ext.matproj import MPRester
+            mprester = MPRester(self.mapi_key, endpoint=endpoint) if endpoint else MPRester(self.mapi_key)
+        self.mprester = mprester
 
     def generate_materialsproject_features(self):
         try:
@@ -405,18 +437,11 @@ class MaterialsProjectFeatureGeneration(object):
         except KeyError as e:
             raise utils.MissingColumnError(f'No column named {self.composition_feature} in csv file')
 
-        mpdata_dict_composition = {}
-
-        # before: 11 hits for a total of ~6 seconds
-        #for composition in compositions:
-        #    composition_data_mp = self._get_data_from_materials_project(composition=composition)
-        #    mpdata_dict_composition[composition] = composition_data_mp
-        # after: 2.5 seconds!!!
-        pool = multiprocessing.Pool(processes=20)
-        #comp_data_mp = pool.map(self._get_data_from_materials_project, compositions)
-        comp_data_mp = map(self._get_data_from_materials_project, compositions)
-
-        mpdata_dict_composition.update(dict(zip(compositions, comp_data_mp)))
+        # Each distinct formula is only asked for once, with several requests in flight at a time
+        unique_compositions = list(pd.unique(compositions))
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            comp_data_mp = executor.map(self._get_data_from_materials_project, unique_compositions)
+            mpdata_dict_composition = dict(zip(unique_compositions, comp_data_mp))
 
         dataframe = self.dataframe
         dataframe_mp = pd.DataFrame.from_dict(data=mpdata_dict_composition, orient='index')
@@ -432,9 +457,21 @@ class MaterialsProjectFeatureGeneration(object):
 
         return dataframe
 
+    def _query_materials_project(self, composition):
+        " Calls the api, retrying with exponential backoff when it errors "
+        from pymatgen.ext.matproj import MPRestError
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.mprester.get_data(chemsys_formula_id=composition)
+            except MPRestError as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = 2 ** attempt
+                log.warning(f'Materials Project query for "{composition}" failed ({e}), retrying in {wait}s')
+                time.sleep(wait)
+
     def _get_data_from_materials_project(self, composition):
-        mprester = MPRester(self.mapi_key)
-        structure_data_list = mprester.get_data(chemsys_formula_id=composition)
+        structure_data_list = self._query_materials_project(composition)
 
         # Sort structures by stability (i.e. E above hull), and only return most stable compound data
         if len(structure_data_list) > 0:
@@ -490,6 +527,12 @@ class CitrineFeatureGeneration(object):
         configdict (dict) : MASTML configfile object as dict
         dataframe (pandas dataframe) : dataframe containing x and y data and feature names
         api_key (str) : your Citrination API key
+        composition_feature (str) : name of the column holding the material compositions
+        max_concurrent_requests (int) : how many searches may be in flight at once
+        cache_size (int) : how many compositions' results are remembered, in memory and in cache_dir
+        cache_dir (str) : directory to also keep results in between runs, None to only use memory. Entries are
+            keyed by api_key, so it's ignored for a client given without one
+        client (CitrinationClient) : client to use instead of making one from api_key
 
     Methods:
         generate_citrine_features : generates Citrine feature set based on compositions in dataframe
@@ -500,11 +543,25 @@ class CitrineFeatureGeneration(object):
             Returns:
                 pandas dataframe : dataframe containing magpie feature set
     """
-    def __init__(self, dataframe, api_key, composition_feature):
+    def __init__(self, dataframe, api_key, composition_feature, max_concurrent_requests=8, cache_size=1024,
+                 cache_dir=None, client=None):
         self.dataframe = dataframe
         self.api_key = api_key
-        self.client = CitrinationClient(api_key, 'https://citrination.com')
+        # the shared in-memory cache is keyed by who asked too, so a client never gets another's
+        # results: the api key when the client is made from it, otherwise the given client itself
+        self._cache_owner = api_key if client is None else client
+        if client is None:
+            from citrination_client import CitrinationClient
+            client = CitrinationClient(api_key, 'https://citrination.com')
+        self.client = client
         self.composition_feature = composition_feature
+        self.max_concurrent_requests = max_concurrent_requests
+        self.cache_size = cache_size
+        # a client object can't be recognized again in a later run, so only api keys get disk entries
+        if cache_dir is not None and api_key is None:
+            log.warning('Not using the citrine cache_dir, since no api_key identifies whose results they are')
+            cache_dir = None
+        self.cache_dir = cache_dir
 
     def generate_citrine_features(self):
         log.warning('WARNING: You have specified generation of features from Citrine. Based on which'
@@ -516,55 +573,112 @@ class CitrineFeatureGeneration(object):
             log.error(f'original python error: {str(e)}')
             raise utils.MissingColumnError('Error! No column named {self.composition_feature} found in your input data file. '
                     'To use this feature generation routine, you must supply a material composition for each data point')
-        citrine_dict_property_min = dict()
-        citrine_dict_property_max = dict()
-        citrine_dict_property_avg = dict()
-
-        # before: ~11 seconds
-        # made into a func so we can do requests in parallel
-
-        # now like 1.8 secs!
-        pool = multiprocessing.Pool(processes=20)
-        #result_tuples = pool.map(self._load_composition, compositions)
-        result_tuples = map(self._load_composition, compositions)
 
-        for comp, (prop_min, prop_max, prop_avg) in zip(compositions, result_tuples):
-            citrine_dict_property_min[comp] = prop_min
-            citrine_dict_property_max[comp] = prop_max
-            citrine_dict_property_avg[comp] = prop_avg
+        # One search per distinct composition, several in flight at a time
+        unique_compositions = list(pd.unique(compositions))
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            property_lists = list(executor.map(self._load_composition, unique_compositions))
+        if self.cache_dir is not None:
+            self._trim_disk_cache()
+
+        # Long table of every (composition, property, value) found, so all the min/max/avg come
+        # out of one groupby
+        properties = pd.DataFrame({
+            'composition': [comp for comp, (names, _) in zip(unique_compositions, property_lists) for _ in names],
+            'name': [name for names, _ in property_lists for name in names],
+            'value': [value for _, values in property_lists for value in values]},
+            columns=['composition', 'name', 'value'])
+        aggregated = properties.groupby(['composition', 'name'], sort=False)['value'].agg(['min', 'max', 'mean'])
 
         dataframe = self.dataframe
-        citrine_dict_list = [citrine_dict_property_min, citrine_dict_property_max, citrine_dict_property_avg]
-        for citrine_dict in citrine_dict_list:
-            dataframe_citrine = pd.DataFrame.from_dict(data=citrine_dict, orient='index')
+        for statistic, suffix in [('min', '_min'), ('max', '_max'), ('mean', '_avg')]:
+            dataframe_citrine = aggregated[statistic].unstack('name')
+            dataframe_citrine.columns = [str(name)+suffix for name in dataframe_citrine.columns]
             # Need to reorder compositions in new dataframe to match input dataframe
-            dataframe_citrine = dataframe_citrine.reindex(self.dataframe[self.composition_feature].tolist())
-            # Need to make compositions the first column, instead of the row names
-            dataframe_citrine.index.name = self.composition_feature
-            dataframe_citrine.reset_index(inplace=True)
-            # Need to delete duplicate column before merging dataframes
-            del dataframe_citrine[self.composition_feature]
+            dataframe_citrine = dataframe_citrine.reindex(compositions).reset_index(drop=True)
             # Merge magpie feature dataframe with originally supplied dataframe
             dataframe = DataframeUtilities().merge_dataframe_columns(dataframe1=dataframe, dataframe2=dataframe_citrine)
 
         return dataframe
 
     def _load_composition(self, composition):
+        " Returns the (property names, property values) citrine has for composition, from cache if possible "
+        cached = self._get_cached_properties(composition)
+        if cached is not None:
+            return cached
         pifquery = self._get_pifquery(composition=composition)
-        property_name_list, property_value_list = self._get_pifquery_property_list(pifquery=pifquery)
-        #print("Citrine Feature Generation: ", composition, property_name_list, property_value_list)
-        property_names_unique, parsed_property_min, parsed_property_max, parsed_property_avg = self._parse_pifquery_property_list(property_name_list=property_name_list, property_value_list=property_value_list)
-        return parsed_property_min, parsed_property_max, parsed_property_avg
+        property_lists = self._get_pifquery_property_list(pifquery=pifquery)
+        self._cache_properties(composition, property_lists)
+        return property_lists
+
+    def _get_cached_properties(self, composition):
+        key = (self._cache_owner, composition)
+        with _citrine_cache_lock:
+            if key in _citrine_cache:
+                _citrine_cache.move_to_end(key)
+                return _citrine_cache[key]
+        if self.cache_dir is not None:
+            path = self._cache_path(composition)
+            try:
+                with open(path) as f:
+                    property_lists = tuple(json.load(f))
+                os.utime(path) # mark as recently used
+            except FileNotFoundError: # not cached, or just evicted by another run
+                return None
+            except ValueError as e:
+                log.warning(f'Ignoring unreadable citrine cache entry {path}: {e}')
+                return None
+            self._cache_properties(composition, property_lists, write_to_disk=False)
+            return property_lists
+        return None
+
+    def _cache_properties(self, composition, property_lists, write_to_disk=True):
+        with _citrine_cache_lock:
+            _citrine_cache[(self._cache_owner, composition)] = property_lists
+            while len(_citrine_cache) > self.cache_size:
+                _citrine_cache.popitem(last=False)
+        if self.cache_dir is not None and write_to_disk:
+            # each thread writes its own temporary file, so readers never see half of an entry
+            path = self._cache_path(composition)
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(property_lists, f)
+            os.replace(temp_path, path)
+
+    def _trim_disk_cache(self):
+        " Keeps only the cache_size most recently used compositions in cache_dir, once per batch "
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except FileNotFoundError: # removed by another run in the meantime
+                continue
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.cache_size, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _cache_path(self, composition):
+        key = f'{self.api_key}\n{composition}'
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
 
     def _get_pifquery(self, composition):
         # TODO: does this stop csv generation on first invalid composition?
         # TODO: Is there a way to send many compositions in one call to citrine?
+        from citrination_client import PifQuery, SystemQuery, ChemicalFieldQuery, ChemicalFilter
         pif_query = PifQuery(system=SystemQuery(chemical_formula=ChemicalFieldQuery(filter=ChemicalFilter(equal=composition))))
+        result = self.client.search(pif_query).as_dictionary()
         # Check if any results found
-        if 'hits' not in self.client.search(pif_query).as_dictionary():
+        if 'hits' not in result:
             raise KeyError('No results found!')
-        pifquery = self.client.search(pif_query).as_dictionary()['hits']
-        return pifquery
+        return result['hits']
 
     def _get_pifquery_property_list(self, pifquery):
         property_name_list = list()
@@ -575,70 +689,20 @@ class CitrineFeatureGeneration(object):
             "Poisson's", 'Elastic', 'Energy'
         ]
 
-        for result_number, results in enumerate(pifquery):
-            for i, dictionary in enumerate(results['system']['properties']):
+        for results in pifquery:
+            for dictionary in results['system']['properties']:
                 if 'name' not in dictionary or dictionary['name'] == "CIF File": continue
                 value = dictionary['name']
-                for entry in accepted_properties_list:
-                    if entry not in value: continue
-                    property_name_list.append(value)
-                    try:
-                        property_value_list.append(
-                            float(dictionary['scalars'][0]['value']))
-                    except (ValueError, KeyError):
-                        property_name_list.pop(-1)
-                        continue
-
-        #for result_number, results in enumerate(pifquery):
-        #    property_value = results['system']['properties']
-        #    for list_index, list_element in enumerate(property_value):
-        #        for name, value in property_value[list_index].items():
-        #            if name == 'name' and value != "CIF File":
-        #                for entry in accepted_properties_list:
-        #                    if entry in value:
-        #                        property_name_list.append(value)
-        #                        try:
-        #                            property_value_list.append(
-        #                                float(property_value[list_index]['scalars'][0]['value']))
-        #                        except (ValueError, KeyError):
-        #                            # print('found something to remove', property_value[list_index]['scalars'][0]['value'])
-        #                            property_name_list.pop(-1)
-        #                            continue
+                if not any(entry in value for entry in accepted_properties_list): continue
+                try:
+                    property_value = float(dictionary['scalars'][0]['value'])
+                except (ValueError, KeyError):
+                    continue
+                property_name_list.append(value)
+                property_value_list.append(property_value)
 
         return property_name_list, property_value_list
 
-    def _parse_pifquery_property_list(self, property_name_list, property_value_list):
-        parsed_property_max = dict()
-        parsed_property_min = dict()
-        parsed_property_avg = dict()
-        property_names_unique = list()
-        if len(property_name_list) != len(property_value_list):
-            print('Error! Length of property name and property value lists are not the same. There must be a bug in the _get_pifquerey_property_list method')
-            raise IndexError("property_name_list and property_value_list are not the same size.")
-        else:
-            # Get unique property names
-            for name in property_name_list:
-                if name not in property_names_unique:
-                    property_names_unique.append(name)
-            for unique_name in property_names_unique:
-                unique_property = list()
-                unique_property_avg = 0
-                count = 0
-                for i, name in enumerate(property_name_list):
-                    # Only include property values whose name are same as those in unique_name list
-                    if name == unique_name:
-                        count += 1 # count how many instances of the same property occur
-                        unique_property_avg += property_value_list[i]
-                        unique_property.append(property_value_list[i])
-                unique_property_min = min(entry for entry in unique_property)
-                unique_property_max = max(entry for entry in unique_property)
-                unique_property_avg = unique_property_avg/count
-                parsed_property_min[str(unique_name)+"_min"] = unique_property_min
-                parsed_property_max[str(unique_name) + "_max"] = unique_property_max
-                parsed_property_avg[str(unique_name) + "_avg"] = unique_property_avg
-
-        return property_names_unique, parsed_property_min, parsed_property_max, parsed_property_avg
-
 class DataframeUtilities(object):
     """
     Class of basic utilities for dataframe manipulation, and exchanging between dataframes and numpy arrays
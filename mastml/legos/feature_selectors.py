@@ -5,18 +5,23 @@ All classes here assume dataframe input and guarantee dataframe output.
 """
 
 from functools import wraps
+import inspect
 import warnings
+import logging
 import numpy as np
 from mastml.metrics import root_mean_squared_error
 
 import pandas as pd
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
 from sklearn.decomposition import PCA
+from sklearn.linear_model import LinearRegression, Ridge
 import sklearn.feature_selection as fs
-from mlxtend.feature_selection import SequentialFeatureSelector
 
 from . import util_legos
 
+log = logging.getLogger('mastml')
+
 # list of sklearn feature selectors:
 # http://scikit-learn.org/stable/modules/classes.html#module-sklearn.feature_selection
 
@@ -83,31 +88,64 @@ class PassThrough(BaseEstimator, TransformerMixin):
         return df[self.features]
 
 class MASTMLFeatureSelector(object):
-    """ Custom-written forward selection class to perform feature selection with flexible model and cv scheme"""
-    def __init__(self, estimator, n_features_to_select, cv):
+    """
+    Custom-written forward selection class to perform feature selection with flexible model and cv scheme
+
+    Each round adds whichever remaining feature gives the lowest average cv RMSE together with the
+    features already chosen. Candidates are scored in n_jobs processes. If patience is set, selection
+    stops once that many rounds in a row failed to lower the best RMSE so far by more than tol, and
+    the features added in those rounds are dropped again, though the first feature is always kept.
+    """
+    def __init__(self, estimator, n_features_to_select, cv, n_jobs=1, patience=None, tol=0.0):
         self.estimator = estimator
         self.n_features_to_select = n_features_to_select
         self.cv = cv
+        self.n_jobs = n_jobs
+        self.patience = patience
+        self.tol = tol
 
     def fit(self, X, y, Xgroups=None):
         self.selected_feature_names = list()
-        selected_feature_avg_rmses = list()
-        selected_feature_std_rmses = list()
+        self.selected_feature_avg_rmses = list()
+        self.selected_feature_std_rmses = list()
         basic_forward_selection_dict = dict()
         num_features_selected = 0
         x_features = X.columns.tolist()
         if self.n_features_to_select >= len(x_features):
             self.n_features_to_select = len(x_features)
+        if self.n_features_to_select < 1:
+            raise ValueError(f'MASTMLFeatureSelector needs n_features_to_select of at least 1, '
+                             f'not {self.n_features_to_select}')
+
+        X_values = np.asarray(X.values, dtype=float)
+        y = np.array(y).ravel()
+        if Xgroups is not None and np.size(Xgroups) > 0:
+            groups = np.array(Xgroups).reshape(-1, )
+        else:
+            groups = None
+        # Same folds for every candidate, so they are compared on equal footing
+        splits = list(self.cv.split(X_values, y, groups))
+        # Chosen columns go in here one per round, in the order they were picked
+        selected_array = np.empty((X_values.shape[0], self.n_features_to_select))
+        remaining = list(range(len(x_features)))
+        best_avg_rmse = np.inf
+        best_num_features = 0
+        rounds_without_improvement = 0
+
         while num_features_selected < self.n_features_to_select:
             # Catch pandas warnings here
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore')
-                ranked_features = self._rank_features(X=X, y=y, groups=Xgroups)
+                ranked_features = self._rank_features(X_values, y, splits, remaining, x_features,
+                                                      selected_array[:, :num_features_selected])
                 top_feature_name, top_feature_avg_rmse, top_feature_std_rmse = self._choose_top_feature(ranked_features=ranked_features)
 
+            top_feature_index = x_features.index(top_feature_name)
+            selected_array[:, num_features_selected] = X_values[:, top_feature_index]
+            remaining.remove(top_feature_index)
             self.selected_feature_names.append(top_feature_name)
-            selected_feature_avg_rmses.append(top_feature_avg_rmse)
-            selected_feature_std_rmses.append(top_feature_std_rmse)
+            self.selected_feature_avg_rmses.append(top_feature_avg_rmse)
+            self.selected_feature_std_rmses.append(top_feature_std_rmse)
 
             basic_forward_selection_dict[str(num_features_selected)] = dict()
             basic_forward_selection_dict[str(num_features_selected)][
@@ -119,12 +157,29 @@ class MASTMLFeatureSelector(object):
             basic_forward_selection_dict[str(num_features_selected)][
                 'Stdev RMSE using top features'] = top_feature_std_rmse
             num_features_selected += 1
-        basic_forward_selection_dict[str(self.n_features_to_select - 1)][
+
+            if top_feature_avg_rmse < best_avg_rmse - self.tol:
+                best_avg_rmse = top_feature_avg_rmse
+                best_num_features = num_features_selected
+                rounds_without_improvement = 0
+            else:
+                rounds_without_improvement += 1
+            if self.patience is not None and rounds_without_improvement >= self.patience:
+                # even if no feature ever improved (on a nan RMSE, or with an infinite tol), the best one is kept
+                num_features_selected = max(best_num_features, 1)
+                log.info(f'MASTMLFeatureSelector stopping early with {num_features_selected} features, '
+                         f'cv RMSE has not improved for {rounds_without_improvement} rounds')
+                del self.selected_feature_names[num_features_selected:]
+                del self.selected_feature_avg_rmses[num_features_selected:]
+                del self.selected_feature_std_rmses[num_features_selected:]
+                break
+
+        basic_forward_selection_dict[str(num_features_selected - 1)][
             'Full feature set Names'] = self.selected_feature_names
-        basic_forward_selection_dict[str(self.n_features_to_select - 1)][
-            'Full feature set Avg RMSEs'] = selected_feature_avg_rmses
-        basic_forward_selection_dict[str(self.n_features_to_select - 1)][
-            'Full feature set Stdev RMSEs'] = selected_feature_std_rmses
+        basic_forward_selection_dict[str(num_features_selected - 1)][
+            'Full feature set Avg RMSEs'] = self.selected_feature_avg_rmses
+        basic_forward_selection_dict[str(num_features_selected - 1)][
+            'Full feature set Stdev RMSEs'] = self.selected_feature_std_rmses
         #self._plot_featureselected_learningcurve(selected_feature_avg_rmses=selected_feature_avg_rmses,
         #                                         selected_feature_std_rmses=selected_feature_std_rmses)
         return self
@@ -133,54 +188,26 @@ class MASTMLFeatureSelector(object):
         dataframe = self._get_featureselected_dataframe(X=X, selected_feature_names=self.selected_feature_names)
         return dataframe
 
-    def _rank_features(self, X, y, groups):
-        y = np.array(y).reshape(-1, 1)
+    def _rank_features(self, X_values, y, splits, remaining, x_features, selected):
+        " Cv RMSE of the selected features plus each remaining one, as {name: {avg_rmse, std_rmse}} "
+        # one chunk of candidates per worker, so the selected columns are only sent once to each
+        n_workers = self.n_jobs if self.n_jobs > 0 else max(cpu_count() + 1 + self.n_jobs, 1)
+        chunks = [list(chunk) for chunk in np.array_split(remaining, min(n_workers, len(remaining)))]
+        scores = Parallel(n_jobs=self.n_jobs)(
+            delayed(_score_candidates)(self.estimator, selected, X_values[:, chunk], y, splits)
+            for chunk in chunks)
+
         ranked_features = dict()
-        trains_metrics = list()
-        tests_metrics = list()
-        if groups is not None:
-            groups = groups.iloc[:,0].tolist()
-        for col in X.columns:
-            if col not in self.selected_feature_names:
-                X_ = X.loc[:, self.selected_feature_names]
-                X_ = np.array(pd.concat([X_, X[col]],axis=1))
-                for trains, tests in self.cv.split(X_, y, groups):
-                    self.estimator.fit(X_[trains], y[trains])
-                    #predict_trains = self.estimator.predict(X_[trains])
-                    predict_tests = self.estimator.predict(X_[tests])
-                    #trains_metrics.append(root_mean_squared_error(y[trains], predict_trains))
-                    tests_metrics.append(root_mean_squared_error(y[tests], predict_tests))
-                avg_rmse = np.mean(tests_metrics)
-                std_rmse = np.std(tests_metrics)
-                ranked_features[col] = {"avg_rmse": avg_rmse, "std_rmse": std_rmse}
+        for chunk, (avg_rmses, std_rmses) in zip(chunks, scores):
+            for i, avg_rmse, std_rmse in zip(chunk, avg_rmses, std_rmses):
+                ranked_features[x_features[i]] = {"avg_rmse": avg_rmse, "std_rmse": std_rmse}
         return ranked_features
 
     def _choose_top_feature(self, ranked_features):
-        feature_names = list()
-        feature_avg_rmses = list()
-        feature_std_rmses = list()
-        feature_names_sorted = list()
-        feature_std_rmses_sorted = list()
-        # Make dict of ranked features into list for sorting
-        for k, v in ranked_features.items():
-            feature_names.append(k)
-            for kk, vv in v.items():
-                if kk == 'avg_rmse':
-                    feature_avg_rmses.append(vv)
-                if kk == 'std_rmse':
-                    feature_std_rmses.append(vv)
-
-        # Sort feature lists so RMSE goes from min to max
-        feature_avg_rmses_sorted = sorted(feature_avg_rmses)
-        for feature_avg_rmse in feature_avg_rmses_sorted:
-            for k, v in ranked_features.items():
-                if v['avg_rmse'] == feature_avg_rmse:
-                    feature_names_sorted.append(k)
-                    feature_std_rmses_sorted.append(v['std_rmse'])
-
-        top_feature_name = feature_names_sorted[0]
-        top_feature_avg_rmse = feature_avg_rmses_sorted[0]
-        top_feature_std_rmse = feature_std_rmses_sorted[0]
+        # Lowest average RMSE wins, ties go to whichever feature comes first
+        top_feature_name = min(ranked_features, key=lambda name: ranked_features[name]['avg_rmse'])
+        top_feature_avg_rmse = ranked_features[top_feature_name]['avg_rmse']
+        top_feature_std_rmse = ranked_features[top_feature_name]['std_rmse']
 
         return top_feature_name, top_feature_avg_rmse, top_feature_std_rmse
 
@@ -208,12 +235,98 @@ class MASTMLFeatureSelector(object):
         plt.savefig(savedir + "/" + "basic_forward_selection_learning_curve_featurenumber.png", dpi=250)
         return
 
+def _score_candidates(estimator, selected, candidates, y, splits):
+    """
+    Returns the average and stdev over splits of the test RMSE of estimator fit on selected plus
+    each column of candidates in turn.
+    """
+    alpha = _closed_form_alpha(estimator)
+    if alpha is not None:
+        return _score_candidates_linear(alpha, estimator.fit_intercept, selected, candidates, y, splits)
+
+    estimator = clone(estimator)
+    # one buffer for the whole chunk: the selected columns, then a slot for the candidate
+    X_ = np.empty((selected.shape[0], selected.shape[1] + 1))
+    X_[:, :-1] = selected
+    avg_rmses = np.empty(candidates.shape[1])
+    std_rmses = np.empty(candidates.shape[1])
+    for j in range(candidates.shape[1]):
+        X_[:, -1] = candidates[:, j]
+        tests_metrics = list()
+        for trains, tests in splits:
+            estimator.fit(X_[trains], y[trains])
+            predict_tests = estimator.predict(X_[tests])
+            tests_metrics.append(root_mean_squared_error(y[tests], predict_tests))
+        avg_rmses[j] = np.mean(tests_metrics)
+        std_rmses[j] = np.std(tests_metrics)
+    return avg_rmses, std_rmses
+
+def _closed_form_alpha(estimator):
+    """
+    The ridge penalty of estimator if it's a plain LinearRegression (alpha 0) or Ridge whose fit
+    _score_candidates_linear reproduces exactly, otherwise None.
+    """
+    if getattr(estimator, 'normalize', False) or getattr(estimator, 'positive', False):
+        return None
+    if type(estimator) is LinearRegression:
+        return 0.0
+    if type(estimator) is Ridge and np.isscalar(estimator.alpha):
+        return float(estimator.alpha)
+    return None
+
+def _score_candidates_linear(alpha, fit_intercept, selected, candidates, y, splits):
+    """
+    Same as _score_candidates for (ridge) least squares, without refitting for each candidate.
+    Per fold the normal equations of the selected columns are solved once, then each candidate is
+    added by bordering that Gram matrix with one row and column: the Schur complement gives the
+    candidate's coefficient and the correction to the others in O(n*k), for all candidates at once.
+    """
+    rmses = np.empty((len(splits), candidates.shape[1]))
+    for fold, (trains, tests) in enumerate(splits):
+        S_train, C_train, y_train = selected[trains], candidates[trains], y[trains]
+        S_test, C_test = selected[tests], candidates[tests]
+        if fit_intercept:
+            S_mean, C_mean, y_mean = S_train.mean(axis=0), C_train.mean(axis=0), y_train.mean()
+            S_train, C_train, y_train = S_train - S_mean, C_train - C_mean, y_train - y_mean
+            S_test, C_test = S_test - S_mean, C_test - C_mean
+        else:
+            y_mean = 0.0
+
+        # fit on the selected columns alone
+        G_inverse = np.linalg.pinv(S_train.T @ S_train + alpha*np.eye(S_train.shape[1]))
+        coef = G_inverse @ (S_train.T @ y_train)
+
+        # border the Gram matrix with each candidate
+        g = S_train.T @ C_train
+        H = G_inverse @ g
+        schur = (C_train**2).sum(axis=0) + alpha - (g*H).sum(axis=0)
+        residual_correlation = C_train.T @ y_train - g.T @ coef
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidate_coef = np.where(schur > 1e-12 * (C_train**2).sum(axis=0).clip(min=1e-300),
+                                      residual_correlation / schur, 0.0)
+
+        # adding the candidate shifts the other coefficients by -H*candidate_coef
+        predict_tests = (S_test @ coef + y_mean)[:, None] + (C_test - S_test @ H) * candidate_coef
+        rmses[fold] = np.sqrt(((predict_tests - y[tests][:, None])**2).mean(axis=0))
+    return rmses.mean(axis=0), rmses.std(axis=0)
+
 # Mess with PCA stuff:
 PCA.transform = dataframify_new_column_names(PCA.transform, 'pca_')
 
-# Mess with SFS stuff:
-SequentialFeatureSelector.transform = dataframify_new_column_names(SequentialFeatureSelector.transform, 'sfs_')
-SequentialFeatureSelector.fit = fitify_just_use_values(SequentialFeatureSelector.fit)
+# Mess with SFS stuff, once mlxtend (slow to import) is needed:
+_sequential_feature_selector = None
+
+def SequentialFeatureSelector(*args, **kwargs):
+    " Makes mlxtend's SequentialFeatureSelector, importing and patching it on first use "
+    global _sequential_feature_selector
+    if _sequential_feature_selector is None:
+        from mlxtend.feature_selection import SequentialFeatureSelector as sfs
+        sfs.transform = dataframify_new_column_names(sfs.transform, 'sfs_')
+        sfs.fit = fitify_just_use_values(sfs.fit)
+        _sequential_feature_selector = sfs
+        SequentialFeatureSelector.__signature__ = inspect.signature(sfs) # for _instantiate's errors
+    return _sequential_feature_selector(*args, **kwargs)
+
 model_selectors['SequentialFeatureSelector'] = SequentialFeatureSelector
 name_to_constructor['SequentialFeatureSelector'] = SequentialFeatureSelector
 
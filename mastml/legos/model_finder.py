@@ -1,19 +1,120 @@
 """
 Provides a name_to_constructor dict for all the models in sklearn,
 and the check_models_mixed function
+
+Finding every sklearn model means importing all of sklearn, so it's only done once per installed
+sklearn version: the model names and the dotted paths of their classes are saved in a registry
+file at REGISTRY_PATH, and each class is only imported when it's first looked up.
 """
+import importlib
+import json
+import os
+import logging
 import warnings
+from collections.abc import MutableMapping
 
+import sklearn
 import sklearn.base
-import sklearn.utils.testing
 import numpy as np
 
 #from . import keras_models
 from .. import utils
 
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-    name_to_constructor = dict(sklearn.utils.testing.all_estimators())
+log = logging.getLogger('mastml')
+
+REGISTRY_PATH = os.path.join(os.path.expanduser('~'), '.mastml', 'model_registry.json')
+
+def load_registry(path=REGISTRY_PATH, refresh=False):
+    """
+    Returns {model name: dotted path of its class} for the installed sklearn, read from the
+    registry file at path, or found with all_estimators() and saved there if the file is missing,
+    from another sklearn version, or refresh is set
+    """
+    if not refresh:
+        try:
+            with open(path) as f:
+                registry = json.load(f)
+            if registry['sklearn_version'] == sklearn.__version__:
+                return registry['models']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    log.info(f'Finding the models in scikit-learn {sklearn.__version__}')
+    from sklearn.utils.testing import all_estimators
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        models = {name: f'{constructor.__module__}.{constructor.__name__}'
+                  for name, constructor in all_estimators()}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(dict(sklearn_version=sklearn.__version__, models=models), f, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except OSError as e:
+        log.warning(f'Could not save the model registry to {path}: {e}')
+    return models
+
+def import_dotted(dotted_path):
+    " The object named by dotted_path, like 'sklearn.linear_model.ridge.Ridge' "
+    module_name, _, name = dotted_path.rpartition('.')
+    return getattr(importlib.import_module(module_name), name)
+
+class ModelRegistry(MutableMapping):
+    """
+    Dict of model name -> constructor. The registry file is only read on first use, and each
+    registered model's module is only imported when the model is first looked up. Models set
+    directly, like custom_models, don't go through the registry.
+    """
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self._paths = None
+        self._constructors = dict()
+
+    def refresh(self):
+        " Finds the sklearn models again, for after sklearn is upgraded while mastml is running "
+        self._paths = load_registry(self.path, refresh=True)
+        self._constructors = {name: constructor for name, constructor in self._constructors.items()
+                              if name not in self._paths}
+
+    def _registry(self):
+        if self._paths is None:
+            self._paths = load_registry(self.path)
+        return self._paths
+
+    def _names(self):
+        return list(self._registry()) + [name for name in self._constructors if name not in self._paths]
+
+    def __getitem__(self, name):
+        if name not in self._constructors:
+            dotted_path = self._registry()[name]
+            try:
+                self._constructors[name] = import_dotted(dotted_path)
+            except (ImportError, AttributeError):
+                log.info(f'{dotted_path} has moved, refreshing the model registry')
+                self.refresh()
+                self._constructors[name] = import_dotted(self._paths[name])
+        return self._constructors[name]
+
+    def __setitem__(self, name, constructor):
+        self._constructors[name] = constructor
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._constructors.pop(name, None)
+        self._registry().pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._constructors or name in self._registry()
+
+    def __iter__(self):
+        return iter(self._names())
+
+    def __len__(self):
+        return len(self._names())
+
+name_to_constructor = ModelRegistry()
 
 
 class AlwaysFive(sklearn.base.RegressorMixin):
@@ -3,6 +3,7 @@ Module for getting a mastml system call and calling all the appropriate subrouti
 """
 
 import argparse
+import copy
 import inspect
 import os
 import shutil
@@ -11,7 +12,6 @@ import warnings
 from datetime import datetime
 from collections import OrderedDict
 from os.path import join # We use join tons
-from functools import reduce
 
 import numpy as np
 import pandas as pd
@@ -19,7 +19,8 @@ from sklearn.externals import joblib
 from sklearn.exceptions import UndefinedMetricWarning
 from sklearn.model_selection import LeaveOneGroupOut
 
-from . import conf_parser, data_loader, html_helper, plot_helper, utils, learning_curve, data_cleaner
+from . import (conf_parser, data_loader, html_helper, plot_helper, utils, learning_curve, data_cleaner,
+               metrics, feature_cache, split_cache, results_store, fold_pipeline)
 from .legos import (data_splitters, feature_generators, feature_normalizers,
                     feature_selectors, model_finder, util_legos)
 from .legos import clusterers as legos_clusterers
@@ -69,7 +70,10 @@ def mastml_run(conf_path, data_path, outdir):
                                      conf['GeneralSetup']['input_features'],
                                      conf['GeneralSetup']['target_feature'],
                                      conf['GeneralSetup']['grouping_feature'],
-                                     conf['GeneralSetup']['not_input_features'])
+                                     conf['GeneralSetup']['not_input_features'],
+                                     low_memory=conf['GeneralSetup']['low_memory'],
+                                     keep_columns=_conf_column_names(conf),
+                                     cache=conf['GeneralSetup']['data_cache'])
 
     # Perform data cleaning here
     dc = conf['DataCleaning']
@@ -121,19 +125,9 @@ def mastml_run(conf_path, data_path, outdir):
         for validation_column_name in validation_column_names:
             validation_columns[validation_column_name] = df[validation_column_name]
         validation_columns = pd.DataFrame(validation_columns)
-        validation_X = list()
-        validation_y = list()
-
-        # TODO make this block its own function
-        for validation_column_name in validation_column_names:
-            # X_, y_ = _exclude_validation(X, validation_columns[validation_column_name]), _exclude_validation(y, validation_columns[validation_column_name])
-            validation_X.append(pd.DataFrame(_exclude_validation(X, validation_columns[validation_column_name])))
-            validation_y.append(pd.DataFrame(_exclude_validation(y, validation_columns[validation_column_name])))
-        idxy_list = list()
-        for i, _ in enumerate(validation_y):
-            idxy_list.append(validation_y[i].index)
-        # Get intersection of indices between all prediction columns
-        intersection = reduce(np.intersect1d, (i for i in idxy_list))
+        # rows that are not prediction-only in any of the validation columns, worked out once
+        # here and reused by the splitters
+        intersection = _novalidation_intersection(y, validation_columns)
         X_novalidation = X.iloc[intersection]
         y_novalidation = y.iloc[intersection]
         X_grouped_novalidation = X_grouped.iloc[intersection]
@@ -145,11 +139,23 @@ def mastml_run(conf_path, data_path, outdir):
     if conf['PlotSettings']['target_histogram']:
         # First, save input data stats to csv
         y.describe().to_csv(join(outdir, 'input_data_statistics.csv'))
-        plot_helper.plot_target_histogram(y, join(outdir, 'target_histogram.png'), label=y.name)
+        plot_helper.plot_target_histogram(y, join(outdir, 'target_histogram.png'), label=y.name, dpi=PlotSettings['dpi'])
 
     # Get the appropriate collection of metrics:
     metrics_dict = conf['GeneralSetup']['metrics']
 
+    # Everything _one_fit needs besides the data and model for a split, see _run_fits
+    n_jobs = conf['GeneralSetup']['n_jobs']
+    fit_settings = dict(is_classification=is_classification,
+                        is_validation=is_validation,
+                        metric_names=list(metrics_dict.keys()),
+                        PlotSettings=PlotSettings,
+                        X_noinput=X_noinput,
+                        split_csvs=conf['GeneralSetup']['split_csvs'])
+    if is_validation:
+        fit_settings.update(validation_columns=validation_columns,
+                            validation_column_names=validation_column_names)
+
     # Extract columns that some splitter need to do grouped splitting using 'grouping_column'
     # special argument
     splitter_to_group_names = _extract_grouping_column_names(conf['DataSplits'])
@@ -219,7 +225,13 @@ def mastml_run(conf_path, data_path, outdir):
 
         def generate_features():
             log.info("Doing feature generation...")
-            dataframes = [instance.fit_transform(df, y) for _, instance in generators]
+            if conf['GeneralSetup']['feature_cache'] is None:
+                dataframes = [instance.fit_transform(df, y) for _, instance in generators]
+            else:
+                dataframes = [feature_cache.generate_cached(instance, conf['FeatureGeneration'][name][1], df, y,
+                                                            conf['GeneralSetup']['feature_cache'],
+                                                            conf['GeneralSetup']['feature_cache_size'])
+                              for name, instance in generators]
             dataframe = pd.concat(dataframes, 1)
             log.info("Saving generated data to csv...")
             log.debug(f'generated cols: {dataframe.columns}')
@@ -264,14 +276,14 @@ def mastml_run(conf_path, data_path, outdir):
                 for column in X: # plot y against each x column
                     filename = f'{column}_vs_target_scatter.png'
                     plot_helper.plot_scatter(X[column], y, join(outdir, filename),
-                                             xlabel=column, groups=None, ylabel='target_feature', label=y.name)
+                                             xlabel=column, groups=None, ylabel='target_feature', label=y.name, dpi=PlotSettings['dpi'])
             else:
                 for name in clustered_df.columns: # for each cluster, plot y against each x column
                     for column in X:
                         filename = f'{column}_vs_target_by_{name}_scatter.png'
                         plot_helper.plot_scatter(X[column], y, join(outdir, filename),
                                                 clustered_df[name], xlabel=column,
-                                                ylabel='target_feature', label=y.name)
+                                                ylabel='target_feature', label=y.name, dpi=PlotSettings['dpi'])
         if PlotSettings['feature_vs_target']:
             make_feature_vs_target_plots()
 
@@ -281,15 +293,24 @@ def mastml_run(conf_path, data_path, outdir):
             X = pd.concat([X, clustered_df], axis=1)
         pd.concat([X, y], 1).to_csv(join(outdir, "clusters.csv"), index=False)
 
+        fold_preprocessing = conf['GeneralSetup']['fold_preprocessing']
+
         def make_normalizer_selector_dataframe_triples():
+            # With fold_preprocessing the normalizers and selectors are only fit per fold (see
+            # run_fits_per_fold), so there's no whole-data normalized.csv or selected.csv and
+            # the triples hold None instead of a dataframe
+            if fold_preprocessing:
+                log.info("Normalizers and selectors are fit on each fold's training rows, "
+                         "skipping normalized.csv and selected.csv")
             triples = []
             for normalizer_name, normalizer_instance in normalizers:
-                log.info(f"Running normalizer {normalizer_name} ...")
-                X_normalized = normalizer_instance.fit_transform(X, y)
-                log.info("Saving normalized data to csv...")
                 dirname = join(outdir, normalizer_name)
                 os.mkdir(dirname)
-                pd.concat([X_normalized, X_noinput, y], 1).to_csv(join(dirname, "normalized.csv"), index=False)
+                if not fold_preprocessing:
+                    log.info(f"Running normalizer {normalizer_name} ...")
+                    X_normalized = normalizer_instance.fit_transform(X, y)
+                    log.info("Saving normalized data to csv...")
+                    pd.concat([X_normalized, X_noinput, y], 1).to_csv(join(dirname, "normalized.csv"), index=False)
 
                 # Put learning curve here??
                 if conf['LearningCurve']:
@@ -313,18 +334,24 @@ def mastml_run(conf_path, data_path, outdir):
                                                             scoring=learning_curve_scoring, Xgroups=X_grouped_novalidation)
                     plot_helper.plot_learning_curve(train_sizes, train_mean, test_mean, train_stdev, test_stdev,
                                                     scoring_name_nice, 'sample_learning_curve',
-                                                    join(dirname, f'data_learning_curve'))
+                                                    join(dirname, f'data_learning_curve'), dpi=PlotSettings['dpi'])
                     # Do feature learning curve
                     train_sizes, train_mean, test_mean, train_stdev, test_stdev = learning_curve.feature_learning_curve(X=X_novalidation, y=y_novalidation,
                                                             estimator=learning_curve_estimator, cv=learning_curve_cv,
                                                             scoring=learning_curve_scoring, selector_name=selector_name,
                                                             n_features_to_select=n_features_to_select,
-                                                            Xgroups=X_grouped_novalidation)
+                                                            Xgroups=X_grouped_novalidation, n_jobs=n_jobs)
                     plot_helper.plot_learning_curve(train_sizes, train_mean, test_mean, train_stdev, test_stdev,
                                                     scoring_name_nice, 'feature_learning_curve',
-                                                    join(dirname, f'feature_learning_curve'))
+                                                    join(dirname, f'feature_learning_curve'), dpi=PlotSettings['dpi'])
+
 
 
+                if fold_preprocessing:
+                    for selector_name, _ in selectors:
+                        os.mkdir(join(outdir, normalizer_name, selector_name))
+                        triples.append((normalizer_name, selector_name, None))
+                    continue
 
                 log.info("Running selectors...")
                 for selector_name, selector_instance in selectors:
@@ -349,17 +376,6 @@ def mastml_run(conf_path, data_path, outdir):
         def make_splittername_splitlist_pairs():
             # exclude the testing_only rows from use in splits
             if is_validation:
-                validation_X = list()
-                validation_y = list()
-                for validation_column_name in validation_column_names:
-                    #X_, y_ = _exclude_validation(X, validation_columns[validation_column_name]), _exclude_validation(y, validation_columns[validation_column_name])
-                    validation_X.append(pd.DataFrame(_exclude_validation(X, validation_columns[validation_column_name])))
-                    validation_y.append(pd.DataFrame(_exclude_validation(y, validation_columns[validation_column_name])))
-                idxy_list = list()
-                for i, _ in enumerate(validation_y):
-                    idxy_list.append(validation_y[i].index)
-                # Get intersection of indices between all prediction columns
-                intersection = reduce(np.intersect1d, (i for i in idxy_list))
                 X_ = X.iloc[intersection]
                 y_ = y.iloc[intersection]
             else:
@@ -367,16 +383,11 @@ def mastml_run(conf_path, data_path, outdir):
 
             pairs = []
 
-            def fix_index(array):
-                return X_.index.values[array] 
-
-            def proper_index(splits):
-                """ For example, if X's indexs are [1,4,6] and you split 
-                [ [[0],[1,2]], [[1],[0,2]] ] then we would get 
-                [ [[1],[4,6]], [[4],[1,6]] ] 
-                Needed only for valdation row stuff.
-                """
-                return tuple(tuple(fix_index(part) for part in split) for split in splits)
+            # Splits are kept as fold numbers or bitmasks over X_'s rows and only turned back into
+            # X_'s index labels (e.g. rows [0,2] of an X_ indexed [1,4,6] become [1,6]) when used
+            def compact_splits(instance, grouping_data=None):
+                return split_cache.make_splits(instance, X_, y_, grouping_data,
+                                               cache_dir=conf['GeneralSetup']['split_cache'])
 
 
             # Collect all the grouping columns, `None` if not needed
@@ -394,30 +405,15 @@ def mastml_run(conf_path, data_path, outdir):
                             # Get groups for plotting first
                             splitter_to_group_column[name] = df_[col].values
                             if is_validation:
-                                _df_list = list()
-                                if df_ is not clustered_df:
-                                    # exclude for df_ so that rows match up in splitter
-                                    for validation_column_name in validation_column_names:
-                                        df_ = _exclude_validation(df_, validation_columns[validation_column_name])
-                                        _df_list.append(df_)
-                                elif df_ is clustered_df:
+                                if df_ is clustered_df:
                                     # merge the cluster data df_ to full df
                                     df[col] = df_
-                                    for validation_column_name in validation_column_names:
-                                        df_ = _exclude_validation(df, validation_columns[validation_column_name])
-                                        _df_list.append(df_)
-
-                                # Get df_ based on index intersection between all df's in _df_list
-                                idxy_list = list()
-                                for i, _ in enumerate(_df_list):
-                                    idxy_list.append(_df_list[i].index)
-                                # Get intersection of indices between all prediction columns
-                                intersection = reduce(np.intersect1d, (i for i in idxy_list))
+                                # exclude the same rows as X_ so that rows match up in splitter
                                 df_ = df.iloc[intersection]
 
                             # and use the no-validation one for the split
                             grouping_data = df_[col].values
-                            split = proper_index(instance.split(X_, y_, grouping_data))
+                            split = compact_splits(instance, grouping_data)
                             pairs.append((name, split))
                             break
                     # If we didn't find that column anywhere, raise
@@ -428,7 +424,7 @@ def mastml_run(conf_path, data_path, outdir):
                 # If we don't need grouping column
                 else: 
                     splitter_to_group_column[name] = None
-                    split = proper_index(instance.split(X_, y_))
+                    split = compact_splits(instance)
                     pairs.append((name, split))
 
             return pairs, splitter_to_group_column
@@ -437,187 +433,118 @@ def mastml_run(conf_path, data_path, outdir):
         log.info("Fitting models to splits...")
 
         def do_models_splits():
-            all_results = []
-            for normalizer_name, selector_name, X in normalizer_selector_dataframe_triples:
+            # Every split of every (normalizer, selector, model, splitter) combo is an independent
+            # fit, so queue them all up first and let _run_fits spread them over n_jobs processes.
+            combos = []
+            fit_tasks = []
+            fit_dtype = conf['GeneralSetup']['fit_dtype']
+
+            fold_columns = dict() # (fold key, normalizer, selector) -> columns its selector kept
+
+            def run_fits_per_fold():
+                # The normalizers and selectors are refit on the training rows of every distinct fold,
+                # instead of once on all of X, so the test rows can't leak into the selected features.
+                # Each fold's transformed copies of X are only made just before its fits, for a batch of
+                # n_jobs folds at a time, and dropped once they're done, so no more are ever held at once.
+                tasks_by_fold = OrderedDict() # fold key -> (training indices, numbers of the tasks on it)
+                for task_num, (fold_key, _, _, split_num, trains_tests, _) in enumerate(fit_tasks):
+                    tasks_by_fold.setdefault(fold_key[0], (trains_tests[split_num][0], []))[1].append(task_num)
+                folds = list(tasks_by_fold.values())
+                batch_size = n_jobs if n_jobs > 0 else max(os.cpu_count() + 1 + n_jobs, 1)
+                fit_results = [None] * len(fit_tasks)
+                for start in range(0, len(folds), batch_size):
+                    batch = folds[start:start+batch_size]
+                    fold_datas = {key: _FoldData(X_fold, y, fit_dtype) for key, X_fold in fold_pipeline.transform_folds(
+                            normalizers, selectors, X, y, [train_indices for train_indices, _ in batch], X_grouped, n_jobs).items()}
+                    fold_columns.update((key, fold_data.columns) for key, fold_data in fold_datas.items())
+                    task_nums = [task_num for _, fold_task_nums in batch for task_num in fold_task_nums]
+                    batch_tasks = [(fold_datas[fit_tasks[task_num][0]],) + fit_tasks[task_num][1:] for task_num in task_nums]
+                    for task_num, fit_result in zip(task_nums, _run_fits(batch_tasks, fit_settings, n_jobs)):
+                        fit_results[task_num] = fit_result
+                return fit_results
+
+            for normalizer_name, selector_name, X_selected in normalizer_selector_dataframe_triples:
                 subdir = join(outdir, normalizer_name, selector_name)
+                if X_selected is not None:
+                    # converted to arrays once here and shared by every fit on this dataframe
+                    fold_data = _FoldData(X_selected, y, fit_dtype)
 
-                if PlotSettings['feature_vs_target']:
+                if PlotSettings['feature_vs_target'] and X_selected is not None:
                     #if selector_name == 'DoNothing': continue
                     # for each selector/normalizer, plot y against each x column
-                    for column in X:
+                    for column in X_selected:
                         filename = f'{column}_vs_target.png'
-                        plot_helper.plot_scatter(X[column], y, join(subdir, filename),
-                                                 xlabel=column, ylabel='target_feature', label=y.name)
+                        plot_helper.plot_scatter(X_selected[column], y, join(subdir, filename),
+                                                 xlabel=column, ylabel='target_feature', label=y.name, dpi=PlotSettings['dpi'])
                 for model_name, model_instance in models:
                     for splitter_name, trains_tests in splittername_splitlist_pairs:
                         grouping_data = splitter_to_group_column[splitter_name]
                         subdir = join(normalizer_name, selector_name, model_name, splitter_name)
-                        log.info(f"    Running splits for {subdir}")
+                        log.info(f"    Queueing splits for {subdir}")
                         subsubdir = join(outdir, subdir)
                         os.makedirs(subsubdir)
-                        # NOTE: do_one_splitter is a big old function, does lots
-                        runs = do_one_splitter(X, y, model_instance, subsubdir, trains_tests, grouping_data)
-                        all_results.extend(runs)
-            return all_results
-
-        return do_models_splits()
-
-    def do_one_splitter(X, y, model, main_path, trains_tests, grouping_data):
-
-        def one_fit(split_num, train_indices, test_indices):
-
-            log.info(f"        Doing split number {split_num}")
-            train_X, train_y = X.loc[train_indices], y.loc[train_indices]
-            test_X,  test_y  = X.loc[test_indices],  y.loc[test_indices]
-
-            # split up groups into train and test as well
-            if grouping_data is not None:
-                train_groups, test_groups = grouping_data[train_indices], grouping_data[test_indices]
-            else:
-                train_groups, test_groups = None, None
-
-            path = join(main_path, f"split_{split_num}")
-            os.mkdir(path)
-
-            log.info("             Fitting model and making predictions...")
-            model.fit(train_X, train_y)
-            #joblib.dump(model, join(path, "trained_model.pkl"))
-            if is_classification:
-                # For classification, need probabilty of prediction to make accurate ROC curve (and other predictions??).
-                #TODO:Consider using only predict_proba and not predict() method for classif problems. Have exit escape if probability set to False here.
-                # See stackoverflow post:
-                #https: // stats.stackexchange.com / questions / 329857 / what - is -the - difference - between - decision
-                # - function - predict - proba - and -predict - fun
-
-                #params = model.get_params()
-                #if params['probability'] == True:
-                try:
-                    train_pred_proba = model.predict_proba(train_X)
-                    test_pred_proba = model.predict_proba(test_X)
-                except:
-                    log.error('You need to perform classification with model param probability=True enabled for accurate'
-                                ' predictions, if your model has the probability param (e.g. RandomForestClassifier does not. '
-                              'Please reset this parameter as applicable and re-run MASTML')
-                    exit()
-                train_pred = model.predict(train_X)
-                test_pred = model.predict(test_X)
+                        split_sources = []
+                        for split_num in range(len(trains_tests)):
+                            if X_selected is not None:
+                                split_data = fold_data
+                            else:
+                                # stands in for the fold's data until run_fits_per_fold makes it
+                                split_data = (fold_pipeline.fold_key(trains_tests[split_num][0]),
+                                              normalizer_name, selector_name)
+                            split_sources.append(split_data)
+                            fit_tasks.append((split_data, model_instance, subsubdir, split_num,
+                                              trains_tests, grouping_data))
+                        combos.append((X if X_selected is None else X_selected, model_instance, subsubdir,
+                                       trains_tests, grouping_data, split_sources))
+
+            log.info(f"    Running {len(fit_tasks)} fits with n_jobs={n_jobs}")
+            if fold_preprocessing:
+                fit_results = iter(run_fits_per_fold())
             else:
-                train_pred = model.predict(train_X)
-                test_pred  = model.predict(test_X)
+                fit_results = iter(_run_fits(fit_tasks, fit_settings, n_jobs))
 
-            # here is where we need to collect validation stats
+            # Row indices and predictions of every split go in one store for the whole run
+            store_path = join(outdir, results_store.STORE_NAME)
             if is_validation:
-                validation_predictions_list = list()
-                validation_y_forpred_list = list()
-                for validation_column_name in validation_column_names:
-                    validation_X_forpred = _only_validation(X, validation_columns[validation_column_name])
-                    validation_y_forpred = _only_validation(y, validation_columns[validation_column_name])
-                    log.info("             Making predictions on prediction_only data...")
-                    validation_predictions = model.predict(validation_X_forpred)
-                    validation_predictions_list.append(validation_predictions)
-                    validation_y_forpred_list.append(validation_y_forpred)
-
-                    # save them as 'predicitons.csv'
-                    validation_predictions_series = pd.Series(validation_predictions, name='clean_predictions', index=validation_X_forpred.index)
-                    #validation_noinput_series = pd.Series(X_noinput.index, index=validation_X.index)
-                    pd.concat([validation_X_forpred,  validation_y_forpred,  validation_predictions_series],  1)\
-                            .to_csv(join(path, 'predictions_'+str(validation_column_name)+'.csv'), index=False)
+                validation_indices = {name: _only_validation(y, validation_columns[name]).index.values
+                                      for name in validation_column_names}
             else:
-                validation_y = None
-            
-
-            # Save train and test data and results to csv:
-            log.info("             Saving train/test data and predictions to csv...")
-            train_pred_series = pd.DataFrame(train_pred, columns=['train_pred'], index=train_indices)
-            train_noinput_series = pd.DataFrame(X_noinput, index=train_indices)
-            pd.concat([train_X, train_y, train_pred_series, train_noinput_series], 1)\
-                    .to_csv(join(path, 'train.csv'), index=False)
-            test_pred_series = pd.DataFrame(test_pred,   columns=['test_pred'],  index=test_indices)
-            test_noinput_series = pd.DataFrame(X_noinput, index=test_indices)
-            pd.concat([test_X,  test_y,  test_pred_series, test_noinput_series],  1)\
-                    .to_csv(join(path, 'test.csv'),  index=False)
-
-
-            log.info("             Calculating score metrics...")
-            split_path = main_path.split(os.sep)
-
-            # collect metrics inside a warning catching block for some things we know we should ignore
-            with warnings.catch_warnings():
-                # NOTE I tried making this more specific use warnings's regex filter but it would never
-                # catch it for some indeterminiable reason.
-                # This warning is raised when you ask for Recall on something from y_true that never
-                # occors in y_pred. sklearn assumes 0.0, and we want it to do so (silently).
-                warnings.simplefilter('ignore', UndefinedMetricWarning)
-                train_metrics = OrderedDict((name, function(train_y, train_pred))
-                                            for name, (_, function) in metrics_dict.items())
-                test_metrics = OrderedDict((name, function(test_y, test_pred))
-                                           for name, (_, function) in metrics_dict.items())
-                # Need to pass y_train data to get rmse/sigma for test rmse and sigma of train y
-                if 'rmse_over_stdev' in metrics_dict.keys():
-                    test_metrics['rmse_over_stdev'] = metrics_dict['rmse_over_stdev'][1](test_y, test_pred, train_y)
-                if 'R2_adjusted' in metrics_dict.keys():
-                    test_metrics['R2_adjusted'] = metrics_dict['R2_adjusted'][1](test_y, test_pred, test_X.shape[1])
-                    train_metrics['R2_adjusted'] = metrics_dict['R2_adjusted'][1](train_y, train_pred, train_X.shape[1])
-
-                split_result = OrderedDict(
-                    normalizer=split_path[-4],
-                    selector=split_path[-3],
-                    model=split_path[-2],
-                    splitter=split_path[-1],
-                    split_num=split_num,
-                    y_train_true=train_y.values,
-                    y_train_pred=train_pred,
-                    y_test_true=test_y.values,
-                    y_test_pred=test_pred,
-                    train_metrics=train_metrics,
-                    test_metrics=test_metrics,
-                    train_indices=train_indices,
-                    test_indices=test_indices,
-                    train_groups=train_groups,
-                    test_groups=test_groups,
-                )
-
-                if is_validation:
-                    prediction_metrics_list = list()
-                    for validation_column_name, validation_y, validation_predictions in zip(validation_column_names, validation_y_forpred_list, validation_predictions_list):
-                        prediction_metrics = OrderedDict((name, function(validation_y, validation_predictions))
-                                           for name, (_, function) in metrics_dict.items())
-                        if 'rmse_over_stdev' in prediction_metrics.keys():
-                            # Correct series passed?
-                            prediction_metrics['rmse_over_stdev'] = metrics_dict['rmse_over_stdev'][1](validation_y, validation_predictions, train_y)
-                        prediction_metrics_list.append(prediction_metrics)
-                        split_result['y_validation_true'+'_'+str(validation_column_name)] = validation_y.values
-                        split_result['y_validation_pred'+'_'+str(validation_column_name)] = validation_predictions
-                    split_result['prediction_metrics'] = prediction_metrics_list
-                else:
-                    split_result['prediction_metrics'] = None
+                validation_indices = None
+
+            # Results come back in the order they were queued, so just peel them off per combo
+            all_results = []
+            for X_combo, model_instance, subsubdir, trains_tests, grouping_data, split_sources in combos:
+                split_results = [next(fit_results) for _ in trains_tests]
+                combo_name = os.path.relpath(subsubdir, outdir).replace(os.sep, '/')
+                results_store.add_combo(store_path, combo_name, X_combo, fold_preprocessed=fold_preprocessing)
+                for split_num, split_result in enumerate(split_results):
+                    plot_helper.queue_plots(split_result.pop('plot_jobs'), PlotSettings['dpi'])
+                    split_source = split_sources[split_num]
+                    x_columns = fold_columns[split_source] if fold_preprocessing else split_source.columns
+                    results_store.add_split(store_path, combo_name, split_num, split_result, validation_indices,
+                                            x_columns=x_columns)
+                log.info(f"    Collecting splits for {os.path.relpath(subsubdir, outdir)}")
+                # NOTE: do_one_splitter is a big old function, does lots
+                runs = do_one_splitter(X_combo, y, model_instance, subsubdir, trains_tests,
+                                       grouping_data, split_results)
+                all_results.extend(runs)
+            return all_results
 
-            if is_classification:
-                split_result['y_train_pred_proba'] = train_pred_proba
-                split_result['y_test_pred_proba'] = test_pred_proba
+        return do_models_splits()
 
-            log.info("             Making plots...")
-            if PlotSettings['train_test_plots']:
-                plot_helper.make_train_test_plots(
-                        split_result, path, is_classification, 
-                        label=y.name, model=model, train_X=train_X, test_X=test_X, groups=grouping_data)
+    def do_one_splitter(X, y, model, main_path, trains_tests, grouping_data, split_results):
 
-            if is_validation:
-                _write_stats(split_result['train_metrics'],
-                         split_result['test_metrics'],
+        # stats.txt used to be rewritten after every split, so it holds the last split's scores
+        if is_validation:
+            _write_stats(split_results[-1]['train_metrics'],
+                         split_results[-1]['test_metrics'],
                          main_path,
-                         split_result['prediction_metrics'],
+                         split_results[-1]['prediction_metrics'],
                          validation_column_names,)
-            else:
-                _write_stats(split_result['train_metrics'],
-                             split_result['test_metrics'],
-                             main_path)
-
-            return split_result
-
-        split_results = []
-        for split_num, (train_indices, test_indices) in enumerate(trains_tests):
-            split_results.append(one_fit(split_num, train_indices, test_indices))
+        else:
+            _write_stats(split_results[-1]['train_metrics'],
+                         split_results[-1]['test_metrics'],
+                         main_path)
 
         log.info("    Calculating mean and stdev of scores...")
         def make_train_test_average_and_std_stats():
@@ -633,7 +560,7 @@ def mastml_run(conf_path, data_path, outdir):
                 if grouping_data is not None:
                     unique_groups = np.union1d(split_results[0]['test_groups'], split_results[0]['train_groups'])
                     plot_helper.plot_metric_vs_group(metric=name, groups=unique_groups, stats=test_values,
-                                                     avg_stats = test_stats_single, savepath=join(main_path, str(name)+'_vs_group.png'))
+                                                     avg_stats = test_stats_single, savepath=join(main_path, str(name)+'_vs_group.png'), dpi=PlotSettings['dpi'])
             return train_stats, test_stats
         avg_train_stats, avg_test_stats = make_train_test_average_and_std_stats()
         log.info("    Making best/worst plots...")
@@ -648,7 +575,7 @@ def mastml_run(conf_path, data_path, outdir):
         def make_pred_vs_true_plots(model):
             if PlotSettings['predicted_vs_true']:
                 plot_helper.plot_best_worst_split(y.values, best, worst,
-                                                  join(main_path, 'best_worst_split.png'), label=y.name)
+                                                  join(main_path, 'best_worst_split.png'), label=y.name, dpi=PlotSettings['dpi'])
             predictions = [[] for _ in range(X.shape[0])]
             for split_num, (train_indices, test_indices) in enumerate(trains_tests):
                 for i, pred in zip(test_indices, split_results[split_num]['y_test_pred']):
@@ -656,26 +583,33 @@ def mastml_run(conf_path, data_path, outdir):
             if PlotSettings['predicted_vs_true_bars']:
                 plot_helper.plot_predicted_vs_true_bars(
                         y.values, predictions, avg_test_stats,
-                        join(main_path, 'average_points_with_bars.png'), label=y.name)
+                        join(main_path, 'average_points_with_bars.png'), label=y.name, dpi=PlotSettings['dpi'])
             if PlotSettings['best_worst_per_point']:
                 plot_helper.plot_best_worst_per_point(y.values, predictions,
                                                       join(main_path, 'best_worst_per_point.png'),
-                                                      metrics_dict, avg_test_stats, label=y.name)
+                                                      metrics_dict, avg_test_stats, label=y.name, dpi=PlotSettings['dpi'])
             if PlotSettings['average_normalized_errors']:
                 plot_helper.plot_normalized_error(y.values, predictions,
                                                   join(main_path, 'average_test_normalized_errors.png'), model, X=None,
-                                                  avg_stats=avg_test_stats)
+                                                  avg_stats=avg_test_stats, dpi=PlotSettings['dpi'])
             if PlotSettings['average_cumulative_normalized_errors']:
                 plot_helper.plot_cumulative_normalized_error(y.values, predictions,
                                                   join(main_path, 'average_test_cumulative_normalized_errors.png'), model, X=None,
-                                                  avg_stats=avg_test_stats)
+                                                  avg_stats=avg_test_stats, dpi=PlotSettings['dpi'])
 
         if not is_classification:
             make_pred_vs_true_plots(model=model)
 
         return split_results
 
-    runs = do_all_combos(X, y, df) # calls do_one_splitter internally
+    if PlotSettings['defer_plots']:
+        # Queue the plots up while fitting and draw them all at the end, spread over n_jobs processes
+        with plot_helper.deferred_plots() as plot_jobs:
+            runs = do_all_combos(X, y, df) # calls do_one_splitter internally
+        log.info(f"Making {len(plot_jobs)} queued plots with n_jobs={n_jobs}...")
+        plot_helper.render_plots(plot_jobs, n_jobs, PlotSettings['dpi'])
+    else:
+        runs = do_all_combos(X, y, df) # calls do_one_splitter internally
 
     log.info("Making image html file...")
     html_helper.make_html(outdir)
@@ -683,6 +617,245 @@ def mastml_run(conf_path, data_path, outdir):
     log.info("Making html file of all runs stats...")
     _save_all_runs(runs, outdir)
 
+def _conf_column_names(conf):
+    """
+    Names of data columns the run uses besides the input, target and not-input features: the
+    validation columns, and any column a feature generator might be pointed at (all of their
+    string parameters, the loader ignores the ones that aren't columns)
+    """
+    names = conf['GeneralSetup'].get('validation_columns', list())
+    names = [names] if isinstance(names, str) else list(names)
+    for name, kwargs in conf['FeatureGeneration'].values():
+        names.extend(value for value in kwargs.values() if isinstance(value, str))
+    return names
+
+def _run_fits(fit_tasks, fit_settings, n_jobs=1):
+    """
+    Calls _one_fit on every task in fit_tasks, using a pool of n_jobs processes when n_jobs != 1.
+    Results are returned in the same order as fit_tasks, regardless of which worker finishes first,
+    so everything downstream sees exactly what the serial path would have produced.
+    Tasks refer to their split by number, and its indices are only decoded as the task is sent off.
+    """
+    def decoded(task):
+        fold_data, model, main_path, split_num, trains_tests, grouping_data = task
+        train_indices, test_indices = trains_tests[split_num]
+        return fold_data, model, main_path, split_num, train_indices, test_indices, grouping_data
+    if n_jobs == 1:
+        return [_one_fit(*decoded(task), **fit_settings) for task in fit_tasks]
+    return joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(_one_fit)(*decoded(task), **fit_settings)
+                                          for task in fit_tasks)
+
+def _one_fit(fold_data, model, main_path, split_num, train_indices, test_indices, grouping_data,
+             is_classification, is_validation, metric_names, PlotSettings, X_noinput,
+             validation_columns=None, validation_column_names=None, split_csvs=False):
+    """
+    Fits and scores one model on one split, saving its csvs and plots into main_path/split_<num>.
+    Lives at module level (and takes metric names rather than metric functions, some of which are
+    lambdas) so that it can be pickled off to worker processes by _run_fits.
+    The model is fit on numpy arrays sliced out of fold_data, dataframes are only made for the csvs.
+    """
+    metrics_dict = metrics.check_and_fetch_names(metric_names, is_classification)
+
+    log.info(f"        Doing split number {split_num}")
+    train_rows, test_rows = fold_data.positions(train_indices), fold_data.positions(test_indices)
+    # the fit model can keep its training matrix (KernelRidge's X_fit_, KNeighbors' _fit_X), so
+    # train_X is always a fresh array. test_X is only predicted on, so it can use the scratch
+    # buffer, unless queued plots are going to keep it around.
+    train_X = _take_rows(fold_data.X, train_rows)
+    test_X  = _take_rows(fold_data.X, test_rows, None if PlotSettings['defer_plots'] else 'test')
+    train_y, test_y = np.take(fold_data.y, train_rows), np.take(fold_data.y, test_rows)
+
+    # split up groups into train and test as well
+    if grouping_data is not None:
+        train_groups, test_groups = grouping_data[train_indices], grouping_data[test_indices]
+    else:
+        train_groups, test_groups = None, None
+
+    path = join(main_path, f"split_{split_num}")
+    os.mkdir(path)
+
+    if PlotSettings['defer_plots']:
+        # the queued plots hold on to this split's model, so leave the one shared by all splits alone
+        model = copy.deepcopy(model)
+
+    log.info("             Fitting model and making predictions...")
+    model.fit(train_X, train_y)
+    #joblib.dump(model, join(path, "trained_model.pkl"))
+    if is_classification:
+        # For classification, need probabilty of prediction to make accurate ROC curve (and other predictions??).
+        #TODO:Consider using only predict_proba and not predict() method for classif problems. Have exit escape if probability set to False here.
+        # See stackoverflow post:
+        #https: // stats.stackexchange.com / questions / 329857 / what - is -the - difference - between - decision
+        # - function - predict - proba - and -predict - fun
+
+        #params = model.get_params()
+        #if params['probability'] == True:
+        try:
+            train_pred_proba = model.predict_proba(train_X)
+            test_pred_proba = model.predict_proba(test_X)
+        except Exception as e:
+            # raised rather than exiting, so it also reaches the user from a _run_fits worker
+            raise utils.InvalidModel('You need to perform classification with model param probability=True enabled for accurate'
+                        ' predictions, if your model has the probability param (e.g. RandomForestClassifier does not. '
+                      'Please reset this parameter as applicable and re-run MASTML') from e
+        train_pred = model.predict(train_X)
+        test_pred = model.predict(test_X)
+    else:
+        train_pred = model.predict(train_X)
+        test_pred  = model.predict(test_X)
+
+    # here is where we need to collect validation stats
+    if is_validation:
+        validation_predictions_list = list()
+        validation_y_forpred_list = list()
+        for validation_column_name in validation_column_names:
+            validation_column = validation_columns[validation_column_name]
+            validation_rows = fold_data.positions(validation_column.index[validation_column == 1])
+            validation_X_forpred = np.take(fold_data.X, validation_rows, axis=0)
+            validation_y_forpred = np.take(fold_data.y, validation_rows)
+            log.info("             Making predictions on prediction_only data...")
+            validation_predictions = model.predict(validation_X_forpred)
+            validation_predictions_list.append(validation_predictions)
+            validation_y_forpred_list.append(validation_y_forpred)
+
+            # save them as 'predicitons.csv'
+            if split_csvs:
+                validation_index = fold_data.index[validation_rows]
+                validation_predictions_series = pd.Series(validation_predictions, name='clean_predictions', index=validation_index)
+                #validation_noinput_series = pd.Series(X_noinput.index, index=validation_X.index)
+                pd.concat([fold_data.frame(validation_rows), fold_data.series(validation_rows),
+                           validation_predictions_series], 1)\
+                        .to_csv(join(path, 'predictions_'+str(validation_column_name)+'.csv'), index=False)
+
+    # The parent process saves the row indices and predictions to the run's results_store,
+    # the csvs with a full copy of the data are only written when asked for
+    if split_csvs:
+        log.info("             Saving train/test data and predictions to csv...")
+        train_pred_series = pd.DataFrame(train_pred, columns=['train_pred'], index=train_indices)
+        train_noinput_series = pd.DataFrame(X_noinput, index=train_indices)
+        pd.concat([fold_data.frame(train_rows), fold_data.series(train_rows), train_pred_series,
+                   train_noinput_series], 1).to_csv(join(path, 'train.csv'), index=False)
+        test_pred_series = pd.DataFrame(test_pred,   columns=['test_pred'],  index=test_indices)
+        test_noinput_series = pd.DataFrame(X_noinput, index=test_indices)
+        pd.concat([fold_data.frame(test_rows), fold_data.series(test_rows), test_pred_series,
+                   test_noinput_series], 1).to_csv(join(path, 'test.csv'),  index=False)
+
+
+    log.info("             Calculating score metrics...")
+    split_path = main_path.split(os.sep)
+
+    # collect metrics inside a warning catching block for some things we know we should ignore
+    with warnings.catch_warnings():
+        # NOTE I tried making this more specific use warnings's regex filter but it would never
+        # catch it for some indeterminiable reason.
+        # This warning is raised when you ask for Recall on something from y_true that never
+        # occors in y_pred. sklearn assumes 0.0, and we want it to do so (silently).
+        warnings.simplefilter('ignore', UndefinedMetricWarning)
+        train_metrics = OrderedDict((name, function(train_y, train_pred))
+                                    for name, (_, function) in metrics_dict.items())
+        test_metrics = OrderedDict((name, function(test_y, test_pred))
+                                   for name, (_, function) in metrics_dict.items())
+        # Need to pass y_train data to get rmse/sigma for test rmse and sigma of train y
+        if 'rmse_over_stdev' in metrics_dict.keys():
+            test_metrics['rmse_over_stdev'] = metrics_dict['rmse_over_stdev'][1](test_y, test_pred, train_y)
+        if 'R2_adjusted' in metrics_dict.keys():
+            test_metrics['R2_adjusted'] = metrics_dict['R2_adjusted'][1](test_y, test_pred, test_X.shape[1])
+            train_metrics['R2_adjusted'] = metrics_dict['R2_adjusted'][1](train_y, train_pred, train_X.shape[1])
+
+        split_result = OrderedDict(
+            normalizer=split_path[-4],
+            selector=split_path[-3],
+            model=split_path[-2],
+            splitter=split_path[-1],
+            split_num=split_num,
+            y_train_true=train_y,
+            y_train_pred=train_pred,
+            y_test_true=test_y,
+            y_test_pred=test_pred,
+            train_metrics=train_metrics,
+            test_metrics=test_metrics,
+            train_indices=train_indices,
+            test_indices=test_indices,
+            train_groups=train_groups,
+            test_groups=test_groups,
+        )
+
+        if is_validation:
+            prediction_metrics_list = list()
+            for validation_column_name, validation_y, validation_predictions in zip(validation_column_names, validation_y_forpred_list, validation_predictions_list):
+                prediction_metrics = OrderedDict((name, function(validation_y, validation_predictions))
+                                   for name, (_, function) in metrics_dict.items())
+                if 'rmse_over_stdev' in prediction_metrics.keys():
+                    # Correct series passed?
+                    prediction_metrics['rmse_over_stdev'] = metrics_dict['rmse_over_stdev'][1](validation_y, validation_predictions, train_y)
+                prediction_metrics_list.append(prediction_metrics)
+                split_result['y_validation_true'+'_'+str(validation_column_name)] = validation_y
+                split_result['y_validation_pred'+'_'+str(validation_column_name)] = validation_predictions
+            split_result['prediction_metrics'] = prediction_metrics_list
+        else:
+            split_result['prediction_metrics'] = None
+
+    if is_classification:
+        split_result['y_train_pred_proba'] = train_pred_proba
+        split_result['y_test_pred_proba'] = test_pred_proba
+
+    # With defer_plots the plots go back to the parent process as jobs, to be drawn after fitting
+    split_result['plot_jobs'] = []
+    if PlotSettings['train_test_plots']:
+        with plot_helper.deferred_plots() as plot_jobs:
+            plot_helper.make_train_test_plots(
+                    split_result, path, is_classification,
+                    label=fold_data.y_name, model=model, train_X=train_X, test_X=test_X, groups=grouping_data)
+        if PlotSettings['defer_plots']:
+            split_result['plot_jobs'] = plot_jobs
+        else:
+            log.info("             Making plots...")
+            plot_helper.render_plots(plot_jobs, dpi=PlotSettings['dpi'])
+
+    return split_result
+
+class _FoldData:
+    """
+    A dataframe X and its targets y as contiguous numpy arrays, made once and shared by every fit
+    on X. Folds are sliced out by row position, and X/y rows are turned back into pandas objects
+    only for saving.
+    """
+    def __init__(self, X, y, dtype=None):
+        self.index = X.index
+        self.columns = X.columns
+        self.X = np.ascontiguousarray(X.values, dtype=dtype)
+        self.y = np.ascontiguousarray(y.loc[X.index].values)
+        self.y_name = y.name
+
+    def positions(self, labels):
+        " Row positions of index labels "
+        return self.index.get_indexer(labels)
+
+    def frame(self, rows):
+        return pd.DataFrame(self.X[rows], columns=self.columns, index=self.index[rows])
+
+    def series(self, rows):
+        return pd.Series(self.y[rows], name=self.y_name, index=self.index[rows])
+
+# Scratch arrays that _take_rows slices folds into, kept per process so fits don't each allocate
+_row_buffers = dict()
+
+def _take_rows(values, rows, buffer_name=None):
+    """
+    Returns values[rows]. If buffer_name is given the rows are written into that scratch buffer and
+    a view of it is returned, which is only valid until the next call with the same buffer_name.
+    So a buffered result must not outlive the fit it's used in: don't fit models on it, or hand it
+    to anything that keeps it, only predict on it.
+    """
+    if buffer_name is None:
+        return np.take(values, rows, axis=0)
+    buffer = _row_buffers.get(buffer_name)
+    if (buffer is None or buffer.dtype != values.dtype or buffer.shape[1:] != values.shape[1:]
+            or len(buffer) < len(rows)):
+        buffer = np.empty((max(len(values), len(rows)),) + values.shape[1:], dtype=values.dtype)
+        _row_buffers[buffer_name] = buffer
+    return np.take(values, rows, axis=0, out=buffer[:len(rows)])
+
 def _instantiate(kwargs_dict, name_to_constructor, category, X_grouped=None, X_indices=None):
     """
     Uses name_to_constructor to instantiate every item in kwargs_dict and return
@@ -811,6 +984,10 @@ def _write_stats(train_metrics, test_metrics, outdir, prediction_metrics=None, p
                 for name, score in prediction_metric.items():
                     f.write(f"{name}: {'%.3f'%float(score)}\n")
 
+def _novalidation_intersection(y, validation_columns):
+    " Index labels of y's rows that are not prediction-only (1) in any of validation_columns "
+    return y.index.values[(validation_columns.loc[y.index] != 1).all(axis=1).values]
+
 def _exclude_validation(df, validation_column):
     return df.loc[validation_column != 1]
 
@@ -825,8 +1002,8 @@ def check_paths(conf_path, data_path, outdir):
         raise utils.FileNotFoundError(f"No such file: {conf_path}")
 
     # Check data path:
-    if os.path.splitext(data_path)[1] not in ['.csv', '.xlsx']:
-        raise utils.FiletypeError(f"Data file does not end in .csv or .xlsx: '{data_path}'")
+    if os.path.splitext(data_path)[1] not in ['.csv', '.xlsx', '.parquet', '.feather']:
+        raise utils.FiletypeError(f"Data file does not end in .csv, .xlsx, .parquet or .feather: '{data_path}'")
     if not os.path.isfile(data_path):
         raise utils.FileNotFoundError(f"No such file: {data_path}")
 
@@ -51,10 +51,91 @@ log = logging.getLogger() # only used inside ipynb_maker I guess
 
 log = logging.getLogger('mastml') # the real logger
 
+import functools
+import pickle
+from contextlib import contextmanager
+from sklearn.externals.joblib import Parallel, delayed
+
 from .ipynb_maker import ipynb_maker # TODO: fix cyclic import
 from .metrics import nice_names
+from .uncertainty import has_prediction_intervals, prediction_intervals
+
+# While deferred_plots is active, calls to @deferrable plot functions are queued here instead of drawn
+_deferred_plots = None
 
-def make_train_test_plots(run, path, is_classification, label, model, train_X, test_X, groups=None):
+def deferrable(plot_func):
+    """
+    Lets calls to plot_func be queued as (name, args, kwargs) jobs inside a deferred_plots block,
+    to be drawn later by render_plots. Outside of one it's drawn right away as usual.
+    """
+    @functools.wraps(plot_func)
+    def wrapper(*args, **kwargs):
+        if _deferred_plots is None:
+            return plot_func(*args, **kwargs)
+        _deferred_plots.append((plot_func.__name__, args, kwargs))
+    return wrapper
+
+@contextmanager
+def deferred_plots():
+    """
+    Queues every deferrable plot made in its block onto the list it yields, rather than drawing it.
+    Blocks can be nested, each one only collects the plots made directly inside it.
+    """
+    global _deferred_plots
+    outer, _deferred_plots = _deferred_plots, []
+    try:
+        yield _deferred_plots
+    finally:
+        _deferred_plots = outer
+
+def queue_plots(jobs, dpi=None):
+    """ Adds jobs collected elsewhere (like in a worker process) to the active deferred_plots
+    block, or draws them now at dpi if there isn't one """
+    if _deferred_plots is None:
+        render_plots(jobs, dpi=dpi)
+    else:
+        _deferred_plots.extend(jobs)
+
+def render_plots(jobs, n_jobs=1, dpi=None):
+    """
+    Draws queued plot jobs, using a pool of n_jobs processes when n_jobs != 1, at dpi (defaults
+    to DPI). The averaged normalized error plots read the csvs written by the per split ones, so
+    they are drawn last. Jobs that can't be pickled (metrics that are lambdas) are drawn here.
+    """
+    global _deferred_plots
+    dpi = dpi or DPI
+    reads_other_plots = lambda job: (job[0] in ['plot_normalized_error', 'plot_cumulative_normalized_error']
+                                      and job[2].get('avg_stats') is not None)
+    waves = [[job for job in jobs if not reads_other_plots(job)],
+             [job for job in jobs if reads_other_plots(job)]]
+    outer, _deferred_plots = _deferred_plots, None
+    try:
+        for wave in waves:
+            if n_jobs == 1:
+                for job in wave:
+                    _render_plot(job, dpi)
+                continue
+            picklable, local = [], []
+            for job in wave:
+                try:
+                    pickle.dumps(job)
+                    picklable.append(job)
+                except (pickle.PicklingError, AttributeError, TypeError):
+                    local.append(job)
+            Parallel(n_jobs=n_jobs)(delayed(_render_plot)(job, dpi) for job in picklable)
+            for job in local:
+                _render_plot(job, dpi)
+    finally:
+        _deferred_plots = outer
+
+def _render_plot(job, dpi):
+    " Draws one job from a deferred_plots queue, at module level so it can be sent to workers "
+    name, args, kwargs = job
+    globals()[name](*args, **dict(kwargs, dpi=dpi))
+    plt.close('all')
+
+@deferrable
+def make_train_test_plots(run, path, is_classification, label, model, train_X, test_X, groups=None, dpi=DPI):
     y_train_true, y_train_pred, y_test_true = \
         run['y_train_true'], run['y_train_pred'], run['y_test_true']
     y_test_pred, train_metrics, test_metrics = \
@@ -69,50 +150,50 @@ def make_train_test_plots(run, path, is_classification, label, model, train_X, t
         title = 'train_confusion_matrix'
         plot_confusion_matrix(y_train_true, y_train_pred,
                               join(path, title+'.png'), train_metrics,
-                              title=title)
+                              title=title, dpi=dpi)
         title = 'test_confusion_matrix'
         plot_confusion_matrix(y_test_true, y_test_pred,
                               join(path, title+'.png'), test_metrics,
-                              title=title)
+                              title=title, dpi=dpi)
         title = 'train_roc_curve'
-        plot_roc_curve(y_train_true, y_train_pred_proba, join(path, title+'png'))
+        plot_roc_curve(y_train_true, y_train_pred_proba, join(path, title+'png'), dpi=dpi)
         title = 'test_roc_curve'
-        plot_roc_curve(y_test_true, y_test_pred_proba, join(path, title+'png'))
+        plot_roc_curve(y_test_true, y_test_pred_proba, join(path, title+'png'), dpi=dpi)
         title = 'train_precision_recall_curve'
-        plot_precision_recall_curve(y_train_true, y_train_pred_proba, join(path, title+'png'))
+        plot_precision_recall_curve(y_train_true, y_train_pred_proba, join(path, title+'png'), dpi=dpi)
         title = 'test_precision_recall_curve'
-        plot_precision_recall_curve(y_test_true, y_test_pred_proba, join(path, title + 'png'))
+        plot_precision_recall_curve(y_test_true, y_test_pred_proba, join(path, title + 'png'), dpi=dpi)
     else: # is_regression
         plot_predicted_vs_true((y_train_true, y_train_pred, train_metrics, train_groups),
                           (y_test_true,  y_test_pred,  test_metrics, test_groups), 
-                          path, label=label)
+                          path, label=label, dpi=dpi)
 
         title = 'train_normalized_error'
-        plot_normalized_error(y_train_true, y_train_pred, join(path, title+'.png'), model, train_X)
+        plot_normalized_error(y_train_true, y_train_pred, join(path, title+'.png'), model, train_X, dpi=dpi)
 
         title = 'test_normalized_error'
-        plot_normalized_error(y_test_true, y_test_pred, join(path, title+'.png'), model, test_X)
+        plot_normalized_error(y_test_true, y_test_pred, join(path, title+'.png'), model, test_X, dpi=dpi)
 
         title = 'train_cumulative_normalized_error'
-        plot_cumulative_normalized_error(y_train_true, y_train_pred, join(path, title+'.png'), model, train_X)
+        plot_cumulative_normalized_error(y_train_true, y_train_pred, join(path, title+'.png'), model, train_X, dpi=dpi)
 
         title = 'test_cumulative_normalized_error'
-        plot_cumulative_normalized_error(y_test_true, y_test_pred, join(path, title+'.png'), model, test_X)
+        plot_cumulative_normalized_error(y_test_true, y_test_pred, join(path, title+'.png'), model, test_X, dpi=dpi)
 
         title = 'train_residuals_histogram'
         plot_residuals_histogram(y_train_true, y_train_pred,
                                  join(path, title+'.png'), train_metrics,
-                                 title=title, label=label)
+                                 title=title, label=label, dpi=dpi)
         title = 'test_residuals_histogram'
         plot_residuals_histogram(y_test_true,  y_test_pred,
                                  join(path, title+'.png'), test_metrics,
-                                 title=title, label=label)
+                                 title=title, label=label, dpi=dpi)
 
 ### Core plotting utilities:
 
 @ipynb_maker
 def plot_confusion_matrix(y_true, y_pred, savepath, stats, normalize=False,
-                          title='Confusion matrix', cmap=plt.cm.Blues):
+                          title='Confusion matrix', cmap=plt.cm.Blues, dpi=DPI):
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
@@ -153,10 +234,10 @@ def plot_confusion_matrix(y_true, y_pred, savepath, stats, normalize=False,
 
     ax.set_ylabel('True label')
     ax.set_xlabel('Predicted label')
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
 @ipynb_maker
-def plot_roc_curve(y_true, y_pred, savepath):
+def plot_roc_curve(y_true, y_pred, savepath, dpi=DPI):
     #TODO: have work when probability=False in model params. Suggest user set probability=True!!
     #classes = sorted(list(set(y_true).union(set(y_pred))))
     #n_classes = y_pred.shape[1]
@@ -185,10 +266,10 @@ def plot_roc_curve(y_true, y_pred, savepath):
     ax.set_ylabel('True Positive Rate', fontsize='16')
     ax.legend(loc="lower right", fontsize=12)
     #plot_stats(fig, stats, x_align=0.60, y_align=0.90)
-    fig.savefig(savepath, dpi=DPI, bbox_to_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_to_inches='tight')
 
 @ipynb_maker
-def plot_precision_recall_curve(y_true, y_pred, savepath):
+def plot_precision_recall_curve(y_true, y_pred, savepath, dpi=DPI):
     # Note this only works with probability predictions of the classifier labels.
     classes = list(np.unique(y_true))
 
@@ -213,12 +294,12 @@ def plot_precision_recall_curve(y_true, y_pred, savepath):
     ax.set_ylabel('Precision', fontsize='16')
     ax.legend(loc="upper right", fontsize=12)
     #plot_stats(fig, stats, x_align=0.60, y_align=0.90)
-    fig.savefig(savepath, dpi=DPI, bbox_to_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_to_inches='tight')
     return
 
 @ipynb_maker
 def plot_residuals_histogram(y_true, y_pred, savepath,
-                             stats, title='residuals histogram', label='residuals'):
+                             stats, title='residuals histogram', label='residuals', dpi=DPI):
 
     # make fig and ax, use x_align when placing text so things don't overlap
     x_align = 0.64
@@ -247,10 +328,11 @@ def plot_residuals_histogram(y_true, y_pred, savepath,
     plot_stats(fig, stats, x_align=x_align, y_align=0.90)
     plot_stats(fig, pd.DataFrame(residuals).describe().to_dict()[0], x_align=x_align, y_align=0.60)
 
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
+@deferrable
 @ipynb_maker
-def plot_target_histogram(y_df, savepath, title='target histogram', label='target values'):
+def plot_target_histogram(y_df, savepath, title='target histogram', label='target values', dpi=DPI):
 
     # make fig and ax, use x_align when placing text so things don't overlap
     x_align = 0.70
@@ -277,10 +359,10 @@ def plot_target_histogram(y_df, savepath, title='target histogram', label='targe
     savepath_parse = savepath.split('target_histogram.png')[0]
     y_df.describe().to_csv(savepath_parse+'/''input_data_statistics.csv')
 
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
 @ipynb_maker
-def plot_predicted_vs_true(train_quad, test_quad, outdir, label):
+def plot_predicted_vs_true(train_quad, test_quad, outdir, label, dpi=DPI):
     filenames = list()
     y_train_true, y_train_pred, train_metrics, train_groups = train_quad
     y_test_true, y_test_pred, test_metrics, test_groups = test_quad
@@ -343,11 +425,12 @@ def plot_predicted_vs_true(train_quad, test_quad, outdir, label):
 
         filename = 'predicted_vs_true_'+ title_addon + '.png'
         filenames.append(filename)
-        fig.savefig(join(outdir, filename), dpi=DPI, bbox_inches='tight')
+        fig.savefig(join(outdir, filename), dpi=dpi, bbox_inches='tight')
 
     return filenames
 
-def plot_scatter(x, y, savepath, groups=None, xlabel='x', ylabel='y', label='target data'):
+@deferrable
+def plot_scatter(x, y, savepath, groups=None, xlabel='x', ylabel='y', label='target data', dpi=DPI):
     # Set image aspect ratio:
     fig, ax = make_fig_ax()
 
@@ -388,11 +471,12 @@ def plot_scatter(x, y, savepath, groups=None, xlabel='x', ylabel='y', label='tar
 
     ax.set_xlabel(xlabel, fontsize=16)
     ax.set_ylabel('Value of '+label, fontsize=16)
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
+@deferrable
 @ipynb_maker
 def plot_best_worst_split(y_true, best_run, worst_run, savepath,
-                          title='Best Worst Overlay', label='target_value'):
+                          title='Best Worst Overlay', label='target_value', dpi=DPI):
 
     # make fig and ax, use x_align when placing text so things don't overlap
     x_align = 0.64
@@ -429,11 +513,12 @@ def plot_best_worst_split(y_true, best_run, worst_run, savepath,
     plot_stats(fig, best_stats, x_align=x_align, y_align=0.90)
     plot_stats(fig, worst_stats, x_align=x_align, y_align=0.60)
 
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
+@deferrable
 @ipynb_maker
 def plot_best_worst_per_point(y_true, y_pred_list, savepath, metrics_dict,
-                              avg_stats, title='best worst per point', label='target_value'):
+                              avg_stats, title='best worst per point', label='target_value', dpi=DPI):
     worsts = []
     bests = []
     new_y_true = []
@@ -484,11 +569,12 @@ def plot_best_worst_per_point(y_true, y_pred_list, savepath, metrics_dict,
     plot_stats(fig, worst_stats, x_align=x_align, y_align=0.73, fontsize=10)
     plot_stats(fig, best_stats, x_align=x_align, y_align=0.95, fontsize=10)
 
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
+@deferrable
 @ipynb_maker
 def plot_predicted_vs_true_bars(y_true, y_pred_list, avg_stats,
-                                savepath, title='best worst with bars', label='target_value'):
+                                savepath, title='best worst with bars', label='target_value', dpi=DPI):
     " EVERYTHING MUST BE ARRAYS DONT GIVE ME DEM DF "
     means = [nice_mean(y_pred) for y_pred in y_pred_list]
     standard_error_means = [nice_std(y_pred)/np.sqrt(len(y_pred))
@@ -523,9 +609,10 @@ def plot_predicted_vs_true_bars(y_true, y_pred_list, avg_stats,
 
     plot_stats(fig, avg_stats, x_align=x_align, y_align=0.90)
 
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
 
-def plot_metric_vs_group(metric, groups, stats, avg_stats, savepath):
+@deferrable
+def plot_metric_vs_group(metric, groups, stats, avg_stats, savepath, dpi=DPI):
     # make fig and ax, use x_align when placing text so things don't overlap
     x_align = 0.64
     fig, ax = make_fig_ax(x_align=x_align)
@@ -543,41 +630,16 @@ def plot_metric_vs_group(metric, groups, stats, avg_stats, savepath):
     savepath_parse = savepath.split(str(metric)+'_vs_group.png')[0]
     pd.DataFrame(groups, stats).to_csv(os.path.join(savepath_parse, str(metric)+'_vs_group.csv'))
 
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
     return
 
-# Prediction intervals adapted from https://blog.datadive.net/prediction-intervals-for-random-forests/
-def prediction_intervals(model, X, percentile=68):
-    err_down = list()
-    err_up = list()
-    X_aslist = X.values.tolist()
-    for x in range(len(X_aslist)):
-        preds = list()
-        if model.__class__.__name__=='RandomForestRegressor':
-            for pred in model.estimators_:
-                preds.append(pred.predict(np.array(X_aslist[x]).reshape(1,-1))[0])
-
-        elif model.__class__.__name__=='GaussianProcessRegressor':
-            preds = model.predict(X, return_std=True)
-
-        e_down = np.percentile(preds, (100 - percentile) / 2. )
-        e_up = np.percentile(preds, 100 - (100 - percentile) / 2.)
-        if e_up == 0.0:
-            e_up = 10**10
-        if e_down == 0.0:
-            e_down = 10**10
-        err_down.append(e_down)
-        err_up.append(e_up)
-    return err_down, err_up
-
-def plot_normalized_error(y_true, y_pred, savepath, model, X=None, avg_stats=None):
+@deferrable
+def plot_normalized_error(y_true, y_pred, savepath, model, X=None, avg_stats=None, dpi=DPI):
     path = os.path.dirname(savepath)
     # Here: if model is random forest or Gaussian process, get real error bars. Else, just residuals
-    model_name = model.__class__.__name__
     # TODO: also add support for Gradient Boosted Regressor
-    models_with_error_predictions = ['RandomForestRegressor', 'GaussianProcessRegressor']
     has_model_errors = False
-    if model_name in models_with_error_predictions:
+    if has_prediction_intervals(model):
         has_model_errors = True
         if not avg_stats:
             err_down, err_up = prediction_intervals(model, X, percentile=68)
@@ -642,17 +704,16 @@ def plot_normalized_error(y_true, y_pred, savepath, model, X=None, avg_stats=Non
     ax.set_xlabel(r"$\mathrm{x}/\mathit{\sigma}$", fontsize=18)
     ax.set_ylabel("Probability density", fontsize=18)
     _set_tick_labels_different(ax, maxx, minn, maxy, miny)
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
     return
 
-def plot_cumulative_normalized_error(y_true, y_pred, savepath, model, X=None, avg_stats=None):
+@deferrable
+def plot_cumulative_normalized_error(y_true, y_pred, savepath, model, X=None, avg_stats=None, dpi=DPI):
     path = os.path.dirname(savepath)
     # Here: if model is random forest or Gaussian process, get real error bars. Else, just residuals
-    model_name = model.__class__.__name__
     # TODO: also add support for Gradient Boosted Regressor
-    models_with_error_predictions = ['RandomForestRegressor', 'GaussianProcessRegressor']
     has_model_errors = False
-    if model_name in models_with_error_predictions:
+    if has_prediction_intervals(model):
         has_model_errors = True
         if not avg_stats:
             err_down, err_up = prediction_intervals(model, X, percentile=68)
@@ -746,10 +807,10 @@ def plot_cumulative_normalized_error(y_true, y_pred, savepath, model, X=None, av
     _set_tick_labels_different(ax, maxx, minn, maxy, miny)
 
     mark_inset(ax, axin, loc1=1, loc2=2)
-    fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
     return
 
-def plot_1d_heatmap(xs, heats, savepath, xlabel='x', heatlabel='heats'):
+def plot_1d_heatmap(xs, heats, savepath, xlabel='x', heatlabel='heats', dpi=DPI):
     # Escape from error of passing tuples when optimzing neural net
     #TODO have more general solution
     try:
@@ -758,13 +819,13 @@ def plot_1d_heatmap(xs, heats, savepath, xlabel='x', heatlabel='heats'):
         ax.set_xlabel(xlabel)
         ax.set_ylabel(heatlabel)
 
-        fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+        fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
     except TypeError:
         pass
 
 
 def plot_2d_heatmap(xs, ys, heats, savepath,
-                    xlabel='x', ylabel='y', heatlabel='heat'):
+                    xlabel='x', ylabel='y', heatlabel='heat', dpi=DPI):
     # Escape from error of passing tuples when optimzing neural net
     #TODO have more general solution
     try:
@@ -775,12 +836,12 @@ def plot_2d_heatmap(xs, ys, heats, savepath,
         cb = fig.colorbar(scat)
         cb.set_label(heatlabel)
 
-        fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+        fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
     except TypeError:
         pass
 
 def plot_3d_heatmap(xs, ys, zs, heats, savepath,
-                    xlabel='x', ylabel='y', zlabel='z', heatlabel='heat'):
+                    xlabel='x', ylabel='y', zlabel='z', heatlabel='heat', dpi=DPI):
     # Escape from error of passing tuples when optimzing neural net
     # TODO have more general solution
     try:
@@ -800,7 +861,7 @@ def plot_3d_heatmap(xs, ys, zs, heats, savepath,
         cb = fig.colorbar(scat)
         cb.set_label(heatlabel)
 
-        fig.savefig(savepath, dpi=DPI, bbox_inches='tight')
+        fig.savefig(savepath, dpi=dpi, bbox_inches='tight')
     except TypeError:
         pass
 
@@ -811,7 +872,8 @@ def plot_3d_heatmap(xs, ys, zs, heats, savepath,
     #anim.save(savepath+'.mp4', fps=5, extra_args=['-vcodec', 'libx264'])
     anim.save(savepath+'.gif', fps=5, dpi=80, writer='imagemagick')
 
-def plot_learning_curve(train_sizes, train_mean, test_mean, train_stdev, test_stdev, score_name, learning_curve_type, savepath='data_learning_curve'):
+@deferrable
+def plot_learning_curve(train_sizes, train_mean, test_mean, train_stdev, test_stdev, score_name, learning_curve_type, savepath='data_learning_curve', dpi=DPI):
 
     # Set image aspect ratio (do custom for learning curve):
     w, h = figaspect(0.75)
@@ -853,16 +915,16 @@ def plot_learning_curve(train_sizes, train_mean, test_mean, train_stdev, test_st
     else:
         raise ValueError('The param "learning_curve_type" must be either "sample_learning_curve" or "feature_learning_curve"')
     ax.set_ylabel(score_name, fontsize=16)
-    fig.savefig(savepath+'.png', dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath+'.png', dpi=dpi, bbox_inches='tight')
 
     # Save output data to spreadsheet
     df_concat = pd.concat([pd.DataFrame(train_sizes), pd.DataFrame(train_mean), pd.DataFrame(train_stdev),
                            pd.DataFrame(test_mean), pd.DataFrame(test_stdev)], 1)
     df_concat.columns = ['train_sizes', 'train_mean', 'train_stdev', 'test_mean', 'test_stdev']
     df_concat.to_csv(savepath+'.csv')
-    plot_learning_curve_convergence(train_sizes, test_mean, score_name, learning_curve_type, savepath)
+    plot_learning_curve_convergence(train_sizes, test_mean, score_name, learning_curve_type, savepath, dpi=dpi)
 
-def plot_learning_curve_convergence(train_sizes, test_mean, score_name, learning_curve_type, savepath):
+def plot_learning_curve_convergence(train_sizes, test_mean, score_name, learning_curve_type, savepath, dpi=DPI):
     # Function to examine the minimization of error in learning curve CV scores as function of amount of data or number
     # of features used.
     steps = [x for x in range(len(train_sizes))]
@@ -899,7 +961,7 @@ def plot_learning_curve_convergence(train_sizes, test_mean, score_name, learning
     ax.legend(['score slope', 'smoothed score slope'], loc='lower right', fontsize=12)
     ax.set_xlabel('Learning curve step', fontsize=16)
     ax.set_ylabel('Change in '+score_name, fontsize=16)
-    fig.savefig(savepath+'_convergence'+'.png', dpi=DPI, bbox_inches='tight')
+    fig.savefig(savepath+'_convergence'+'.png', dpi=dpi, bbox_inches='tight')
 
     if learning_curve_type == 'feature_learning_curve':
         # First, set number optimal features to all features in case stopping criteria not met
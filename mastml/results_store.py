@@ -0,0 +1,136 @@
+"""
+Module for storing the predictions of every split of a run in one file, instead of writing a
+train.csv and test.csv (each with a copy of the features) into every split directory.
+
+For each (normalizer, selector, model, splitter) combo the store keeps the index labels of its
+rows and the names of its feature columns once, and for each split only the train/test row labels,
+predictions and the feature columns its model saw. Every array is a .npy member of a zip archive
+that is appended to as the splits come in, so it can be read with np.load like any .npz file.
+The old csvs can be rebuilt from it and the combo's selected.csv with SplitPredictions.to_frame and
+SplitPredictions.export_csvs, except for combos fit with fold_preprocessing, whose features differ
+per split and are only kept in the split csvs.
+"""
+
+import os
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+STORE_NAME = 'split_predictions.npz'
+
+def add_combo(path, combo, X, fold_preprocessed=False):
+    """
+    Records the row labels and feature columns of the dataframe combo is fit on. With
+    fold_preprocessed, every split was fit on features normalized and selected on its own training
+    rows (see fold_pipeline), which aren't stored, so X only gives the row labels.
+    """
+    _append_arrays(path, combo, OrderedDict(index=X.index.values,
+                                            x_columns=np.array([str(c) for c in X.columns]),
+                                            fold_preprocessed=np.array(fold_preprocessed)))
+
+def add_split(path, combo, split_num, split_result, validation_indices=None, x_columns=None):
+    """
+    Records the row labels and predictions of one split's split_result, the feature columns
+    (x_columns) its model was fit on, and the predictions for the prediction only rows of each
+    validation column in validation_indices (column name -> row labels)
+    """
+    arrays = OrderedDict(train_index=split_result['train_indices'],
+                         train_pred=split_result['y_train_pred'],
+                         test_index=split_result['test_indices'],
+                         test_pred=split_result['y_test_pred'])
+    if x_columns is not None:
+        arrays['x_columns'] = np.array([str(c) for c in x_columns])
+    for name, indices in (validation_indices or dict()).items():
+        arrays['validation_index_' + str(name)] = indices
+        arrays['validation_pred_' + str(name)] = split_result['y_validation_pred_' + str(name)]
+    _append_arrays(path, f'{combo}/split_{split_num}', arrays)
+
+def _append_arrays(path, prefix, arrays):
+    # the archive is closed after every append, so whatever was stored before a crash is readable
+    with zipfile.ZipFile(path, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, array in arrays.items():
+            with zf.open(f'{prefix}/{name}.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=True)
+
+class SplitPredictions:
+    """
+    Reads a store written by add_combo and add_split. Combos are named by their path relative to
+    the run's output directory, with '/' separators, like 'DoNothing/DoNothing/KernelRidge/KFold'.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.outdir = os.path.dirname(os.path.abspath(path))
+        self._npz = np.load(path, allow_pickle=True)
+        self._selected = dict()
+
+    def combos(self):
+        return sorted({name.rsplit('/', 1)[0] for name in self._npz.files
+                       if name.endswith('/index')})
+
+    def split_nums(self, combo):
+        prefix = combo + '/split_'
+        return sorted({int(name[len(prefix):].split('/')[0]) for name in self._npz.files
+                       if name.startswith(prefix)})
+
+    def fold_preprocessed(self, combo):
+        " Whether combo's splits were each fit on their own normalized and selected features "
+        name = combo + '/fold_preprocessed'
+        return name in self._npz.files and bool(self._npz[name])
+
+    def get(self, combo, split_num):
+        " Dict of everything stored for one split, like train_index and test_pred "
+        prefix = f'{combo}/split_{split_num}/'
+        return OrderedDict((name[len(prefix):], self._npz[name]) for name in self._npz.files
+                           if name.startswith(prefix))
+
+    def to_frame(self, combo, split_num, kind='test'):
+        """
+        Rebuilds the dataframe that used to be saved as split_<split_num>/<kind>.csv, where kind is
+        'train', 'test' or 'predictions_<validation column name>'. The features, targets and
+        non-input columns are read from the combo's selected.csv.
+        Combos fit with fold_preprocessing can't be rebuilt: each split saw its own features,
+        which are only saved when the run has split_csvs on.
+        """
+        if self.fold_preprocessed(combo):
+            raise ValueError(f"'{combo}' was fit with fold_preprocessing, so its splits' features aren't "
+                             f"in the store. Rerun with [GeneralSetup] split_csvs = True to save them.")
+        X, y, X_noinput = self._combo_data(combo)
+        split = self.get(combo, split_num)
+        if kind in ['train', 'test']:
+            indices, pred_name = split[kind + '_index'], kind + '_pred'
+            predictions = pd.DataFrame(split[pred_name], columns=[pred_name], index=indices)
+            return pd.concat([X.loc[indices], y.loc[indices], predictions,
+                              X_noinput.loc[indices]], axis=1)
+        if kind.startswith('predictions_'):
+            name = kind[len('predictions_'):]
+            indices = split['validation_index_' + name]
+            predictions = pd.Series(split['validation_pred_' + name], name='clean_predictions', index=indices)
+            return pd.concat([X.loc[indices], y.loc[indices], predictions], axis=1)
+        raise ValueError(f"Unknown kind '{kind}', expected 'train', 'test' or 'predictions_<name>'")
+
+    def export_csvs(self, combo=None):
+        " Writes the old train.csv, test.csv and predictions_*.csv files of combo (default: all combos) "
+        for combo_name in ([combo] if combo is not None else self.combos()):
+            for split_num in self.split_nums(combo_name):
+                path = os.path.join(self.outdir, *combo_name.split('/'), f'split_{split_num}')
+                os.makedirs(path, exist_ok=True)
+                kinds = ['train', 'test'] + ['predictions_' + name[len('validation_index_'):]
+                                             for name in self.get(combo_name, split_num)
+                                             if name.startswith('validation_index_')]
+                for kind in kinds:
+                    self.to_frame(combo_name, split_num, kind).to_csv(os.path.join(path, kind + '.csv'),
+                                                                      index=False)
+
+    def _combo_data(self, combo):
+        " (X, y, X_noinput) of combo, read from selected.csv and labelled with the stored index "
+        normalizer_selector = tuple(combo.split('/')[:2])
+        if normalizer_selector not in self._selected:
+            self._selected[normalizer_selector] = pd.read_csv(
+                    os.path.join(self.outdir, *normalizer_selector, 'selected.csv'),
+                    float_precision='round_trip')
+        data = self._selected[normalizer_selector].copy(deep=False)
+        data.index = self._npz[combo + '/index']
+        n_features = len(self._npz[combo + '/x_columns'])
+        return data.iloc[:, :n_features], data.iloc[:, -1], data.iloc[:, n_features:-1]
@@ -8,8 +8,9 @@ import numpy as np
 import os
 import time
 import logging
+import json
 
-from .grid_search import GridSearch
+from .grid_search import GridSearch, load_fitness_cache
 
 logger = logging.getLogger('mastml')
 
@@ -58,6 +59,8 @@ class GeneticSearch(GridSearch):
         mutation_prob (float): Mutation probability (float < 1.00)
         shift_prob (float): Shift probability (float < 1.00)
         gen_tol (float): Generation-to-generation RMSE tolerance for considering RMSEs to be equal (absolute float tolerance)
+        fitness_cache_file (str): File to keep every evaluated genome's RMSE in. A rerun pointed at the same file
+            skips the genomes it already has, so an interrupted search can resume.
 
     Returns:
         Analysis in save_path folder
@@ -69,7 +72,8 @@ class GeneticSearch(GridSearch):
                  num_folds=None, percent_leave_out=None, num_cvtests=20, mark_outlying_points='0,3',
                  num_bests=10, fix_random_for_testing=0, processors=1, pop_upper_limit=1000000,
                  num_gas=1, ga_pop_size=50, convergence_generations=30, max_generations=200,
-                 crossover_prob=0.5, mutation_prob=0.1, shift_prob=0.5, gen_tol=0.00000001):
+                 crossover_prob=0.5, mutation_prob=0.1, shift_prob=0.5, gen_tol=0.00000001,
+                 fitness_cache_file=None):
         """
             Additional class attributes not in parent class:
            
@@ -84,6 +88,7 @@ class GeneticSearch(GridSearch):
             self.mutation_prob
             self.shift_prob
             self.gen_tol
+            self.fitness_cache_file
             Set by code:
             self.random_state <numpy RandomState>: random state
             self.ga_dict 
@@ -121,6 +126,14 @@ class GeneticSearch(GridSearch):
         #
         self.ga_dict = dict()
         self.gact = 0
+        # RMSEs of every genome evaluated so far, shared by all generations of all the GAs
+        self.fitness_cache_file = fitness_cache_file
+        self.fitness_cache, self.splitter_seed = load_fitness_cache(fitness_cache_file)
+        if self.fitness_cache_file is not None and self.splitter_seed is None:
+            # the fitness keys include the cv splits, so a resumed run must shuffle the same ones
+            self.splitter_seed = self.random_state.randint(2**31)
+            with open(self.fitness_cache_file, 'a') as cache_file:
+                cache_file.write(json.dumps(dict(splitter_seed=int(self.splitter_seed))) + "\n")
         return
 
     def set_up_generation(self, genct=0):
@@ -144,6 +157,13 @@ class GeneticSearch(GridSearch):
             processors = self.processors,
             pop_upper_limit = self.pop_upper_limit,
             num_bests = self.num_bests)
+        # every generation is scored on the same splits, by the same workers, which already have the data
+        mygen.splitter = self.get_splitter()
+        mygen.data_fingerprint = self.get_data_fingerprint()
+        mygen.fitness_cache = self.fitness_cache
+        mygen.fitness_cache_file = self.fitness_cache_file
+        if self.processors > 1:
+            mygen.worker_pool = self.get_worker_pool()
         return mygen
 
     def get_parent_params(self, prev_gen):
@@ -161,9 +181,9 @@ class GeneticSearch(GridSearch):
         if safety_ct == 1000:
             raise ValueError("Error generating parents. Reached 1000 random integers, all identical in second parent.")
         if prev_gen is None:
-            pop_keys = list(self.pop_params.keys()) #these keys are combinatorial, not by count
-            p1_params = self.pop_params[pop_keys[p1idx]]
-            p2_params = self.pop_params[pop_keys[p2idx]]
+            # decoded straight from the grid, which is never enumerated
+            p1_params = self.pop_params.params_at(p1idx)
+            p2_params = self.pop_params.params_at(p2idx)
         else:
             # NOTE: i think we are actually not even getting the right individuals
             p1_params = prev_gen.best_indivs[p1idx][2] #params in third column
@@ -323,9 +343,12 @@ class GeneticSearch(GridSearch):
     def run(self):
         self.set_up()
         self.readme_list.append("===== GA info =====\n")
-        for ga in range(0, self.num_gas):
-            self.run_ga()
-            self.print_ga(ga)
+        try:
+            for ga in range(0, self.num_gas):
+                self.run_ga()
+                self.print_ga(ga)
+        finally:
+            self.close_worker_pool()
         self.select_final_best()
         self.print_final_results()
         return
@@ -5,6 +5,8 @@ __email__ = 'rjacobs3@wisc.edu'
 __date__ = 'October 14th, 2017'
 
 import os
+import hashlib
+import json
 import numpy as np
 import pandas as pd
 import copy
@@ -12,13 +14,20 @@ import logging
 import sys
 import time
 import itertools
+import heapq
+from collections.abc import Mapping
 from sklearn.externals import joblib
 import sklearn.model_selection
+import sklearn.metrics
+import sklearn.linear_model
 
 from .. import plot_helper
 
 logger = logging.getLogger('mastml')
 
+# How many individuals evaluate_indivs decodes and sends out at a time
+EVALUATION_CHUNK = 4096
+
 class GridSearch:
     """Class to perform parameter optimization by grid search. Only up to 4 parameters may be optimized at a time.
 
@@ -57,6 +66,16 @@ class GridSearch:
         num_bests (int): Number of best individuals to track
         processors (int): Number of processors to use 1 - single processor (serial); 2 - use multiprocessing with this many processors, all on a SINGLE node
         pop_upper_limit (int): Upper limit for population size.
+        halving_factor (int): Leave blank to score every individual on all of the data. Otherwise use successive
+            halving: every individual is first scored on a small random subsample of the data, and only the best
+            1/halving_factor of them are scored again on halving_factor times as many rows, until the survivors,
+            never fewer than num_bests, are scored on all of it. Only their rmses are plotted.
+        halving_min_rows (int): Fewest rows any individual is scored on when halving_factor is set.
+        warm_start (bool): Fit individuals that differ only in n_estimators (for ensembles) or alpha (for Lasso and
+            ElasticNet) as one path on each cv split, growing the ensemble or shrinking alpha with the model's
+            warm_start, instead of fitting each from scratch. Splits never share a fit. Only used when the model's
+            random_state is an int (or, for Lasso and ElasticNet, selection is 'cyclic'), since only then does the
+            path give the same rmses as fitting from scratch.
 
     Returns:
         Analysis in the save_path folder
@@ -69,7 +88,8 @@ class GridSearch:
     def __init__(self, param_strings, training_dataset, testing_dataset, model,
                  save_path=None, xlabel="Measured", ylabel="Predicted", fix_random_for_testing=0,
                  num_cvtests=5, mark_outlying_points='0,3', num_folds=None, percent_leave_out=None,
-                 processors=1, pop_upper_limit=1000000, num_bests=10):
+                 processors=1, pop_upper_limit=1000000, num_bests=10, halving_factor=None,
+                 halving_min_rows=20, warm_start=False):
         """
         Additional class attributes to parent class:
             Set by keyword:
@@ -81,6 +101,9 @@ class GridSearch:
                 self.processors
                 self.pop_upper_limit
                 self.num_bests
+                self.halving_factor
+                self.halving_min_rows
+                self.warm_start
                 self.param_strings
             Set in code:
                 self.opt_dict
@@ -91,8 +114,15 @@ class GridSearch:
                 self.pop_size
                 self.pop_stats
                 self.pop_rmses
+                self.pop_budgets
                 self.best_indivs
                 self.best_params
+                self.splitter
+                self.splitter_seed
+                self.data_fingerprint
+                self.fitness_cache
+                self.fitness_cache_file
+                self.worker_pool
                 ?self.random_state
         """
         if not(training_dataset == testing_dataset):
@@ -117,6 +147,11 @@ class GridSearch:
         self.processors=int(processors)
         self.pop_upper_limit = int(pop_upper_limit)
         self.num_bests = int(num_bests)
+        self.halving_factor = None if halving_factor is None else int(halving_factor)
+        if self.halving_factor is not None and self.halving_factor < 2:
+            raise ValueError("halving_factor must be at least 2.")
+        self.halving_min_rows = int(halving_min_rows)
+        self.warm_start = warm_start
 
         ### MARK Don't do this
         #self.param_strings = dict()
@@ -135,9 +170,17 @@ class GridSearch:
         self.pop_size=None
         self.pop_stats=None
         self.pop_rmses=None
+        self.pop_budgets=None # rows each individual was last scored on, only when halving
         self.flat_results=None
         self.best_indivs=None
         self.best_params=None
+        self.splitter=None # see get_splitter
+        self.splitter_seed=None # random_state of a ShuffleSplit splitter, drawn in get_splitter unless set
+        self.data_fingerprint=None # see get_data_fingerprint
+        self.fitness_cache=dict() # fitness key -> rmse, see get_fitness_key
+        self.fitness_cache_file=None # where fitness_cache is also written to, if anywhere
+        self.worker_pool=None # see get_worker_pool
+        self.owns_worker_pool=False
         return
 
     ### SingleFit section
@@ -239,7 +282,10 @@ class GridSearch:
 
     def run(self):
         self.set_up()
-        self.evaluate_pop()
+        try:
+            self.evaluate_pop()
+        finally:
+            self.close_worker_pool()
         self.get_best_indivs()
         self.print_results()
         self.plot()
@@ -274,92 +320,266 @@ class GridSearch:
         """
         self.pop_stats=dict()
         self.pop_rmses=dict()
+        if self.halving_factor is None:
+            self.evaluate_indivs(self.pop_params.keys())
+        else:
+            self.evaluate_pop_halving()
+        return
+
+    def evaluate_pop_halving(self):
+        """Successive halving: score the population on a random subsample of the rows, keep the
+            best 1/halving_factor, and repeat on halving_factor times more rows until the
+            survivors have been scored on every row. At least num_bests individuals survive to the
+            end, so there are as many best individuals as without halving. Individuals keep the
+            rmse of the last rung they reached, and self.pop_budgets records how many rows that was.
+        """
+        n_rows = len(self.testing_dataset.data)
+        # the whole population to begin with, without listing its keys
+        survivors = self.pop_params
+        n_survivors = len(self.pop_params)
+        # the number of eliminations that leave at least n_final survivors
+        n_final = max(1, min(self.num_bests, n_survivors))
+        n_rungs = int(np.floor(np.log(n_survivors / n_final) / np.log(self.halving_factor)))
+        self.pop_budgets = dict()
+        for rung in range(n_rungs + 1):
+            n_sub = int(round(n_rows * float(self.halving_factor)**(rung - n_rungs)))
+            n_sub = max(n_sub, self.halving_min_rows)
+            if n_sub >= n_rows or rung == n_rungs:
+                rows = None
+                n_sub = n_rows
+            else:
+                rows = np.sort(self.random_state.choice(n_rows, n_sub, replace=False))
+            logger.debug(f'Halving rung {rung}: scoring {n_survivors} individuals on {n_sub}/{n_rows} rows')
+            self.evaluate_indivs(survivors, rows)
+            for ikey in survivors:
+                self.pop_budgets[ikey] = n_sub
+            if rows is None:
+                break
+            n_survivors = max(n_final, int(np.ceil(n_survivors / self.halving_factor)))
+            survivors = heapq.nsmallest(n_survivors, survivors, key=self.pop_rmses.__getitem__)
+        return
+
+    def evaluate_indivs(self, ikeys, rows=None):
+        """Evaluate the individuals ikeys of the population into self.pop_rmses, using only the
+            data rows given, or all of them if None.
+            Genomes already in self.fitness_cache, or repeated within ikeys, are only
+            evaluated once. ikeys is read EVALUATION_CHUNK at a time, so however large the
+            population, only one chunk of it is ever decoded into params at once.
+        """
+        ikeys = iter(ikeys)
+        n_evaluated = 0
+        while True:
+            chunk = list(itertools.islice(ikeys, EVALUATION_CHUNK))
+            if len(chunk) == 0:
+                break
+            self.evaluate_chunk(chunk, rows)
+            n_evaluated += len(chunk)
+        logger.debug(f'finished generation of {n_evaluated} individuals.')
+        return
+
+    def evaluate_chunk(self, ikeys, rows=None):
+        """Evaluate the list of individuals ikeys, see evaluate_indivs
+        """
+        to_evaluate = dict() # fitness key -> keys of the individuals with that genome
+        for ikey in ikeys:
+            fitness_key = self.get_fitness_key(self.pop_params[ikey], rows)
+            if fitness_key in self.fitness_cache:
+                self.save_indiv(self.pop_params[ikey], ikey)
+                self.pop_rmses[ikey] = self.fitness_cache[fitness_key]
+            else:
+                to_evaluate.setdefault(fitness_key, list()).append(ikey)
+        logger.debug(f'{len(ikeys) - sum(len(keys) for keys in to_evaluate.values())}/{len(ikeys)} '
+                     f'individuals found in fitness cache, evaluating {len(to_evaluate)} new genomes.')
+
+        def record(fitness_key, indiv_rmse, indiv_stats):
+            self.record_fitness(fitness_key, indiv_rmse)
+            for ikey in to_evaluate[fitness_key]:
+                self.save_indiv(self.pop_params[ikey], ikey)
+                if indiv_stats: # nothing else is kept per individual, so a large grid stays small
+                    self.pop_stats[ikey] = indiv_stats
+                self.pop_rmses[ikey] = indiv_rmse
+
+        # each task is a list of genomes, and the parameter they are fit along if there are several
+        path_param = self.get_warm_start_param()
+        if path_param is None:
+            tasks = [([fitness_key], None) for fitness_key in to_evaluate]
+        else:
+            tasks = self.get_warm_start_paths(to_evaluate, path_param)
 
         if self.processors == 1:
-            for ikey in self.pop_params.keys():
-                #sys.stdout.write("\rIndividual %s/%i" % (ikey, self.pop_size)) # loading bar HACK
-                sys.stdout.write(f"\rMaking individuals [{'+'*int(ikey)}{'-'*(self.pop_size-int(ikey))}]") # loading bar HACK
+            for pop_done, (fitness_keys, task_path_param) in enumerate(tasks):
+                sys.stdout.write(f"\rMaking individuals [{'+'*pop_done}{'-'*(len(tasks)-pop_done)}]") # loading bar HACK
                 sys.stdout.flush()
-                indiv_params = self.pop_params[ikey]
-                [indiv_rmse, indiv_stats] = self.evaluate_indiv(indiv_params, ikey)
-                self.pop_stats[ikey] = indiv_stats
-                self.pop_rmses[ikey] = indiv_rmse
+                if task_path_param is None:
+                    fitness_key = fitness_keys[0]
+                    indiv_params = self.pop_params[to_evaluate[fitness_key][0]]
+                    [indiv_rmse, indiv_stats] = self.evaluate_indiv(indiv_params, to_evaluate[fitness_key][0], rows)
+                    record(fitness_key, indiv_rmse, indiv_stats)
+                    continue
+                path_params = [self.pop_params[to_evaluate[fitness_key][0]] for fitness_key in fitness_keys]
+                X, y = self.get_indiv_data(path_params[0])
+                if rows is not None:
+                    X, y = X[rows], y[rows]
+                path_rmses = _cv_rmses_along_path(self.model, path_params, task_path_param, X, y, self.get_splitter())
+                for fitness_key, indiv_rmse in zip(fitness_keys, path_rmses):
+                    record(fitness_key, indiv_rmse, dict())
             print()
-            logger.debug(f'finished generation of {self.pop_size} individuals.')
         else:
-            from multiprocessing import Process, Manager
-            manager = Manager()
-            pop_stats_dict = manager.dict()
-            pop_rmses_dict = manager.dict()
-            pop_done = manager.Value('i',0)
-            #create a number of lists each with the size of number of processors
-            pop_keys = list(self.pop_params.keys())
-            num_lists = int(np.ceil(self.pop_size/self.processors)) #round up
-            flat_lists = list()
-            pkct = 0
-            for listct in range(0, num_lists):
-                flat_list = list()
-                for item_ct in range(0, self.processors):
-                    if pkct < self.pop_size: #last list may have fewer entries
-                        flat_list.append(pop_keys[pkct])
-                        pkct = pkct + 1
-                flat_lists.append(flat_list)
-            for listct in range(0, num_lists):
-                pkey_list = flat_lists[listct]
-                indiv_p_list = list()
-                for iidx in range(0, len(pkey_list)):
-                    ikey = pkey_list[iidx]
-                    logger.debug("Individual %s/%i" % (ikey, self.pop_size))
-                    indiv_params = self.pop_params[ikey]
-                    indiv_p = Process(target=self.evaluate_indiv_multiprocessing, args=(indiv_params, ikey, pop_stats_dict, pop_rmses_dict, pop_done))
-                    indiv_p_list.append(indiv_p)
-                    indiv_p.start()
-                for indiv_p in indiv_p_list:
-                    indiv_p.join()
-            self.pop_stats = pop_stats_dict
-            self.pop_rmses = pop_rmses_dict
+            # Idle workers pull the next individual as soon as they finish one, and results are
+            # recorded in whatever order they come back. Tasks only name their individuals, which
+            # the workers decode from the grid themselves.
+            def make_task(fitness_keys, task_path_param):
+                indiv_keys = [to_evaluate[fitness_key][0] for fitness_key in fitness_keys]
+                return (fitness_keys, indiv_keys, self.get_params_source(indiv_keys), task_path_param, rows)
+            # sent in chunks, since one individual of a large grid is often quicker to fit than to ship
+            chunksize = max(1, len(tasks) // (4*self.processors))
+            for pop_done, task_results in enumerate(self.get_worker_pool().imap_unordered(
+                    _evaluate_indiv_in_worker, itertools.starmap(make_task, tasks), chunksize)):
+                for fitness_key, indiv_rmse, indiv_stats in task_results:
+                    record(fitness_key, indiv_rmse, indiv_stats)
+                logger.debug("Individual %s done (multiprocessing), %i/%i" % (to_evaluate[fitness_key][0], pop_done+1, len(tasks)))
+        return
+
+    def get_params_source(self, ikeys):
+        """What a worker looks the params of individuals ikeys up in: the grid itself, which is
+            only its value arrays, or else a dict of just those individuals
+        """
+        if isinstance(self.pop_params, ParamGrid):
+            return self.pop_params
+        return {ikey: self.pop_params[ikey] for ikey in ikeys}
+
+    def get_warm_start_param(self):
+        """The model parameter individuals can be fit along with warm starts, if warm_start is on
+            and the model and the searched parameters allow it, else None
+        """
+        if not self.warm_start:
+            return None
+        model_params = self.model.get_params()
+        if 'warm_start' not in model_params:
+            return None
+        # growing a seeded ensemble only adds the members a fit from scratch would have made, and
+        # coordinate descent converges to the same optimum (within tol) from any start. Unseeded
+        # models draw the added members from a different random stream, so they fit from scratch.
+        seeded = isinstance(model_params.get('random_state'), (int, np.integer))
+        if 'model.n_estimators' in self.opt_param_list and 'n_estimators' in model_params and seeded:
+            return 'n_estimators'
+        if ('model.alpha' in self.opt_param_list and isinstance(self.model, sklearn.linear_model.ElasticNet)
+                and (seeded or model_params['selection'] == 'cyclic')):
+            return 'alpha'
+        return None
+
+    def get_warm_start_paths(self, to_evaluate, path_param):
+        """Groups the genomes in to_evaluate that differ only in path_param into (fitness keys,
+            path_param) tasks, in the order they're fit: n_estimators up, alpha down. Genomes
+            alone in their group become ([fitness key], None) tasks.
+        """
+        paths = dict()
+        for fitness_key, same_keys in to_evaluate.items():
+            indiv_params = copy.deepcopy(self.pop_params[same_keys[0]])
+            path_value = indiv_params['model'].pop(path_param)
+            path_key = json.dumps(_canonical_params(indiv_params), sort_keys=True)
+            paths.setdefault(path_key, list()).append((path_value, fitness_key))
+        tasks = list()
+        for path in paths.values():
+            if len(path) == 1:
+                tasks.append(([path[0][1]], None))
+                continue
+            path = sorted(path, key=lambda pair: pair[0], reverse=(path_param == 'alpha'))
+            tasks.append(([fitness_key for path_value, fitness_key in path], path_param))
+        return tasks
+
+    def get_fitness_key(self, indiv_params, rows=None):
+        """Hash of everything that decides an individual's rmse: its genome, the model it's
+            applied to, the data (and the rows of it used), and the cv settings
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(_canonical_params(indiv_params), sort_keys=True).encode())
+        hasher.update(type(self.model).__name__.encode())
+        # the genome overrides whatever a previous save_best_model left on the shared model
+        model_params = self.model.get_params(deep=False)
+        model_params.update(indiv_params['model'])
+        hasher.update(repr(sorted(model_params.items())).encode())
+        hasher.update(self.get_data_fingerprint().encode())
+        hasher.update(repr(self.get_splitter()).encode())
+        if rows is not None:
+            hasher.update(np.asarray(rows, dtype=np.int64).tobytes())
+        return hasher.hexdigest()
+
+    def get_data_fingerprint(self):
+        if self.data_fingerprint is None:
+            X, y = self.get_indiv_data(dict(model=dict()))
+            hasher = hashlib.sha256()
+            for array in [X, y]:
+                array = np.ascontiguousarray(array)
+                hasher.update(repr((array.shape, array.dtype.str)).encode())
+                hasher.update(array.tobytes() if array.dtype != object else repr(array.tolist()).encode())
+            self.data_fingerprint = hasher.hexdigest()
+        return self.data_fingerprint
+
+    def record_fitness(self, fitness_key, indiv_rmse):
+        self.fitness_cache[fitness_key] = indiv_rmse
+        if self.fitness_cache_file is not None:
+            # appended as it goes, so an interrupted search can pick up where it stopped
+            with open(self.fitness_cache_file, 'a') as cache_file:
+                cache_file.write(json.dumps(dict(key=fitness_key, rmse=float(indiv_rmse))) + "\n")
         return
 
-    def evaluate_indiv_multiprocessing(self, indiv_params, indiv_key, pop_stats_dict, pop_rmses_dict, pop_done):
-        [indiv_rmse, indiv_stats] = self.evaluate_indiv(indiv_params, indiv_key)
-        pop_stats_dict[indiv_key] = indiv_stats
-        pop_rmses_dict[indiv_key] = indiv_rmse
-        pop_done.value += 1
-        logger.debug("Individual %s done (multiprocessing), %i/%i" % (indiv_key, pop_done.value, self.pop_size))
+    def get_worker_pool(self):
+        """Pool of self.processors worker processes, made on first use and kept until
+            close_worker_pool. Each worker is sent the model and the data once, when it starts.
+        """
+        if self.worker_pool is None:
+            from multiprocessing import Pool
+            X, y = self.get_indiv_data(dict(model=dict()))
+            self.worker_pool = Pool(processes=self.processors, initializer=_init_worker,
+                                    initargs=(self.model, X, y, self.get_splitter()))
+            self.owns_worker_pool = True
+        return self.worker_pool
+
+    def close_worker_pool(self):
+        if self.worker_pool is not None and self.owns_worker_pool:
+            self.worker_pool.close()
+            self.worker_pool.join()
+            self.worker_pool = None
         return
 
-    def evaluate_indiv(self, indiv_params, indiv_key):
-        """Evaluate an individual
+    def evaluate_indiv(self, indiv_params, indiv_key, rows=None):
+        """Evaluate an individual, on only the data rows given if not None
         """
-        indiv_model = copy.deepcopy(self.model)
-        try:
-            indiv_model.set_params(**indiv_params['model'])
-        except ValueError as e:
-            logger.debug('good params: ', indiv_model.get_params().keys())
-            logger.debug('your params: ', indiv_params['model'].keys())
-            raise e
+        X, y = self.get_indiv_data(indiv_params)
+        if rows is not None:
+            X, y = X[rows], y[rows]
+        mycv_rmse = _cv_rmse(self.model, indiv_params, X, y, self.get_splitter())
+        mycv_stats = dict()
+        self.save_indiv(indiv_params, indiv_key)
+        return [mycv_rmse, mycv_stats]
 
+    def get_indiv_data(self, indiv_params):
         indiv_dh = self.get_indiv_datahandler(indiv_params)
         #logging.debug(indiv_dh)
-        indiv_path = os.path.join(self.save_path, "indiv_%s" % indiv_key)
+        X = indiv_dh.data[indiv_dh.input_features].values
+        y = indiv_dh.data[indiv_dh.target_feature].values
+        return X, y
 
+    def get_splitter(self):
+        """Cv splitter shared by every individual, so they are all scored on the same splits
+        """
+        if self.splitter is not None:
+            return self.splitter
         if self.num_folds is not None: # CZECK_mARK replace with sklearn
-            splitter = sklearn.model_selection.KFold(n_splits=self.num_folds)
+            self.splitter = sklearn.model_selection.KFold(n_splits=self.num_folds)
         elif self.percent_leave_out is not None: # CZECK-mARK replace with sklearn shuffesplit
-            splitter = sklearn.model_selection.ShuffleSplit(percent_test=self.percent_leave_out)
+            if self.splitter_seed is None:
+                self.splitter_seed = self.random_state.randint(2**31)
+            self.splitter = sklearn.model_selection.ShuffleSplit(n_splits=self.num_cvtests,
+                                                                 test_size=self.percent_leave_out/100,
+                                                                 random_state=self.splitter_seed)
         else:
             raise ValueError("Both self.num_folds and self.percent_leave_out are None. One or the other must be specified.")
+        return self.splitter
 
-        X = indiv_dh.data[indiv_dh.input_features].values
-        y = indiv_dh.data[indiv_dh.target_feature].values
-        for train_index, test_index in splitter.split(X):
-            X_train, X_test = X[train_index], X[test_index]
-            y_train, y_test = y[train_index], y[test_index]
-            indiv_model.fit(X_train, y_train)
-            y_test_pred = indiv_model.predict(X_test)
-            mycv_rmse = sklearn.metrics.mean_squared_error(y_test, y_test_pred)**0.5
-            mycv_stats = dict()
-
+    def save_indiv(self, indiv_params, indiv_key):
+        indiv_path = os.path.join(self.save_path, "indiv_%s" % indiv_key)
         indiv_param_list = self.print_params(indiv_params)
         try:
             os.makedirs(indiv_path) # TODO Why do I need to make this now? I didn't before....
@@ -373,16 +593,19 @@ class GridSearch:
             cdir = os.path.join(indiv_path, cfile)
             if os.path.isfile(cdir):
                 os.remove(cdir)
-        return [mycv_rmse, mycv_stats]
+        return
 
     def get_best_indivs(self):
-        how_many = min(self.num_bests, len(self.pop_rmses.keys()))
+        rmses = copy.deepcopy(self.pop_rmses)
+        if self.pop_budgets is not None:
+            # individuals dropped by halving were scored on fewer rows, so can't be compared
+            full_budget = max(self.pop_budgets.values())
+            rmses = {ikey: rmse for ikey, rmse in rmses.items() if self.pop_budgets[ikey] == full_budget}
+        how_many = min(self.num_bests, len(rmses.keys()))
         if how_many < self.num_bests:
             logger.info("Only %i best values will be returned because population size is limited to %i." % (how_many, how_many))
         largeval=1e10
         lowest = list()
-        params = copy.deepcopy(self.pop_params)
-        rmses = copy.deepcopy(self.pop_rmses)
         lct=0
         while lct < how_many:
             minval = largeval
@@ -392,7 +615,7 @@ class GridSearch:
                 if ival < minval:
                     minval = ival
                     minikey = ikey
-            lowest.append((minikey, rmses[minikey], params[minikey]))
+            lowest.append((minikey, rmses[minikey], copy.deepcopy(self.pop_params[minikey])))
             rmses[minikey]=largeval
             lct = lct + 1
         self.readme_list.append("----Minimum RMSE params----\n")
@@ -466,64 +689,15 @@ class GridSearch:
         location = str.join(".", name_split) #join back up
         return (location, param_name)
 
-    def grow_param_dict(self, old_dict, add_combined_name):
-        """Increase the parameter dictionary by having each entry
-            branch into new entries
-        """
-        add_vals = self.opt_dict[add_combined_name]
-        (location, param_name) = self.get_split_name(add_combined_name)
-        if len(old_dict.keys()) == 0:
-            new_dict = dict()
-            for addct in range(0, len(add_vals)):
-                newstr = "%i" % addct
-                new_dict[newstr]=dict()
-                if not location in new_dict[newstr].keys():
-                    new_dict[newstr][location]=dict()
-                new_dict[newstr][location][param_name] = add_vals[addct]
-        else:
-            new_dict = dict()
-            for oldstr in old_dict.keys():
-                for addct in range(0, len(add_vals)):
-                    newstr = "%s_%i" % (oldstr, addct)
-                    new_dict[newstr] = dict()
-                    for oloc in old_dict[oldstr].keys():
-                        if not oloc in new_dict[newstr].keys():
-                            new_dict[newstr][oloc] = dict()
-                        for oparam in old_dict[oldstr][oloc].keys():
-                            new_dict[newstr][oloc][oparam] = old_dict[oldstr][oloc][oparam]
-                    if not location in new_dict[newstr].keys():
-                        new_dict[newstr][location]=dict()
-                    new_dict[newstr][location][param_name] = add_vals[addct]
-        return new_dict
-
-    def grow_param_dict_nonopt(self, old_dict, add_combined_name):
-        """Add nonoptimized parameters (single value) to parameter
-            dictionary.
+    def set_up_pop_params(self):
+        """Set self.pop_params to the grid of every combination of the optimized parameters'
+            values, decoded only as individuals are asked for
         """
-        add_value = self.opt_dict[add_combined_name]
-        (location, param_name) = self.get_split_name(add_combined_name)
-        if len(old_dict.keys()) == 0:
+        if len(self.opt_param_list) == 0 and len(self.nonopt_param_list) > 0:
             raise ValueError("No optimized parameters in grid search? You shouldn't be using Grid Search, silly.")
-        new_dict = dict()
-        for oldstr in old_dict.keys():
-            newstr = oldstr
-            new_dict[newstr] = dict()
-            for oloc in old_dict[oldstr].keys():
-                if not oloc in new_dict[newstr].keys():
-                    new_dict[newstr][oloc] = dict()
-                for oparam in old_dict[oldstr][oloc].keys():
-                    new_dict[newstr][oloc][oparam] = old_dict[oldstr][oloc][oparam]
-            if not location in new_dict[newstr].keys():
-                new_dict[newstr][location]=dict()
-            new_dict[newstr][location][param_name] = add_value
-        return new_dict
-
-    def set_up_pop_params(self):
-        self.pop_params=dict()
-        for opt_param in self.opt_param_list:
-            self.pop_params = self.grow_param_dict(self.pop_params, opt_param)
-        for nonopt_param in self.nonopt_param_list:
-            self.pop_params = self.grow_param_dict_nonopt(self.pop_params, nonopt_param)
+        opt_params = [self.get_split_name(name) + (self.opt_dict[name],) for name in self.opt_param_list]
+        nonopt_params = [self.get_split_name(name) + (self.opt_dict[name],) for name in self.nonopt_param_list]
+        self.pop_params = ParamGrid(opt_params, nonopt_params)
         return
 
     def set_up_opt_dict(self):
@@ -643,6 +817,15 @@ class GridSearch:
             self.plot_3d_rmse_heatmap(self.opt_param_list)
         return
 
+    def get_plot_rmses(self):
+        """The rmses of flat_results to plot. After halving only the individuals scored on every
+            row can be compared, so the rest are NaN and left out of the plots.
+        """
+        rmses = self.flat_results['rmse'].astype(float)
+        if self.pop_budgets is not None:
+            rmses = rmses.where(self.flat_results['rows_scored_on'] == max(self.pop_budgets.values()))
+        return rmses
+
     def is_log_param(self, col):
         """Check to see if flattened column was a log parameter
         """
@@ -683,7 +866,7 @@ class GridSearch:
             strings = list(set(xdata))
             mapping = {string: i for i,string in enumerate(strings)}
             xdata = xdata.map(lambda s: mapping[s])
-        plot_helper.plot_3d_heatmap(xdata, ydata, zdata, self.flat_results['rmse'], savepath,
+        plot_helper.plot_3d_heatmap(xdata, ydata, zdata, self.get_plot_rmses(), savepath,
                                     xlabel, ylabel, zlabel, 'rmse')
         self.readme_list.append("Plot %s.png created\n" % plotlabel)
 
@@ -706,7 +889,7 @@ class GridSearch:
 
         plotlabel = "rmse_heatmap"
         savepath = os.path.join(self.save_path, f'{plotlabel}.png')
-        plot_helper.plot_2d_heatmap(xdata, ydata, self.flat_results['rmse'], savepath, xlabel, ylabel, 'rmse')
+        plot_helper.plot_2d_heatmap(xdata, ydata, self.get_plot_rmses(), savepath, xlabel, ylabel, 'rmse')
         self.readme_list.append("Plot %s.png created\n" % plotlabel)
         return
 
@@ -739,7 +922,7 @@ class GridSearch:
 
         plotlabel="rmse_vs_%s" % col
         savepath = os.path.join(self.save_path, f'{plotlabel}.png')
-        plot_helper.plot_1d_heatmap(xdata, self.flat_results['rmse'], savepath)
+        plot_helper.plot_1d_heatmap(xdata, self.get_plot_rmses(), savepath)
         self.readme_list.append("Plot %s.png created\n" % plotlabel)
         return
 
@@ -751,6 +934,8 @@ class GridSearch:
             cols.append(opt_param)
         cols.append('rmse')
         cols.append('key')
+        if self.pop_budgets is not None:
+            cols.append('rows_scored_on')
         flat_results = pd.DataFrame(index=range(0, self.pop_size), columns=cols)
         pct = 0
         for pkey in self.pop_params.keys():
@@ -769,8 +954,182 @@ class GridSearch:
                     flat_results.loc[pct, colname] = val
             flat_results.loc[pct, 'rmse'] = rmse
             flat_results.loc[pct, 'key'] = pkey
+            if self.pop_budgets is not None:
+                flat_results.loc[pct, 'rows_scored_on'] = self.pop_budgets[pkey]
             pct = pct + 1
         flat_results.to_csv(os.path.join(self.save_path, "results.csv"))
         self.readme_list.append("Printed RMSE results to results.csv\n")
         self.flat_results = flat_results
         return
+
+class ParamGrid(Mapping):
+    """The population of a grid search, as a read-only mapping from individual key to params
+        dict, e.g. {'model': {'alpha': 0.1, 'gamma': 10}}.
+
+        Nothing is stored per individual. Individual number k of the grid is decoded on demand by
+        reading k in mixed radix, where the radix of each digit is the number of values of one
+        optimized parameter and the last parameter varies fastest. Its key is the digits joined
+        by underscores, e.g. '3_0', the same keys the grid search has always written out.
+
+        Args:
+            opt_params (list of (location, param name, array of values)): the optimized parameters
+            nonopt_params (list of (location, param name, value)): parameters every individual shares
+    """
+    def __init__(self, opt_params, nonopt_params=()):
+        self.opt_params = list(opt_params)
+        self.nonopt_params = list(nonopt_params)
+        self.radices = [len(values) for (location, param_name, values) in self.opt_params]
+
+    def __len__(self):
+        if len(self.radices) == 0:
+            return 0
+        size = 1
+        for radix in self.radices:
+            size *= radix
+        return size
+
+    def __iter__(self):
+        if len(self.radices) == 0:
+            return iter(())
+        return ("_".join(map(str, digits)) for digits in itertools.product(*map(range, self.radices)))
+
+    def __getitem__(self, indiv_key):
+        return self.params_from_digits(self.get_digits(indiv_key))
+
+    def get_digits(self, indiv_key):
+        try:
+            digits = [int(digit) for digit in str(indiv_key).split("_")]
+        except ValueError:
+            raise KeyError(indiv_key)
+        if len(digits) != len(self.radices) or not all(0 <= d < r for d, r in zip(digits, self.radices)):
+            raise KeyError(indiv_key)
+        return digits
+
+    def get_digits_at(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        digits = list()
+        for radix in reversed(self.radices):
+            index, digit = divmod(index, radix)
+            digits.append(digit)
+        return digits[::-1]
+
+    def get_key(self, index):
+        """Key of individual number index, counting from 0 in iteration order
+        """
+        return "_".join(map(str, self.get_digits_at(index)))
+
+    def get_index(self, indiv_key):
+        """Position of indiv_key in iteration order, the inverse of get_key
+        """
+        index = 0
+        for digit, radix in zip(self.get_digits(indiv_key), self.radices):
+            index = index * radix + digit
+        return index
+
+    def params_at(self, index):
+        return self.params_from_digits(self.get_digits_at(index))
+
+    def params_from_digits(self, digits):
+        params = dict()
+        for (location, param_name, values), digit in zip(self.opt_params, digits):
+            params.setdefault(location, dict())[param_name] = values[digit]
+        for (location, param_name, value) in self.nonopt_params:
+            params.setdefault(location, dict())[param_name] = value
+        return params
+
+    def sample_keys(self, num, random_state):
+        """Keys of num distinct individuals drawn at random, without enumerating the grid
+        """
+        indices = random_state.choice(len(self), size=min(num, len(self)), replace=False)
+        return [self.get_key(int(index)) for index in indices]
+
+# The worker pool's copy of everything an individual's evaluation needs besides its params,
+# filled in once per worker process by _init_worker
+_worker_state = dict()
+
+def _init_worker(model, X, y, splitter):
+    _worker_state.update(model=model, X=X, y=y, splitter=splitter)
+
+def _evaluate_indiv_in_worker(task):
+    fitness_keys, indiv_keys, params_source, path_param, rows = task
+    indiv_params_list = [params_source[indiv_key] for indiv_key in indiv_keys]
+    state = _worker_state
+    X, y = state['X'], state['y']
+    if rows is not None:
+        X, y = X[rows], y[rows]
+    if path_param is None:
+        indiv_rmses = [_cv_rmse(state['model'], indiv_params_list[0], X, y, state['splitter'])]
+    else:
+        indiv_rmses = _cv_rmses_along_path(state['model'], indiv_params_list, path_param, X, y, state['splitter'])
+    return [(fitness_key, indiv_rmse, dict()) for fitness_key, indiv_rmse in zip(fitness_keys, indiv_rmses)]
+
+def load_fitness_cache(path):
+    """Reads back the fitness cache a previous search wrote to path, as ({fitness key: rmse},
+        the seed of the ShuffleSplit those rmses were scored on, or None if it has none yet)
+    """
+    fitness_cache = dict()
+    splitter_seed = None
+    if path is not None and os.path.isfile(path):
+        with open(path) as cache_file:
+            for line in cache_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # last line cut short by the interruption
+                    continue
+                if 'splitter_seed' in entry:
+                    splitter_seed = entry['splitter_seed']
+                    continue
+                fitness_cache[entry['key']] = entry['rmse']
+        logger.info(f'Loaded {len(fitness_cache)} evaluated genomes from {path}')
+    return fitness_cache, splitter_seed
+
+def _canonical_params(value):
+    """Params as plain json types, so equal genomes always serialize the same way
+    """
+    if isinstance(value, dict):
+        return {str(k): _canonical_params(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical_params(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _cv_rmses_along_path(model, indiv_params_list, path_param, X, y, splitter):
+    """Average test RMSE over the splits of each of indiv_params_list, which differ only in
+        path_param. On each split one warm-started model is refit at each value in turn.
+    """
+    cv_rmses = np.zeros((len(indiv_params_list), splitter.get_n_splits(X)))
+    for split_num, (train_index, test_index) in enumerate(splitter.split(X)):
+        X_train, X_test = X[train_index], X[test_index]
+        y_train, y_test = y[train_index], y[test_index]
+        # a fresh model per split, so no split's fit starts from another split's data
+        path_model = copy.deepcopy(model)
+        path_model.set_params(**indiv_params_list[0]['model'])
+        path_model.set_params(warm_start=True)
+        for indiv_num, indiv_params in enumerate(indiv_params_list):
+            path_model.set_params(**{path_param: indiv_params['model'][path_param]})
+            path_model.fit(X_train, y_train)
+            y_test_pred = path_model.predict(X_test)
+            cv_rmses[indiv_num, split_num] = sklearn.metrics.mean_squared_error(y_test, y_test_pred)**0.5
+    return list(cv_rmses.mean(axis=1))
+
+def _cv_rmse(model, indiv_params, X, y, splitter):
+    """Average test RMSE over the splits of model with indiv_params['model'] set
+    """
+    indiv_model = copy.deepcopy(model)
+    try:
+        indiv_model.set_params(**indiv_params['model'])
+    except ValueError as e:
+        logger.debug('good params: %s' % indiv_model.get_params().keys())
+        logger.debug('your params: %s' % indiv_params['model'].keys())
+        raise e
+
+    cv_rmses = list()
+    for train_index, test_index in splitter.split(X):
+        X_train, X_test = X[train_index], X[test_index]
+        y_train, y_test = y[train_index], y[test_index]
+        indiv_model.fit(X_train, y_train)
+        y_test_pred = indiv_model.predict(X_test)
+        cv_rmses.append(sklearn.metrics.mean_squared_error(y_test, y_test_pred)**0.5)
+    return np.mean(cv_rmses)
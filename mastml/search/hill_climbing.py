@@ -2,43 +2,59 @@ import random
 from copy import copy
 
 from sklearn.model_selection import train_test_split
+from sklearn.externals.joblib import Parallel, delayed
 
-def climb_hill(model_constructor, X, y, param_dict, score_func, num_steps=100, num_restarts=5):
-    pairs = []
-    for _ in range(num_restarts):
-        best_score = -float('inf')
-        best_params = {key: random.choice(values) for key,values in param_dict.items()}
-        non_singleton_params = [param for param in param_dict if len(param_dict[param]) > 1]
-        X_train, X_test, y_train, y_test = train_test_split(X, y)
-        for step in range(100):
-            print(f"Step {step}/100")
-            if step % 10 == 0:
-                X_train, X_test, y_train, y_test = train_test_split(X, y)
-            # get random subset of parameters
-            params = copy(best_params)
-            subset = random_subset(non_singleton_params)
-            params.update((key, random.choice(param_dict[key])) for key in subset)
+def climb_hill(model_constructor, X, y, param_dict, score_func, num_steps=100, num_restarts=5, n_jobs=1):
+    """
+    Returns the (best_score, best_params) found by num_restarts independent hill climbs of
+    num_steps steps each, run on n_jobs processes. score_func must be greater-is-better.
+    """
+    # seeded here so the restarts don't depend on which process runs them
+    seeds = [random.randrange(2**32) for _ in range(num_restarts)]
+    if n_jobs == 1:
+        pairs = [_climb(model_constructor, X, y, param_dict, score_func, num_steps, seed) for seed in seeds]
+    else:
+        pairs = Parallel(n_jobs=n_jobs)(
+                delayed(_climb)(model_constructor, X, y, param_dict, score_func, num_steps, seed)
+                for seed in seeds)
+    return max(pairs, key=lambda pair: pair[0])
+
+def _climb(model_constructor, X, y, param_dict, score_func, num_steps, seed):
+    " One restart: every step is scored on the same split, and no parameter set is fit twice "
+    rng = random.Random(seed)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=seed)
+    scores = dict() # repr of sorted params -> score
+    best_score = -float('inf')
+    best_params = {key: rng.choice(values) for key,values in param_dict.items()}
+    non_singleton_params = [param for param in param_dict if len(param_dict[param]) > 1]
+    for step in range(num_steps):
+        # get random subset of parameters
+        params = copy(best_params)
+        subset = random_subset(non_singleton_params, rng)
+        params.update((key, rng.choice(param_dict[key])) for key in subset)
+        key = repr(sorted(params.items()))
+        if key not in scores:
             model = model_constructor(**params)
             model.fit(X_train, y_train)
             y_pred = model.predict(X_test)
-            score = score_func(y_test, y_pred)
-            if score > best_score:
-                best_score = score
-                best_params = params
-        pairs.append((best_score, best_params))
-    return max(pairs, key=lambda pair: pair[0])
+            scores[key] = score_func(y_test, y_pred)
+        score = scores[key]
+        if score > best_score:
+            best_score = score
+            best_params = params
+    return best_score, best_params
 
-def random_subset(list1):
-    return random.sample(list1, random_power(len(list1)))
+def random_subset(list1, rng=random):
+    return rng.sample(list1, random_power(len(list1), rng))
 
-def random_power(n):
+def random_power(n, rng=random):
     """
     Random number from 1 to n.
     1 is the most likely, 2 is half as likely, 3 is a third as likely, etc
     """
     total = sum(1/i for i in range(1,n+1))
     cumulative_probability = 0
-    r = random.random()
+    r = rng.random()
     for i in range(1,n+1):
         cumulative_probability += 1 / (i * total)
         if r <= cumulative_probability:
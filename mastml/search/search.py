@@ -4,6 +4,7 @@
 
 import argparse
 import logging
+from functools import partial
 from os.path import join
 
 from sklearn.base import is_classifier
@@ -23,18 +24,18 @@ log = logging.getLogger('mastml')
 grid_search_user_params = [ # parameters to GridSearch initializer which user has permission to set
     'param_strings', 'model', 'xlabel', 'ylabel', 'fix_random_for_testing',
     'num_cvtests', 'mark_outlying_points', 'num_folds', 'percent_leave_out',
-    'processors', 'pop_upper_limit', 'num_bests',
+    'processors', 'pop_upper_limit', 'num_bests', 'halving_factor', 'halving_min_rows', 'warm_start',
 ]
 
 genetic_search_user_params = [ # parameters to GeneticSearch initializer which user has permission to set
     'param_strings', 'model', 'num_folds', 'percent_leave_out', 'num_cvtests',
     'mark_outlying_points', 'num_bests', 'fix_random_for_testing', 'processors', 'pop_upper_limit',
     'num_gas', 'ga_pop_size', 'convergence_generations', 'max_generations', 'crossover_prob',
-    'mutation_prob', 'shift_prob', 'gen_tol',
+    'mutation_prob', 'shift_prob', 'gen_tol', 'fitness_cache_file',
 ]
 
 hill_climbing_user_params = [
-    'model', 'score_func', 'num_steps', 'num_restarts'
+    'model', 'score_func', 'num_steps', 'num_restarts', 'n_jobs',
 ]
 
 def parse_conf_file(filepath):
@@ -69,7 +70,8 @@ def parse_conf_file(filepath):
             raise Exception(f"HillCimbing requires score_func parameter")
         is_c = is_classifier(HC['model'])
         metrics_dict =  metrics.classification_metrics if is_c else metrics.regression_metrics
-        metrics_dict = {name: (func if greater_is_better else (lambda yt, yp: -func(yt, yp)))
+        # partial rather than a lambda, so it can be sent to the climbing processes
+        metrics_dict = {name: (func if greater_is_better else partial(_negated_score, func))
                         for name, (greater_is_better, func) in metrics_dict.items()}
                                              
         task = 'classification' if is_c else 'regression'
@@ -112,6 +114,9 @@ def parse_conf_file(filepath):
 
     return conf
 
+def _negated_score(score_func, y_true, y_pred):
+    return -score_func(y_true, y_pred)
+
 def load_data(data_path, input_features, target_feature, istest_feature, not_input_features):
     df = pd.read_csv(data_path)
     if len(df.columns) != len(set(df.columns)):
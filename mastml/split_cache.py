@@ -0,0 +1,178 @@
+"""
+Module for storing the (train, test) splits of a splitter compactly, and caching them on disk.
+
+A splitter's splits are read once and packed into CompactSplits instead of being kept as index
+arrays. Splits whose train set is everything outside their test set (KFold, LeaveOneOut,
+RepeatedKFold, ...) become fold numbers in an int array over the rows, one array per pass through
+the data. Any other split is kept as a pair of bitmasks. Splits are decoded back into indices only
+when they are asked for.
+"""
+
+import hashlib
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+# Bump whenever the saved format or the way splits are packed changes
+CACHE_VERSION = 1
+
+class CompactSplits:
+    """
+    Sequence of (train_indices, test_indices) pairs, where the indices are labels of index_values.
+
+    Attributes:
+        index_values (array): labels the row positions are translated to on decoding
+        layers (int array, shape (n_layers, n_rows)): fold number of every row in each pass
+            through the data, -1 where a row's fold hasn't been seen
+        masks (uint8 array, shape (n_masked, 2, ceil(n_rows/8))): packed train and test bitmasks
+        locations (int32 array, shape (n_splits, 2)): (layer, fold) of each split, or (-1, i)
+            for the i-th masked split
+    """
+    def __init__(self, index_values, layers, masks, locations):
+        self.index_values = index_values
+        self.layers = layers
+        self.masks = masks
+        self.locations = locations
+
+    @classmethod
+    def from_splits(cls, splits, index_values):
+        " Packs splits, an iterable of (train, test) row positions, without keeping any of them "
+        n_rows = len(index_values)
+        layers = list()
+        fold_counts = list()
+        masks = list()
+        locations = list()
+        for train, test in splits:
+            train = np.asarray(train, dtype=np.intp)
+            test = np.asarray(test, dtype=np.intp)
+            in_test = np.zeros(n_rows, dtype=bool)
+            in_test[test] = True
+            complementary = (len(train) + len(test) == n_rows and in_test.sum() == len(test)
+                             and not in_test[train].any())
+            if not complementary:
+                in_train = np.zeros(n_rows, dtype=bool)
+                in_train[train] = True
+                if in_train.sum() != len(train): # repeated rows can't be stored as a mask
+                    raise ValueError('Splits that repeat rows in a training set cannot be compacted')
+                locations.append((-1, len(masks)))
+                masks.append(np.packbits(np.stack([in_train, in_test]), axis=1))
+                continue
+            # a new pass starts whenever a test set overlaps one already seen in the current pass
+            if not layers or (layers[-1][test] != -1).any():
+                layers.append(np.full(n_rows, -1, dtype=np.int32))
+                fold_counts.append(0)
+            layers[-1][test] = fold_counts[-1]
+            locations.append((len(layers) - 1, fold_counts[-1]))
+            fold_counts[-1] += 1
+        layers = np.array(layers, dtype=np.int32).reshape(len(layers), n_rows)
+        # most splitters make far fewer folds than an int32 can count
+        for dtype in [np.int8, np.int16]:
+            if max(fold_counts, default=0) <= np.iinfo(dtype).max:
+                layers = layers.astype(dtype)
+                break
+        masks = np.array(masks, dtype=np.uint8).reshape(len(masks), 2, (n_rows + 7) // 8)
+        locations = np.array(locations, dtype=np.int32).reshape(len(locations), 2)
+        return cls(np.asarray(index_values), layers, masks, locations)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, split_num):
+        layer, fold = self.locations[split_num]
+        if layer == -1:
+            n_rows = len(self.index_values)
+            in_train, in_test = np.unpackbits(self.masks[fold], axis=1)[:, :n_rows].astype(bool)
+        else:
+            in_test = self.layers[layer] == fold
+            in_train = ~in_test
+        return self.index_values[np.flatnonzero(in_train)], self.index_values[np.flatnonzero(in_test)]
+
+    def __iter__(self):
+        return (self[split_num] for split_num in range(len(self)))
+
+    def save(self, path):
+        " Writes through a temporary file so readers never see half of it "
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, index_values=self.index_values, layers=self.layers, masks=self.masks,
+                     locations=self.locations)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as saved:
+            return cls(saved['index_values'], saved['layers'], saved['masks'], saved['locations'])
+
+def make_splits(splitter, X, y, groups=None, cache_dir=None):
+    """
+    Returns splitter's splits of X as CompactSplits over X's index labels. If cache_dir is given
+    and the splitter is deterministic, they are loaded from there when the same splitter has
+    already split the same rows.
+    """
+    if groups is None:
+        split_positions = lambda: splitter.split(X, y)
+    else:
+        split_positions = lambda: splitter.split(X, y, groups)
+    if cache_dir is None or not is_deterministic(splitter):
+        return CompactSplits.from_splits(split_positions(), X.index.values)
+
+    path = os.path.join(cache_dir, cache_key(splitter, X, y, groups) + '.npz')
+    if os.path.isfile(path):
+        try:
+            splits = CompactSplits.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'Ignoring unreadable split cache entry {path}: {e}')
+        else:
+            log.info(f'Loaded {splitter.__class__.__name__} splits from cache {path}')
+            return splits
+
+    splits = CompactSplits.from_splits(split_positions(), X.index.values)
+    os.makedirs(cache_dir, exist_ok=True)
+    splits.save(path)
+    return splits
+
+def is_deterministic(splitter):
+    " False for splitters that shuffle without a fixed integer random_state, whose splits shouldn't be reused "
+    if hasattr(splitter, 'splitters'): # SplittersUnion
+        return all(is_deterministic(s) for s in splitter.splitters)
+    if not hasattr(splitter, 'random_state') or getattr(splitter, 'shuffle', True) is False:
+        return True
+    return isinstance(splitter.random_state, (int, np.integer))
+
+def cache_key(splitter, X, y, groups):
+    """
+    Hex digest identifying splitter's splits of X. Splitters only look at the number of rows, the
+    targets and the groups, so X's values are left out.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f'{CACHE_VERSION}'.encode())
+    _hash_value(hasher, splitter)
+    hasher.update(pd.util.hash_pandas_object(pd.Series(np.asarray(y), index=X.index), index=True).values.tobytes())
+    if groups is not None:
+        hasher.update(pd.util.hash_pandas_object(pd.Series(np.asarray(groups)), index=False).values.tobytes())
+    hasher.update(str(len(X)).encode())
+    return hasher.hexdigest()
+
+def _hash_value(hasher, value):
+    """
+    Adds a splitter parameter to hasher. Splitters are hashed by their attributes, since sklearn's
+    don't have get_params and their repr shortens long arrays like PredefinedSplit's test_fold.
+    """
+    if isinstance(value, (list, tuple)):
+        hasher.update(f'{type(value).__name__} {len(value)}'.encode())
+        for item in value:
+            _hash_value(hasher, item)
+    elif isinstance(value, np.ndarray):
+        hasher.update(repr((value.shape, value.dtype.str)).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value.tolist()).encode())
+    elif hasattr(value, 'split') and hasattr(value, '__dict__'):
+        hasher.update(f'{type(value).__module__}.{type(value).__name__}'.encode())
+        for name, attribute in sorted(vars(value).items()):
+            hasher.update(name.encode())
+            _hash_value(hasher, attribute)
+    else:
+        hasher.update(repr(value).encode())
@@ -0,0 +1,41 @@
+"""
+Module for estimating the uncertainty of a fitted model's predictions, row by row.
+
+Forests are asked for every tree's predictions on all rows at once, and Gaussian processes for
+their predictive mean and standard deviation in a single call, so the cost doesn't grow with a
+Python loop over the rows.
+"""
+
+import numpy as np
+from scipy.stats import norm
+
+def has_prediction_intervals(model):
+    " True if prediction_intervals can be computed for model "
+    return model.__class__.__name__ in ['RandomForestRegressor', 'ExtraTreesRegressor',
+                                        'GaussianProcessRegressor']
+
+# Prediction intervals adapted from https://blog.datadive.net/prediction-intervals-for-random-forests/
+def prediction_intervals(model, X, percentile=68):
+    """
+    Returns (err_down, err_up), arrays of the lower and upper ends of the central percentile%
+    interval of model's prediction for each row of X. For forests these are percentiles of the
+    trees' predictions, for Gaussian processes of the predictive distribution. Ends that come out
+    exactly 0 are replaced by 1e10.
+    """
+    X = np.asarray(X)
+    lower_quantile = (100 - percentile) / 2.
+    upper_quantile = 100 - lower_quantile
+    if model.__class__.__name__ == 'GaussianProcessRegressor':
+        mean, std = model.predict(X, return_std=True)
+        err_down = mean + norm.ppf(lower_quantile / 100.) * std
+        err_up = mean + norm.ppf(upper_quantile / 100.) * std
+    elif hasattr(model, 'estimators_'):
+        tree_preds = np.empty((len(model.estimators_), X.shape[0]))
+        for tree_num, tree in enumerate(model.estimators_):
+            tree_preds[tree_num] = tree.predict(X)
+        err_down, err_up = np.percentile(tree_preds, [lower_quantile, upper_quantile], axis=0)
+    else:
+        raise ValueError(f'Prediction intervals are not available for {model.__class__.__name__}')
+    err_down = np.where(err_down == 0.0, 10**10, err_down)
+    err_up = np.where(err_up == 0.0, 10**10, err_up)
+    return err_down, err_up
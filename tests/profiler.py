@@ -1,5 +1,56 @@
+"""
+Times how long importing each mastml subsystem takes, each in a fresh interpreter so nothing is
+already imported, and lists the slow optional backends each one pulls in (they should only load
+when a conf file asks for them).
+Run with --cprofile to profile importing mastml.mastml instead.
+"""
 
+import subprocess
+import sys
 import cProfile
-import re
 
-cProfile.run('from mastml import mastml')
+SUBSYSTEMS = [
+    'mastml.conf_parser',
+    'mastml.data_loader',
+    'mastml.legos.model_finder',
+    'mastml.legos.feature_generators',
+    'mastml.legos.feature_selectors',
+    'mastml.plot_helper',
+    'mastml.html_helper',
+    'mastml.mastml',
+]
+
+BACKENDS = ['pymatgen', 'citrination_client', 'mlxtend', 'nbformat', 'matplotlib']
+
+TIMER = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(name for name in {backends} if name in sys.modules))
+"""
+
+def time_import(module, repeats=3):
+    " Best of repeats import times of module in seconds, and the backends it imported "
+    times = list()
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', TIMER.format(module=module, backends=BACKENDS)],
+                                         universal_newlines=True).split('\n')
+        times.append(float(output[0]))
+    return min(times), output[1].split()
+
+def main():
+    print(f"{'subsystem':<36}{'import (s)':>12}  backends loaded")
+    for module in SUBSYSTEMS:
+        try:
+            seconds, backends = time_import(module)
+        except subprocess.CalledProcessError:
+            print(f'{module:<36}{"failed":>12}')
+            continue
+        print(f"{module:<36}{seconds:>12.3f}  {', '.join(backends)}")
+
+if __name__ == '__main__':
+    if '--cprofile' in sys.argv:
+        cProfile.run('from mastml import mastml')
+    else:
+        main()
@@ -5,16 +5,28 @@ import logging
 import textwrap
 import nbformat
 import inspect
+import json
+import os
 from io import StringIO
 from pprint import pprint
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from types import SimpleNamespace
 
 import numpy as np
 import pandas as pd
-
-from mastml import plot_helper, conf_parser, metrics
+from sklearn.linear_model import LinearRegression, Ridge, Lasso
+from sklearn.svm import SVC
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
+from sklearn.model_selection import KFold, LeaveOneOut, PredefinedSplit, ShuffleSplit
+from sklearn.metrics import r2_score, make_scorer, mean_squared_error
+from sklearn.feature_selection import RFE, SelectKBest, f_regression
+
+from mastml import plot_helper, conf_parser, metrics, feature_cache, split_cache, uncertainty, results_store, fold_pipeline, data_loader, data_cache, learning_curve
 import mastml.utils
-from mastml.legos import feature_generators
+import mastml.mastml
+from mastml.legos import feature_generators, feature_selectors, util_legos, model_finder
+from mastml.search import grid_search, genetic_search, hill_climbing
+from mastml.search.data_handler import DataHandler
 from mastml.legos.randomizers import Randomizer
 from mastml.legos.feature_normalizers import MeanStdevScaler
 
@@ -86,6 +98,62 @@ class TestFeatureSelectionDefaults(unittest.TestCase):
                 string_to_filename(self.regress_conf))
         pprint(conf)
 
+class TestMASTMLFeatureSelector(unittest.TestCase):
+
+    def test_forward_selection(self):
+        rng = np.random.RandomState(0)
+        X = pd.DataFrame(rng.rand(80, 8), columns=list('abcdefgh'))
+        y = 3*X['c'] - 2*X['f'] + 0.5*X['a'] + 0.01*rng.rand(80)
+        serial = feature_selectors.MASTMLFeatureSelector(LinearRegression(), 5, KFold(5)).fit(X, y)
+        self.assertEqual(serial.selected_feature_names[:3], ['c', 'f', 'a'])
+        parallel = feature_selectors.MASTMLFeatureSelector(LinearRegression(), 5, KFold(5), n_jobs=2).fit(X, y)
+        self.assertEqual(serial.selected_feature_names, parallel.selected_feature_names)
+        # the features after 'a' barely help, so they get dropped again
+        early = feature_selectors.MASTMLFeatureSelector(LinearRegression(), 5, KFold(5), patience=2, tol=1e-3).fit(X, y)
+        self.assertEqual(list(early.transform(X).columns), ['c', 'f', 'a'])
+        # when no feature improves enough to count, the best single one is still kept
+        none_improve = feature_selectors.MASTMLFeatureSelector(LinearRegression(), 5, KFold(5), patience=1,
+                                                               tol=np.inf).fit(X, y)
+        self.assertEqual(list(none_improve.transform(X).columns), ['c'])
+
+    def test_linear_fast_path(self):
+        # subclasses aren't exactly LinearRegression/Ridge, so they get refit for every candidate
+        class SlowLinearRegression(LinearRegression): pass
+        class SlowRidge(Ridge): pass
+        rng = np.random.RandomState(0)
+        X = rng.rand(60, 6)
+        X[:, 5] = 2*X[:, 1] + 1 # collinear with a selected column
+        y = 3*X[:, 2] - 2*X[:, 4] + 0.1*rng.rand(60)
+        splits = list(KFold(5, shuffle=True, random_state=0).split(X))
+        for fast, slow in [(LinearRegression(), SlowLinearRegression()), (Ridge(alpha=0.5), SlowRidge(alpha=0.5))]:
+            fast_scores = feature_selectors._score_candidates(fast, X[:, 1:3], X[:, [0, 3, 4, 5]], y, splits)
+            slow_scores = feature_selectors._score_candidates(slow, X[:, 1:3], X[:, [0, 3, 4, 5]], y, splits)
+            self.assertTrue(np.allclose(fast_scores, slow_scores))
+
+class TestLearningCurve(unittest.TestCase):
+
+    def test_feature_ranking_path(self):
+        rng = np.random.RandomState(0)
+        X = pd.DataFrame(rng.rand(60, 6), columns=list('abcdef'))
+        y = 3*X['c'] - 2*X['f'] + X['a'] - 0.5*X['d'] + 0.1*rng.rand(60)
+        # refitting each selector for every number of features gives the same feature sets
+        refit = {
+            'RFE': lambda k: RFE(LinearRegression(), n_features_to_select=k).fit(X, y).get_support(indices=True),
+            'SelectKBest': lambda k: SelectKBest(f_regression, k=k).fit(X, y).get_support(indices=True),
+            'MASTMLFeatureSelector': lambda k: [list(X.columns).index(name) for name in
+                    feature_selectors.MASTMLFeatureSelector(LinearRegression(), k, KFold(3)).fit(X, y).selected_feature_names]}
+        for selector_name, selected in refit.items():
+            path = learning_curve._feature_ranking_path(X, y, LinearRegression(), KFold(3), selector_name, 6, None)
+            self.assertEqual([sorted(subset) for subset in path],
+                             [sorted(selected(k)) for k in range(1, 7)], selector_name)
+
+        scoring = make_scorer(mean_squared_error)
+        serial, parallel = [learning_curve.feature_learning_curve(X, y, LinearRegression(), KFold(3), scoring, 'SelectKBest',
+                                                                  n_jobs=n_jobs) for n_jobs in [1, 2]]
+        self.assertEqual(list(serial[0]), [1, 2, 3, 4, 5, 6])
+        for serial_values, parallel_values in zip(serial, parallel):
+            self.assertTrue(np.allclose(serial_values, parallel_values))
+
 class TestPlotToPython(unittest.TestCase):
     " How to convert a call to plot to a .py file that the user can modify "
     def test_test(self):
@@ -154,6 +222,17 @@ class TestGeneration(unittest.TestCase):
         df = magpie.transform(df)
         df.to_csv('magpie_test.csv')
 
+    def test_contains_element(self):
+        df = pd.DataFrame({'MaterialComp': ['Al2O3', 'Fe2O3', 'Al2O3', 'NaCl']}, index=[3,1,4,1])
+        contains_all = feature_generators.ContainsElement('MaterialComp', None, None, all_elements=True)
+        df_trans = contains_all.fit(df).transform(df)
+        self.assertEqual(list(df_trans.columns), ['has_Al', 'has_O', 'has_Fe', 'has_Na', 'has_Cl'])
+        self.assertEqual(list(df_trans['has_O']), [1, 1, 1, 0])
+        self.assertEqual(list(df_trans.index), [3, 1, 4, 1])
+
+        contains_fe = feature_generators.ContainsElement('MaterialComp', 'Fe', 'has_Fe')
+        self.assertEqual(list(contains_fe.fit(df).transform(df)['has_Fe']), [0, 1, 0, 0])
+
     def test_materials_project(self):
         df = pd.read_csv('tests/csv/common_materials.csv')
         materials_project = feature_generators.MaterialsProject(
@@ -163,6 +242,25 @@ class TestGeneration(unittest.TestCase):
         df = materials_project.transform(df)
         df.to_csv('materials_project.csv')
 
+    def test_materials_project_stand_in(self):
+        class StandInMPRester:
+            def __init__(self):
+                self.queries = list()
+            def get_data(self, chemsys_formula_id):
+                self.queries.append(chemsys_formula_id)
+                if chemsys_formula_id == 'Unobtainium':
+                    return []
+                return [{'e_above_hull': 0.1, 'band_gap': 2.0, 'spacegroup': {'number': 167}, 'elasticity': None},
+                        {'e_above_hull': 0.0, 'band_gap': 1.0, 'spacegroup': {'number': 225}, 'elasticity': None}]
+
+        df = pd.DataFrame({'Material': ['NaCl', 'Unobtainium', 'NaCl', 'NaCl']})
+        mprester = StandInMPRester()
+        mpg = feature_generators.MaterialsProjectFeatureGeneration(df, None, 'Material', mprester=mprester)
+        df = mpg.generate_materialsproject_features()
+        self.assertEqual(sorted(mprester.queries), ['NaCl', 'Unobtainium'])
+        self.assertEqual(list(df['band_gap']), [1.0, '', 1.0, 1.0])
+        self.assertEqual(list(df['Spacegroup_number']), [225, '', 225, 225])
+
     def test_citrine(self):
         df = pd.read_csv('tests/csv/feature_generation.csv')
         citrine = feature_generators.Citrine(
@@ -172,6 +270,56 @@ class TestGeneration(unittest.TestCase):
         df = citrine.transform(df)
         df.to_csv('citrine.csv')
 
+    def test_citrine_mocked_client(self):
+        class MockResult:
+            def __init__(self, hits):
+                self.hits = hits
+            def as_dictionary(self):
+                return {'hits': self.hits}
+
+        class MockClient:
+            def __init__(self):
+                self.n_searches = 0
+            def search(self, pif_query):
+                self.n_searches += 1
+                return MockResult([
+                    {'system': {'properties': [{'name': 'Band gap', 'scalars': [{'value': '1.0'}]},
+                                               {'name': 'CIF File'},
+                                               {'name': 'Density', 'scalars': [{'value': 'n/a'}]}]}},
+                    {'system': {'properties': [{'name': 'Band gap', 'scalars': [{'value': '3.0'}]}]}}])
+
+        df = pd.DataFrame({'MaterialComp': ['GaAs', 'InP', 'GaAs']})
+        client = MockClient()
+        feature_generators._citrine_cache.clear()
+        cfg = feature_generators.CitrineFeatureGeneration(df, None, 'MaterialComp', client=client)
+        df = cfg.generate_citrine_features()
+        self.assertEqual(client.n_searches, 2)
+        self.assertEqual(list(df['Band gap_min']), [1.0, 1.0, 1.0])
+        self.assertEqual(list(df['Band gap_max']), [3.0, 3.0, 3.0])
+        self.assertEqual(list(df['Band gap_avg']), [2.0, 2.0, 2.0])
+
+        # a second run is served from the cache
+        feature_generators.CitrineFeatureGeneration(df, None, 'MaterialComp', client=client).generate_citrine_features()
+        self.assertEqual(client.n_searches, 2)
+        # but not for another client
+        other_client = MockClient()
+        feature_generators.CitrineFeatureGeneration(df, None, 'MaterialComp', client=other_client).generate_citrine_features()
+        self.assertEqual(other_client.n_searches, 2)
+
+        # the disk cache is trimmed to cache_size once all the searches are done
+        with TemporaryDirectory() as tmpdir:
+            df = pd.DataFrame({'MaterialComp': ['GaAs', 'InP', 'GaN', 'AlAs']})
+            feature_generators.CitrineFeatureGeneration(df, 'key', 'MaterialComp', client=MockClient(), cache_size=2,
+                                                        cache_dir=tmpdir).generate_citrine_features()
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+            # and only shared by the same api key
+            feature_generators._citrine_cache.clear()
+            for api_key, n_searches in [('key', 2), ('other key', 4), (None, 4), (None, 4)]:
+                other_client = MockClient()
+                feature_generators.CitrineFeatureGeneration(df, api_key, 'MaterialComp', client=other_client,
+                                                            cache_size=2, cache_dir=tmpdir).generate_citrine_features()
+                self.assertEqual(other_client.n_searches, n_searches)
+
     def test_clean_data(self):
         good = pd.DataFrame([
             [10,20,30,40],
@@ -322,6 +470,17 @@ class TestPlots(unittest.TestCase):
         plot_helper.plot_scatter(self.y_true, self.y_pred,
                                  'results/scatter.png')
 
+    def test_deferred_plots(self):
+        with TemporaryDirectory() as tmpdir:
+            savepath = os.path.join(tmpdir, 'scatter.png')
+            with plot_helper.deferred_plots() as plot_jobs:
+                plot_helper.plot_scatter(self.y_true, self.y_pred, savepath)
+            self.assertEqual([job[0] for job in plot_jobs], ['plot_scatter'])
+            self.assertFalse(os.path.exists(savepath))
+            plot_helper.render_plots(plot_jobs, dpi=50)
+            self.assertTrue(os.path.exists(savepath))
+            self.assertEqual(plot_helper.DPI, 250) # the dpi only applies to those plots
+
 class TestHtml(unittest.TestCase):
 
     def test_image_list(self):
@@ -366,6 +525,442 @@ class TestNormalization(unittest.TestCase):
         self.assertTrue(set(d1.columns) == set(d3.columns))
         self.assertTrue((abs(d3 - d1) < .001).all().all())
 
+class TestFeatureCache(unittest.TestCase):
+
+    def test_cache_hit_and_eviction(self):
+        df = pd.DataFrame({'MaterialComp': ['Al2O3', 'NaCl', 'Fe2O3'], 'target': [1, 2, 3]})
+        generator = feature_generators.ContainsElement('MaterialComp', None, None, all_elements=True)
+        with TemporaryDirectory() as cache_dir:
+            first = feature_cache.generate_cached(generator, {'all_elements': True}, df, None, cache_dir, 1000)
+            # a column the generator doesn't read shouldn't invalidate the entry
+            df['target'] = [4, 5, 6]
+            key = feature_cache.cache_key(generator, {'all_elements': True}, df)
+            self.assertEqual(os.listdir(cache_dir), [key + '.npz'])
+            second = feature_cache.generate_cached(generator, {'all_elements': True}, df, None, cache_dir, 1000)
+            self.assertTrue(first.equals(second))
+
+            feature_cache.generate_cached(generator, {'all_elements': 'other'}, df, None, cache_dir, 0)
+            self.assertEqual(os.listdir(cache_dir), [])
+
+class TestSplitCache(unittest.TestCase):
+
+    def test_compact_splits_match_splitter(self):
+        X = pd.DataFrame({'a': np.arange(20.)}, index=np.arange(20)*2)
+        y = pd.Series(np.arange(20.), index=X.index)
+        for splitter in [KFold(4), LeaveOneOut(), ShuffleSplit(3, test_size=5, train_size=10, random_state=0)]:
+            expected = [(X.index.values[np.sort(train)], X.index.values[np.sort(test)])
+                        for train, test in splitter.split(X, y)]
+            with TemporaryDirectory() as cache_dir:
+                split_cache.make_splits(splitter, X, y, cache_dir=cache_dir)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                splits = split_cache.make_splits(splitter, X, y, cache_dir=cache_dir)
+            self.assertEqual(len(splits), len(expected))
+            for (train, test), (expected_train, expected_test) in zip(splits, expected):
+                self.assertTrue(np.array_equal(train, expected_train))
+                self.assertTrue(np.array_equal(test, expected_test))
+        # numpy shortens the repr of these, hiding where they differ
+        X = pd.DataFrame({'a': np.zeros(2000)})
+        y = pd.Series(np.zeros(2000))
+        test_fold = np.arange(2000) % 2
+        other_test_fold = test_fold.copy()
+        other_test_fold[500] = 1 - other_test_fold[500]
+        with TemporaryDirectory() as cache_dir:
+            split_cache.make_splits(PredefinedSplit(test_fold), X, y, cache_dir=cache_dir)
+            splits = split_cache.make_splits(PredefinedSplit(other_test_fold), X, y, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        for (train, test), (expected_train, expected_test) in zip(splits, PredefinedSplit(other_test_fold).split(X, y)):
+            self.assertTrue(np.array_equal(test, np.sort(expected_test)))
+
+class TestUncertainty(unittest.TestCase):
+
+    def test_forest_prediction_intervals(self):
+        from sklearn.ensemble import RandomForestRegressor
+        X = np.random.RandomState(0).rand(30, 3)
+        y = X.sum(axis=1)
+        forest = RandomForestRegressor(n_estimators=20, random_state=0).fit(X, y)
+        err_down, err_up = uncertainty.prediction_intervals(forest, X, percentile=68)
+        for row, (down, up) in enumerate(zip(err_down, err_up)):
+            tree_preds = [tree.predict(X[row:row+1])[0] for tree in forest.estimators_]
+            self.assertAlmostEqual(down, np.percentile(tree_preds, 16))
+            self.assertAlmostEqual(up, np.percentile(tree_preds, 84))
+
+class TestResultsStore(unittest.TestCase):
+
+    def test_rebuilds_test_csv(self):
+        X = pd.DataFrame(np.random.RandomState(0).rand(12, 2), columns=['a', 'b'])
+        y = pd.Series(X.sum(axis=1), name='target')
+        X_noinput = pd.DataFrame({'name': [f'row{i}' for i in range(12)]})
+        with TemporaryDirectory() as outdir:
+            os.makedirs(os.path.join(outdir, 'DoNothing', 'DoNothing'))
+            pd.concat([X, X_noinput, y], 1).to_csv(
+                    os.path.join(outdir, 'DoNothing', 'DoNothing', 'selected.csv'), index=False)
+            store_path = os.path.join(outdir, results_store.STORE_NAME)
+            combo = 'DoNothing/DoNothing/LinearRegression/KFold'
+            results_store.add_combo(store_path, combo, X)
+            expected = []
+            for split_num, (train, test) in enumerate(KFold(3).split(X)):
+                model = LinearRegression().fit(X.loc[train], y.loc[train])
+                split_result = dict(train_indices=train, test_indices=test,
+                                    y_train_pred=model.predict(X.loc[train]),
+                                    y_test_pred=model.predict(X.loc[test]))
+                results_store.add_split(store_path, combo, split_num, split_result)
+                test_pred = pd.DataFrame(split_result['y_test_pred'], columns=['test_pred'], index=test)
+                expected.append(pd.concat([X.loc[test], y.loc[test], test_pred,
+                                           pd.DataFrame(X_noinput, index=test)], 1).to_csv(index=False))
+            store = results_store.SplitPredictions(store_path)
+            self.assertEqual(store.combos(), [combo])
+            self.assertEqual(store.split_nums(combo), [0, 1, 2])
+            for split_num in range(3):
+                self.assertEqual(store.to_frame(combo, split_num, 'test').to_csv(index=False),
+                                 expected[split_num])
+
+    def test_fold_preprocessed_combo(self):
+        X = pd.DataFrame(np.random.RandomState(0).rand(6, 2), columns=['a', 'b'])
+        with TemporaryDirectory() as outdir:
+            store_path = os.path.join(outdir, results_store.STORE_NAME)
+            combo = 'DoNothing/SelectKBest/LinearRegression/KFold'
+            results_store.add_combo(store_path, combo, X, fold_preprocessed=True)
+            for split_num, (train, test) in enumerate(KFold(2).split(X)):
+                split_result = dict(train_indices=train, test_indices=test,
+                                    y_train_pred=np.zeros(len(train)), y_test_pred=np.zeros(len(test)))
+                results_store.add_split(store_path, combo, split_num, split_result, x_columns=[['a'], ['b']][split_num])
+            store = results_store.SplitPredictions(store_path)
+            self.assertTrue(store.fold_preprocessed(combo))
+            self.assertEqual(list(store.get(combo, 1)['x_columns']), ['b'])
+            # each split saw its own features, which aren't in the store
+            self.assertRaises(ValueError, store.to_frame, combo, 0, 'test')
+
+class TestFoldPipeline(unittest.TestCase):
+
+    def test_fits_each_fold_once_on_its_training_rows(self):
+        X = pd.DataFrame(np.random.RandomState(0).rand(20, 3), columns=['a', 'b', 'c'])
+        y = pd.Series(np.arange(20.))
+        folds = [X.index[train] for train, test in KFold(4).split(X)]
+        transformed = fold_pipeline.transform_folds([('MeanStdevScaler', MeanStdevScaler())],
+                                                    [('DoNothing', util_legos.DoNothing())],
+                                                    X, y, folds + folds)
+        self.assertEqual(len(transformed), 4)
+        train = folds[0]
+        expected = (X - X.loc[train].values.mean()) / X.loc[train].values.std()
+        result = transformed[(fold_pipeline.fold_key(train), 'MeanStdevScaler', 'DoNothing')]
+        self.assertTrue(np.allclose(result[expected.columns].values, expected.values))
+
+class TestDataLoader(unittest.TestCase):
+
+    def test_low_memory_matches_default(self):
+        df = pd.DataFrame({'name': ['a', 'b', 'c', 'a'], 'x1': [0.5, 1.5, 2.5, 3.5],
+                           'unused': [1., 2., 3., 4.], 'target': [1., 2., 3., 4.]})
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'data.csv')
+            df.to_csv(path, index=False)
+            _, X, X_noinput, _, y = data_loader.load_data(path, ['x1', 'name'], 'target', None, ['name'])
+            lean_df, lean_X, lean_X_noinput, _, lean_y = data_loader.load_data(
+                    path, ['x1', 'name'], 'target', None, ['name'], low_memory=True)
+        self.assertNotIn('unused', lean_df.columns)
+        self.assertEqual(lean_X['x1'].dtype, np.float32)
+        self.assertTrue(np.allclose(lean_X.values, X.values))
+        self.assertEqual(list(lean_X_noinput['name']), list(X_noinput['name']))
+        self.assertTrue(lean_y.equals(y))
+
+    def test_data_cache(self):
+        df = pd.DataFrame({'name': ['a', 'b', None, 'a'], 'x1': [0.5, 1.5, 2.5, 3.5], 'target': [1, 2, 3, 4]})
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'data.csv')
+            df.to_csv(path, index=False)
+            loaded = data_loader.load_data(path, cache=True)
+            self.assertTrue(os.path.isdir(data_cache.cache_path(path)))
+            cached = data_loader.load_data(path, cache=True)
+            for first, second in zip(loaded, cached):
+                if first is not None:
+                    self.assertTrue(first.equals(second))
+            df.iloc[:2].to_csv(path, index=False)
+            self.assertIsNone(data_cache.cached_columns(path))
+
+    def test_data_cache_unstorable(self):
+        # like an xlsx column with dates mixed into the text, which json can't write
+        df = pd.DataFrame({'when': [pd.Timestamp('2018-01-01'), 'unknown'], 'target': [1, 2]})
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'data.xlsx')
+            open(path, 'w').close()
+            self.assertRaises(TypeError, data_cache.save, path, df)
+            self.assertEqual(os.listdir(tmpdir), ['data.xlsx'])
+            data_loader._read_file, read_file = (lambda file_path, usecols=None: df), data_loader._read_file
+            try:
+                self.assertIs(data_loader._read_cached(path), df)
+            finally:
+                data_loader._read_file = read_file
+
+class TestModelFinder(unittest.TestCase):
+
+    def test_registry(self):
+        with TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'model_registry.json')
+            registry = model_finder.ModelRegistry(path)
+            registry.update(model_finder.custom_models)
+            self.assertFalse(os.path.exists(path)) # nothing is found until it's used
+            self.assertIs(registry['Ridge'], Ridge)
+            self.assertIs(registry['AlwaysFive'], model_finder.AlwaysFive)
+            with open(path) as f:
+                saved = json.load(f)
+            self.assertIn('Ridge', saved['models'])
+            saved['sklearn_version'] = 'some other version'
+            saved['models'] = dict()
+            with open(path, 'w') as f:
+                json.dump(saved, f)
+            self.assertIn('Ridge', model_finder.load_registry(path))
+
+class TestParamGrid(unittest.TestCase):
+
+    def test_matches_old_grid(self):
+        alphas, gammas, sizes = [0.1, 1., 10., 100.], [1, 2], [3, 4, 5]
+        grid = grid_search.ParamGrid([('model', 'alpha', alphas), ('model', 'gamma', gammas),
+                                      ('feature', 'size', sizes)], [('model', 'kernel', 'rbf')])
+        # the grid grow_param_dict used to build, one parameter at a time
+        old_grid = dict()
+        for i, alpha in enumerate(alphas):
+            for j, gamma in enumerate(gammas):
+                for k, size in enumerate(sizes):
+                    old_grid['%i_%i_%i' % (i, j, k)] = {'model': {'alpha': alpha, 'gamma': gamma, 'kernel': 'rbf'},
+                                                        'feature': {'size': size}}
+        self.assertEqual(len(grid), 24)
+        self.assertEqual(list(grid), list(old_grid))
+        self.assertEqual(list(grid)[:3], ['0_0_0', '0_0_1', '0_0_2'])
+        self.assertEqual(grid['3_0_1'], {'model': {'alpha': 100., 'gamma': 1, 'kernel': 'rbf'}, 'feature': {'size': 4}})
+        self.assertEqual(dict(grid), old_grid)
+        for index, key in enumerate(old_grid):
+            self.assertEqual(grid.get_key(index), key)
+            self.assertEqual(grid.get_index(key), index)
+            self.assertEqual(grid.params_at(index), old_grid[key])
+        self.assertNotIn('4_0_0', grid)
+        self.assertNotIn('3_0', grid)
+
+    def test_evaluated_in_chunks(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.rand(30, 2), columns=['x1', 'x2'])
+        df['y'] = df['x1'] + rng.rand(30)
+        dataset = DataHandler(df, input_features=['x1', 'x2'], target_feature='y')
+        pop_rmses = list()
+        evaluated = list()
+        evaluation_chunk = grid_search.EVALUATION_CHUNK
+        try:
+            for chunk in [evaluation_chunk, 2]:
+                grid_search.EVALUATION_CHUNK = chunk
+                with TemporaryDirectory() as tmpdir:
+                    search = grid_search.GridSearch(['model;alpha;float;discrete;1:2:3:1'], dataset, dataset, Ridge(),
+                                                    save_path=tmpdir, num_folds=3)
+                    search.set_up()
+                    evaluate_indiv = search.evaluate_indiv
+                    def counted(indiv_params, indiv_key, rows=None):
+                        evaluated.append(indiv_key)
+                        return evaluate_indiv(indiv_params, indiv_key, rows)
+                    search.evaluate_indiv = counted
+                    search.evaluate_pop()
+                    pop_rmses.append(search.pop_rmses)
+        finally:
+            grid_search.EVALUATION_CHUNK = evaluation_chunk
+        # '3' repeats the genome of '0', which an earlier chunk already evaluated
+        self.assertEqual(evaluated, ['0', '1', '2'] * 2)
+        self.assertEqual(pop_rmses[0], pop_rmses[1])
+        self.assertEqual(pop_rmses[1]['3'], pop_rmses[1]['0'])
+
+class TestFitnessCache(unittest.TestCase):
+
+    def test_genomes_are_evaluated_once(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.rand(30, 2), columns=['x1', 'x2'])
+        df['y'] = df['x1'] + rng.rand(30)
+        dataset = DataHandler(df, input_features=['x1', 'x2'], target_feature='y')
+        evaluated = list()
+        def generation(save_path, cache_file):
+            # unseeded, like a real resumed search
+            search = genetic_search.GeneticSearch(['model;alpha;float;discrete;1:1:2'], dataset, dataset, Ridge(),
+                                                  save_path, percent_leave_out=20, num_cvtests=3,
+                                                  fitness_cache_file=cache_file)
+            gen = search.set_up_generation()
+            gen.set_up()
+            evaluate_indiv = gen.evaluate_indiv
+            def counted(indiv_params, indiv_key, rows=None):
+                evaluated.append(indiv_key)
+                return evaluate_indiv(indiv_params, indiv_key, rows)
+            gen.evaluate_indiv = counted
+            gen.evaluate_pop()
+            return gen
+        with TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'fitness_cache.json')
+            first = generation(os.path.join(tmpdir, 'first'), cache_file)
+            self.assertEqual(len(evaluated), 2) # alphas 1, 1 and 2
+            self.assertEqual(first.pop_rmses['0'], first.pop_rmses['1'])
+            first.evaluate_pop()
+            self.assertEqual(len(evaluated), 2)
+            resumed = generation(os.path.join(tmpdir, 'resumed'), cache_file)
+            self.assertEqual(len(evaluated), 2)
+            self.assertEqual(resumed.pop_rmses, first.pop_rmses)
+
+class TestWarmStart(unittest.TestCase):
+
+    def test_path_matches_fitting_from_scratch(self):
+        rng = np.random.RandomState(0)
+        X = rng.rand(40, 3)
+        y = 3*X[:, 0] + rng.rand(40)
+        splitter = KFold(4)
+        for model, param, values, tolerance in [
+                (RandomForestRegressor(random_state=0), 'n_estimators', [3, 6, 10], 0),
+                (GradientBoostingRegressor(random_state=0, subsample=0.7), 'n_estimators', [5, 10, 20], 0),
+                (Lasso(), 'alpha', [0.1, 0.01, 0.001], 1e-5)]:
+            indiv_params_list = [{'model': {param: value}} for value in values]
+            path_rmses = grid_search._cv_rmses_along_path(model, indiv_params_list, param, X, y, splitter)
+            rmses = [grid_search._cv_rmse(model, indiv_params, X, y, splitter) for indiv_params in indiv_params_list]
+            self.assertTrue(np.allclose(path_rmses, rmses, rtol=0, atol=tolerance), type(model).__name__)
+
+    def test_unseeded_models_fit_from_scratch(self):
+        dataset = DataHandler(pd.DataFrame({'x': np.arange(10.), 'y': np.arange(10.)}),
+                              input_features=['x'], target_feature='y')
+        with TemporaryDirectory() as tmpdir:
+            for model, path_param in [(RandomForestRegressor(random_state=0), 'n_estimators'),
+                                      (RandomForestRegressor(), None)]:
+                search = grid_search.GridSearch(['model;n_estimators;int;discrete;5:10'], dataset, dataset, model,
+                                                save_path=tmpdir, num_folds=2, warm_start=True)
+                search.set_up()
+                self.assertEqual(search.get_warm_start_param(), path_param)
+
+class TestHillClimbing(unittest.TestCase):
+
+    def test_climb_hill(self):
+        rng = np.random.RandomState(0)
+        X = pd.DataFrame(rng.rand(40, 2), columns=['x1', 'x2'])
+        y = X['x1'] + 0.1*rng.rand(40)
+        fits = list()
+        class StubModel:
+            def __init__(self, a, b):
+                fits.append((a, b))
+                self.prediction = a + b
+            def fit(self, X, y):
+                return self
+            def predict(self, X):
+                return np.full(len(X), self.prediction)
+        steps = list()
+        random_subset = hill_climbing.random_subset
+        def counted_subset(*args):
+            steps.append(1)
+            return random_subset(*args)
+        hill_climbing.random_subset = counted_subset
+        try:
+            random.seed(0)
+            best_score, best_params = hill_climbing.climb_hill(StubModel, X, y, dict(a=[0, 1, 2, 3], b=[0, 1]),
+                                                               lambda y_true, y_pred: -abs(y_pred[0] - 3),
+                                                               num_steps=30, num_restarts=1)
+        finally:
+            hill_climbing.random_subset = random_subset
+        self.assertEqual(len(steps), 30)
+        # revisited points are scored from the cache, not refit
+        self.assertEqual(len(fits), len(set(fits)))
+        self.assertEqual(best_score, 0)
+        self.assertEqual(best_params['a'] + best_params['b'], 3)
+
+        results = list()
+        for n_jobs in [1, 2]:
+            random.seed(0)
+            results.append(hill_climbing.climb_hill(Ridge, X, y, dict(alpha=[0.001, 0.01, 0.1, 1, 10], fit_intercept=[True, False]),
+                                                    r2_score, num_steps=10, num_restarts=4, n_jobs=n_jobs))
+        self.assertEqual(results[0], results[1])
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_pool_matches_serial(self):
+        rng = np.random.RandomState(0)
+        df = pd.DataFrame(rng.rand(30, 2), columns=['x1', 'x2'])
+        df['y'] = df['x1'] + rng.rand(30)
+        dataset = DataHandler(df, input_features=['x1', 'x2'], target_feature='y')
+        pop_rmses = list()
+        with TemporaryDirectory() as tmpdir:
+            for processors in [1, 2]:
+                search = grid_search.GridSearch(['model;alpha;float;discrete;0.1:1:10', 'model;tol;float;discrete;0.001:0.01'],
+                                                dataset, dataset, Ridge(), save_path=os.path.join(tmpdir, str(processors)),
+                                                num_folds=3, processors=processors)
+                search.set_up()
+                search.evaluate_pop()
+                pop_rmses.append(search.pop_rmses)
+            pool = search.worker_pool
+            self.assertIsNotNone(pool)
+            # a second population is sent to the same workers
+            search.fitness_cache.clear()
+            search.evaluate_pop()
+            self.assertIs(search.worker_pool, pool)
+            self.assertEqual(search.pop_rmses, pop_rmses[1])
+            search.close_worker_pool()
+            self.assertIsNone(search.worker_pool)
+            self.assertRaises(ValueError, pool.apply, abs, (-1,))
+            # and run shuts its own pool down when it's done
+            search.fitness_cache.clear()
+            search.run()
+            self.assertIsNone(search.worker_pool)
+        self.assertEqual(pop_rmses[0], pop_rmses[1])
+
+class TestRunFits(unittest.TestCase):
+
+    def run_fits(self, X, y, model, is_classification, metric_names, n_jobs):
+        trains_tests = [(X.index[train], X.index[test]) for train, test in KFold(4).split(X)]
+        fit_settings = dict(is_classification=is_classification, is_validation=False, metric_names=metric_names,
+                            PlotSettings=dict(train_test_plots=False, defer_plots=False, dpi=100), X_noinput=None)
+        with TemporaryDirectory() as tmpdir:
+            main_path = os.path.join(tmpdir, 'DoNothing', 'DoNothing', type(model).__name__, 'KFold')
+            os.makedirs(main_path)
+            fit_tasks = [(mastml.mastml._FoldData(X, y), model, main_path, split_num, trains_tests, None)
+                         for split_num in range(len(trains_tests))]
+            return mastml.mastml._run_fits(fit_tasks, fit_settings, n_jobs)
+
+    def test_parallel_matches_serial(self):
+        rng = np.random.RandomState(0)
+        X = pd.DataFrame(rng.rand(40, 3), columns=['a', 'b', 'c'], index=np.arange(40)*2)
+        y = pd.Series(X['a'] + rng.rand(40), index=X.index, name='y')
+        serial, parallel = [self.run_fits(X, y, Ridge(), False, ['R2', 'root_mean_squared_error'], n_jobs)
+                            for n_jobs in [1, 2]]
+        self.assertEqual(len(serial), 4)
+        for serial_result, parallel_result in zip(serial, parallel):
+            self.assertEqual(serial_result['split_num'], parallel_result['split_num'])
+            for name in ['train_indices', 'test_indices', 'y_test_true', 'y_test_pred', 'y_train_pred']:
+                self.assertTrue(np.array_equal(serial_result[name], parallel_result[name]), name)
+            self.assertEqual(serial_result['test_metrics'], parallel_result['test_metrics'])
+
+    def test_missing_predict_proba(self):
+        rng = np.random.RandomState(0)
+        X = pd.DataFrame(rng.rand(40, 2), columns=['a', 'b'])
+        y = pd.Series((X['a'] > 0.5).astype(int), name='y')
+        for n_jobs in [1, 2]:
+            # an error for the user, not an exit that would take a worker down with it
+            self.assertRaises(mastml.utils.InvalidModel, self.run_fits, X, y, SVC(), True, ['accuracy'], n_jobs)
+
+class TestSuccessiveHalving(unittest.TestCase):
+
+    def test_halving(self):
+        dataset = SimpleNamespace(data=pd.DataFrame({'x': np.arange(64.)}))
+        for num_bests, expected_rungs, expected_budgets in [
+                (1, [(8, 8), (4, 16), (2, 32), (1, 64)], [64, 32, 16, 16, 8, 8, 8, 8]),
+                (3, [(8, 32), (4, 64)], [64, 64, 64, 64, 32, 32, 32, 32])]:
+            with TemporaryDirectory() as tmpdir:
+                search = grid_search.GridSearch(['model;alpha;int;discrete;0:1:2:3:4:5:6:7'], dataset, dataset,
+                                                Ridge(), save_path=tmpdir, fix_random_for_testing=1,
+                                                num_bests=num_bests, halving_factor=2, halving_min_rows=5)
+                search.set_up()
+                rungs = list()
+                def evaluate_indivs(ikeys, rows=None):
+                    # smaller alphas score better, on any rows
+                    n_rows = 64 if rows is None else len(rows)
+                    rungs.append((len(ikeys), n_rows))
+                    for ikey in ikeys:
+                        search.pop_rmses[ikey] = search.pop_params[ikey]['model']['alpha'] + 1. / n_rows
+                search.evaluate_indivs = evaluate_indivs
+                search.evaluate_pop()
+                self.assertEqual(rungs, expected_rungs)
+                self.assertEqual(search.pop_budgets, dict(zip(map(str, range(8)), expected_budgets)))
+                # the last rung keeps num_bests survivors, and only they are compared
+                search.get_best_indivs()
+                self.assertEqual([indiv[0] for indiv in search.best_indivs], list(map(str, range(num_bests))))
+                search.flatten_results()
+                results = pd.read_csv(os.path.join(tmpdir, 'results.csv'), index_col=0)
+                self.assertEqual(dict(zip(results['key'].astype(str), results['rows_scored_on'])), search.pop_budgets)
+                self.assertEqual(search.get_plot_rmses().notnull().sum(), expected_budgets.count(64))
+
 def string_to_filename(st):
     f = NamedTemporaryFile(mode='w', delete=False)
     f.write(st)